@@ -154,7 +154,12 @@ def start_server(
     
     # Register all blueprints
     register_extensions(flask_app)
-    
+
+    # Create the tables and indexes which do not exist yet (e.g. added by an
+    # update):
+    with flask_app.app_context():
+        create_tables()
+
     # Ensure default admin exists
     create_default_admin(flask_app, admin_user, admin_password)
     
@@ -257,7 +262,7 @@ def register_extensions(app):
 # Decide whether to parse CLI args. If help is requested or the first token
 # Module-level initialization for when IRIS is imported (not run as CLI)
 # This is used by tests and when importing iris as a library
-from iris.models import Action, User
+from iris.models import Action, User, create_tables
 
 # Create default app for imports/tests
 _default_args = {
@@ -269,7 +274,7 @@ _default_args['project'] = get_demo_file()
 app = create_app(_default_args['project'], _default_args)
 
 with app.app_context():
-    db.create_all()
+    create_tables()
     db.session.commit()
 
 register_extensions(app)
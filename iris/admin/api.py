@@ -3,9 +3,16 @@ JSON API endpoints for admin interface.
 
 Provides REST API endpoints that return JSON data for the React frontend.
 """
+import io
+
 import flask
-from iris.user import requires_auth
-from iris.models import User
+from PIL import Image as PILImage
+from sqlalchemy import distinct, func
+from iris.user import requires_admin, requires_auth
+from iris.models import Agreement, ClassCount, Conflict, User, db
+from iris.project import project
+from iris.segmentation.remerge import remerger
+from iris.segmentation.scheduler import scheduler
 
 api_bp = flask.Blueprint(
     'admin_api', __name__,
@@ -27,6 +34,179 @@ def users():
     else:
         users = users.order_by(getattr(User, order_by).desc()).all()
 
-    users_json = [user.to_json() for user in users]
+    # The statistics of all users are aggregated in a single query (users
+    # without masks are not listed and get zeros):
+    stats = User.get_segmentation_stats()
+    users_json = [user.to_json(segmentation=stats.get(user.id)) for user in users]
     
-    return flask.jsonify({'users': users_json})
\ No newline at end of file
+    return flask.jsonify({'users': users_json})
+
+
+@api_bp.route('/metrics', methods=['GET'])
+@requires_admin
+def metrics():
+    """Get server metrics, e.g. thread allocation and wait times of AI jobs."""
+    return flask.jsonify({'scheduler': scheduler.stats()})
+
+
+@api_bp.route('/remerge', methods=['POST'])
+@requires_admin
+def start_remerge():
+    """Re-merge all annotated images and recompute their scores.
+
+    Optional JSON: {"workers": <number of threads>, "batch_size": <images per
+    commit>}. The remerge runs in the background; poll GET /remerge for the
+    progress.
+    """
+    data = flask.request.get_json(silent=True) or {}
+    try:
+        workers = int(data.get('workers', 1))
+        batch_size = int(data.get('batch_size', 50))
+    except (TypeError, ValueError):
+        return flask.make_response('workers and batch_size must be integers!', 400)
+    if workers < 1 or batch_size < 1:
+        return flask.make_response('workers and batch_size must be positive!', 400)
+
+    if not remerger.start(flask.current_app._get_current_object(), workers, batch_size):
+        return flask.make_response('A remerge is already running!', 409)
+    return flask.jsonify({'remerge': remerger.get_status()}), 202
+
+
+@api_bp.route('/remerge', methods=['GET'])
+@requires_admin
+def get_remerge():
+    """Get the progress of the last remerge."""
+    return flask.jsonify({'remerge': remerger.get_status()})
+
+
+@api_bp.route('/statistics', methods=['GET'])
+@requires_admin
+def statistics():
+    """Get the class distribution over all saved masks and per annotator.
+
+    Pixels labelled by hand (`user_pixels`) and by the AI (`ai_pixels`) are
+    counted separately. The counts are updated whenever masks are merged.
+    """
+    sums = (
+        func.sum(ClassCount.pixels), func.sum(ClassCount.user_pixels),
+        func.count(distinct(ClassCount.image_id)),
+    )
+    class_names = [klass['name'] for klass in project['classes']]
+
+    def counts(pixels, user_pixels, n_images):
+        return {
+            'pixels': int(pixels), 'user_pixels': int(user_pixels),
+            'ai_pixels': int(pixels - user_pixels), 'n_images': n_images,
+        }
+
+    classes = [
+        {
+            'class_id': class_id,
+            'name': class_names[class_id] if class_id < len(class_names) else None,
+            **counts(*row),
+        }
+        for class_id, *row in db.session.query(ClassCount.class_id, *sums)
+            .group_by(ClassCount.class_id).order_by(ClassCount.class_id)
+    ]
+
+    users = {}
+    rows = db.session.query(ClassCount.user_id, User.name, ClassCount.class_id, *sums)\
+        .join(User, User.id == ClassCount.user_id)\
+        .group_by(ClassCount.user_id, User.name, ClassCount.class_id)\
+        .order_by(ClassCount.user_id, ClassCount.class_id)
+    for user_id, name, class_id, *row in rows:
+        user = users.setdefault(user_id, {
+            'user_id': user_id, 'name': name, 'pixels': 0, 'user_pixels': 0,
+            'ai_pixels': 0, 'classes': {},
+        })
+        user['classes'][class_id] = counts(*row)
+        for key in ('pixels', 'user_pixels', 'ai_pixels'):
+            user[key] += user['classes'][class_id][key]
+    # The number of images per user is counted over all classes:
+    for user_id, n_images in db.session.query(
+                ClassCount.user_id, func.count(distinct(ClassCount.image_id))
+            ).group_by(ClassCount.user_id):
+        if user_id in users:
+            users[user_id]['n_images'] = n_images
+
+    return flask.jsonify({'classes': classes, 'users': list(users.values())})
+
+
+@api_bp.route('/agreement', methods=['GET'])
+@requires_admin
+def agreement():
+    """Get the pairwise agreement of all annotators.
+
+    `matrix[i][j]` is the percentage of pixels on which users i and j agree
+    over all images they both annotated (null if there are none), `n_images`
+    the number of these images. The agreement is updated whenever masks are
+    merged.
+    """
+    rows = db.session.query(
+            Agreement.user_a, Agreement.user_b, func.sum(Agreement.agreeing_pixels),
+            func.sum(Agreement.pixels), func.count(Agreement.image_id)
+        ).group_by(Agreement.user_a, Agreement.user_b).all()
+
+    user_ids = sorted({user_id for row in rows for user_id in row[:2]})
+    names = dict(
+        db.session.query(User.id, User.name).filter(User.id.in_(user_ids))
+    )
+    index = {user_id: i for i, user_id in enumerate(user_ids)}
+    matrix = [[None] * len(user_ids) for _ in user_ids]
+    n_images = [[0] * len(user_ids) for _ in user_ids]
+    for i in range(len(user_ids)):
+        matrix[i][i] = 100.
+    for user_a, user_b, agreeing_pixels, pixels, n in rows:
+        a, b = index[user_a], index[user_b]
+        matrix[a][b] = matrix[b][a] = round(100 * agreeing_pixels / max(pixels, 1), 2)
+        n_images[a][b] = n_images[b][a] = n
+
+    return flask.jsonify({
+        'users': [{'id': user_id, 'name': names.get(user_id)} for user_id in user_ids],
+        'matrix': matrix,
+        'n_images': n_images,
+    })
+
+
+@api_bp.route('/review-queue', methods=['GET'])
+@requires_admin
+def review_queue():
+    """Get the images with the most disagreement between the annotators first.
+
+    Query parameters:
+        limit: number of images (default: 20)
+        offset: number of images to skip (default: 0)
+        min_score: only images with a higher conflict score (default: 0)
+    """
+    try:
+        limit = int(flask.request.args.get('limit', 20))
+        offset = int(flask.request.args.get('offset', 0))
+        min_score = float(flask.request.args.get('min_score', 0))
+    except ValueError:
+        return flask.make_response('limit, offset and min_score must be numbers!', 400)
+
+    # Served from the index of the conflict score:
+    conflicts = Conflict.query.filter(Conflict.score > min_score)\
+        .order_by(Conflict.score.desc(), Conflict.image_id)\
+        .offset(offset).limit(limit).all()
+    return flask.jsonify({'images': [conflict.to_json() for conflict in conflicts]})
+
+
+@api_bp.route('/review-queue/<image_id>/disagreement', methods=['GET'])
+@requires_admin
+def get_disagreement_map(image_id):
+    """Get the pixels on which the annotators of an image disagree as PNG."""
+    # Imported here to avoid circular imports:
+    from iris.segmentation import read_disagreement
+
+    if image_id not in project.image_ids:
+        return flask.make_response('Unknown image id!', 404)
+    disagreement = read_disagreement(image_id)
+    if disagreement is None:
+        return flask.make_response('The masks of this image were not merged yet!', 404)
+
+    stream = io.BytesIO()
+    PILImage.fromarray(disagreement).save(stream, format='PNG')
+    response = flask.make_response(stream.getvalue())
+    response.headers.set('Content-Type', 'image/png')
+    return response
@@ -6,7 +6,7 @@ which offers better type hints, automatic help generation, and cleaner code.
 """
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import typer
 from typing_extensions import Annotated
@@ -131,6 +131,199 @@ def rm(
         raise typer.Exit(code=1)
 
 
+@app.command()
+def benchmark(
+    project: Annotated[str, typer.Argument(help="Path to project configuration file (JSON or YAML)")],
+    backend: Annotated[
+        Optional[List[str]],
+        typer.Option("--backend", "-b", help="Backend to benchmark (repeatable, default: all)"),
+    ] = None,
+    image: Annotated[
+        Optional[List[str]],
+        typer.Option("--image", "-i", help="Image id to use (repeatable, default: all with masks)"),
+    ] = None,
+    threads: Annotated[int, typer.Option("--threads", "-t", help="Number of threads per backend")] = 1,
+):
+    """
+    Compare the AI backends on the saved masks of a project.
+
+    Each backend is trained on the pixels the users labelled by hand and
+    reports fit time, predict time, memory and the agreement with the saved
+    masks.
+
+    Examples:
+        iris benchmark my-project.json
+        iris benchmark my-project.json -b lightgbm -b nearest_centroid
+    """
+    from iris.project import project as iris_project
+    from iris.segmentation.benchmark import run_benchmark, summarise
+
+    project_path = Path(project)
+    if not project_path.exists():
+        typer.echo(f"Error: Project file '{project}' not found!", err=True)
+        raise typer.Exit(code=1)
+
+    iris_project.load_from(str(project_path))
+    try:
+        results = run_benchmark(backends=backend, image_ids=image, n_threads=threads)
+    except ValueError as e:
+        typer.echo(f"Error: {e}", err=True)
+        raise typer.Exit(code=1) from e
+
+    if not results:
+        typer.echo("No saved masks found!", err=True)
+        raise typer.Exit(code=1)
+
+    typer.echo(
+        f"{'backend':<24}{'masks':>6}{'fit [s]':>10}{'predict [s]':>13}"
+        f"{'memory [MB]':>13}{'agreement':>11}"
+    )
+    for name, row in summarise(results).items():
+        typer.echo(
+            f"{name:<24}{row['n_masks']:>6}{row['fit_time']:>10.3f}"
+            f"{row['predict_time']:>13.3f}{row['peak_memory']:>13.1f}"
+            f"{row['agreement']:>11.2%}"
+        )
+
+
+@app.command("export")
+def export(
+    project: Annotated[str, typer.Argument(help="Path to project configuration file (JSON or YAML)")],
+    format: Annotated[str, typer.Option("--format", "-f", help="Mask format: 'png', 'npz' or 'geotiff'")] = "png",
+    workers: Annotated[int, typer.Option("--workers", "-w", help="Number of worker processes")] = 1,
+    output: Annotated[
+        Optional[str],
+        typer.Option("--output", "-o", help="Output folder (default: export in the project folder)"),
+    ] = None,
+):
+    """
+    Export the merged masks and statistics of all images.
+
+    The masks of all users are merged for each image and saved in the chosen
+    format (GeoTIFFs keep the georeferencing of the source images). The
+    statistics of each image and user are written to images.csv and
+    users.csv in the output folder.
+
+    Examples:
+        iris export my-project.json
+        iris export my-project.json --format geotiff --workers 8
+    """
+    from os.path import join
+
+    from iris.project import project as iris_project
+    from iris.segmentation.export import export_project
+
+    project_path = Path(project)
+    if not project_path.exists():
+        typer.echo(f"Error: Project file '{project}' not found!", err=True)
+        raise typer.Exit(code=1)
+
+    iris_project.load_from(str(project_path))
+    output = output or join(iris_project['path'], 'export')
+    try:
+        n_images = export_project(output, format=format, workers=workers)
+    except ValueError as e:
+        typer.echo(f"Error: {e}", err=True)
+        raise typer.Exit(code=1) from e
+    typer.echo(f"Exported {n_images} images to {output}.")
+
+
+@app.command()
+def remerge(
+    project: Annotated[str, typer.Argument(help="Path to project configuration file (JSON or YAML)")],
+    workers: Annotated[int, typer.Option("--workers", "-w", help="Number of worker processes")] = 1,
+    batch_size: Annotated[
+        int, typer.Option("--batch-size", help="Number of images whose scores are committed together")
+    ] = 50,
+):
+    """
+    Merge the masks of all images again and recompute all scores.
+
+    Use it after changing the score, unverified_threshold or mask_encoding
+    of the segmentation config. Stop the server before running it.
+
+    Examples:
+        iris remerge my-project.json
+        iris remerge my-project.json --workers 8
+    """
+    from iris import create_app
+    from iris.models import create_tables
+    from iris.segmentation.remerge import remerger
+
+    project_path = Path(project)
+    if not project_path.exists():
+        typer.echo(f"Error: Project file '{project}' not found!", err=True)
+        raise typer.Exit(code=1)
+
+    def progress(done, total):
+        typer.echo(f"Merged {done}/{total} images")
+
+    flask_app = create_app(str(project_path), {'debug': False})
+    with flask_app.app_context():
+        create_tables()
+        status = remerger.run(workers=workers, batch_size=batch_size, progress=progress)
+
+    for image_id, error in status['failed'].items():
+        typer.echo(f"Error: could not merge {image_id}: {error}", err=True)
+    if status['failed']:
+        raise typer.Exit(code=1)
+
+
+@app.command("migrate-masks")
+def migrate_masks(
+    project: Annotated[str, typer.Argument(help="Path to project configuration file (JSON or YAML)")],
+    to: Annotated[str, typer.Option("--to", help="Target mask store: 'files' or 'sqlite'")] = "files",
+    from_sqlite: Annotated[
+        bool, typer.Option("--from-sqlite", help="With --to files: export the masks of the SQLite store to files")
+    ] = False,
+):
+    """
+    Convert the saved masks of a project.
+
+    With --to files (default), masks saved by older versions of IRIS (one-hot
+    `_final.npy` and `_user.npy` files) are rewritten as compressed label
+    images with a bit-packed user mask. With --from-sqlite, the masks of a
+    SQLite store are exported to this per-file layout as well. With --to
+    sqlite, all per-file masks are copied into a single SQLite file. Masks
+    with a newer version in the target store are never overwritten. Set
+    `segmentation : mask_store` in the project file to use the new store
+    afterwards.
+
+    Examples:
+        iris migrate-masks my-project.json
+        iris migrate-masks my-project.json --to sqlite
+        iris migrate-masks my-project.json --to files --from-sqlite
+    """
+    from os.path import exists
+
+    from iris.project import project as iris_project
+    from iris.segmentation.storage import copy_masks, get_mask_store
+
+    project_path = Path(project)
+    if not project_path.exists():
+        typer.echo(f"Error: Project file '{project}' not found!", err=True)
+        raise typer.Exit(code=1)
+
+    iris_project.load_from(str(project_path))
+    try:
+        target = get_mask_store(to)
+    except ValueError as e:
+        typer.echo(f"Error: {e}", err=True)
+        raise typer.Exit(code=1) from e
+
+    if to == 'files':
+        n_masks = target.migrate()
+        if from_sqlite:
+            sqlite = get_mask_store('sqlite')
+            if not exists(sqlite.filename):
+                typer.echo(f"Error: no SQLite mask store found at '{sqlite.filename}'!", err=True)
+                raise typer.Exit(code=1)
+            n_masks += copy_masks(sqlite, target)
+    else:
+        n_masks = copy_masks(get_mask_store('files'), target)
+    typer.echo(f"Converted {n_masks} masks.")
+
+
 def main():
     """Entry point for the IRIS CLI."""
     app()
@@ -5,6 +5,9 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 from iris import db
 
+# Default of optional arguments for which None is a valid value:
+_NOT_GIVEN = object()
+
 class JsonSerializable:
     def to_json(self):
         json = {
@@ -48,25 +51,68 @@ class User(JsonSerializable, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    def to_json(self, full=False):
+    def to_json(self, full=False, segmentation=_NOT_GIVEN):
+        """Get the user as dictionary
+
+        Args:
+            full: Unused.
+            segmentation: Statistics of the user's masks as returned by
+                `get_segmentation_stats` (queried if not given, None if the
+                user has no masks).
+        """
         data = super().to_json()
         del data['password_hash']
 
-        masks = Action.query.filter_by(user=self, type="segmentation").all()
-        data['segmentation'] = {
-            'score': 0,
-            'score_unverified': 0,
-            'n_masks': len(masks)
-        }
-        for mask in masks:
-            if mask.unverified:
-                data['segmentation']['score_unverified'] += mask.score
-            else:
-                data['segmentation']['score'] += mask.score
+        if segmentation is _NOT_GIVEN:
+            segmentation = User.get_segmentation_stats([self.id])[self.id]
+        data['segmentation'] = segmentation or User._empty_segmentation_stats()
 
         return data
 
+    @staticmethod
+    def get_segmentation_stats(user_ids=None):
+        """Sum up the masks of users in a single query
+
+        Args:
+            user_ids: Ids of the users (default: all users).
+
+        Returns:
+            Dictionary with the statistics for each user id: score (sum of the
+            verified scores), score_unverified and n_masks. Given users without
+            masks get zeros, with the default only users with masks are listed.
+        """
+        query = db.session.query(
+            Action.user_id,
+            db.func.sum(db.case((Action.unverified.is_(True), 0), else_=Action.score)),
+            db.func.sum(db.case((Action.unverified.is_(True), Action.score), else_=0)),
+            db.func.count(Action.id),
+        ).filter(Action.type == "segmentation")
+        if user_ids is not None:
+            query = query.filter(Action.user_id.in_(user_ids))
+
+        stats = {
+            user_id: User._empty_segmentation_stats()
+            for user_id in user_ids or []
+        }
+        stats.update({
+            user_id: {
+                'score': int(score or 0),
+                'score_unverified': int(score_unverified or 0),
+                'n_masks': n_masks,
+            }
+            for user_id, score, score_unverified, n_masks
+            in query.group_by(Action.user_id)
+        })
+        return stats
+
+    @staticmethod
+    def _empty_segmentation_stats():
+        return {'score': 0, 'score_unverified': 0, 'n_masks': 0}
+
 class Action(JsonSerializable, db.Model):
+    # For the statistics of each user:
+    __table_args__ = (db.Index('ix_action_type_user', 'type', 'user_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     # Can be segmentation, classification or detection:
     type = db.Column(db.String(64), index=True)
@@ -85,3 +131,84 @@ class Action(JsonSerializable, db.Model):
 
     def __repr__(self):
         return f'<Action user={self.user_id}, image_id={self.image_id}, score={self.score}>'
+
+class ClassCount(JsonSerializable, db.Model):
+    """Number of pixels of a class in the mask of a user
+
+    Updated whenever the masks of an image are merged, so dataset statistics
+    can be aggregated without reading the masks.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('image_id', 'user_id', 'class_id'),
+        db.Index('ix_class_count_user_class', 'user_id', 'class_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.String(256), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    class_id = db.Column(db.Integer, index=True)
+    # All pixels of this class:
+    pixels = db.Column(db.Integer, default=0)
+    # Pixels of this class which the user labelled by hand (the others were
+    # labelled by the AI):
+    user_pixels = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return f'<ClassCount user={self.user_id}, image_id={self.image_id}, class={self.class_id}>'
+
+class Agreement(JsonSerializable, db.Model):
+    """Number of pixels on which two users agree in their masks of an image
+
+    Updated whenever the masks of an image are merged. user_a is always the
+    smaller user id.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('image_id', 'user_a', 'user_b'),
+        db.Index('ix_agreement_users', 'user_a', 'user_b'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.String(256), index=True)
+    user_a = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_b = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # Pixels with the same class in both masks:
+    agreeing_pixels = db.Column(db.Integer, default=0)
+    pixels = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return f'<Agreement users={self.user_a},{self.user_b}, image_id={self.image_id}>'
+
+class Conflict(JsonSerializable, db.Model):
+    """How much the annotators of an image disagree
+
+    Updated whenever the masks of an image are merged. The review queue is
+    ordered by descending score and then by image id, so both are indexed
+    together in this order and the queue can be read without scanning or
+    sorting all images.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.String(256), index=True, unique=True)
+    # Share of pixels (0-1) whose winning class got less than
+    # `segmentation : disagreement_threshold` of the votes:
+    score = db.Column(db.Float, default=0)
+    disagreeing_pixels = db.Column(db.Integer, default=0)
+    n_users = db.Column(db.Integer, default=0)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Same order as the review queue:
+    __table_args__ = (db.Index('ix_conflict_score_desc_image', score.desc(), image_id),)
+
+    def __repr__(self):
+        return f'<Conflict image_id={self.image_id}, score={self.score}>'
+
+
+def create_tables():
+    """Create missing tables and indexes (needs an app context)
+
+    `db.create_all` skips tables which exist already, so indexes added to an
+    existing table by an update are created here as well.
+    """
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
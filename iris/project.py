@@ -74,7 +74,7 @@ class Project:
             encodings = {
                 'npy': ['integer', 'binary', 'rgb', 'rgba'],
                 'tif': ['integer', 'rgb', 'rgba'],
-                'png': ['integer', 'rgb', 'rgba'],
+                'png': ['integer', 'palette', 'rgb', 'rgba'],
                 'jpg': ['rgb'],
                 'jpeg': ['rgb'],
             }
@@ -1,25 +1,32 @@
 from datetime import datetime, timedelta
-from glob import glob
-import json
+import io
 import os
-from os.path import basename, dirname, exists, join
+from os.path import dirname, exists, join
 import time
 from pprint import pprint
 
-import lightgbm as lgb
 import flask
 import numpy as np
-from scipy.ndimage import convolve, minimum_filter, maximum_filter
+from PIL import Image as PILImage
 from skimage.io import imread, imsave
-from skimage.filters import sobel
-from skimage.segmentation import felzenszwalb
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, f1_score, jaccard_score
 import yaml
 
 from iris.user import requires_auth
-from iris.models import db, User, Action
+from iris.models import db, User, Action, Agreement, ClassCount, Conflict
 from iris.project import project
+from iris.segmentation.ai import (
+    REGION_HEADER, image_dict_to_array, predict, read_prediction_request
+)
+from iris.segmentation.codec import (
+    MASK_FULL, MASK_PATCH, MASK_VERSION_HEADER, apply_patches, decode_masks,
+    encode_masks, is_mask_message
+)
+from iris.segmentation.journal import mask_journal
+from iris.segmentation.merge_queue import merge_queue
+from iris.segmentation.prelabel import prelabeller
+from iris.segmentation.project_model import project_model
+from iris.segmentation.scheduler import call_cooperatively
+from iris.segmentation.storage import get_mask_store, pack_user_mask, unpack_user_mask
 
 segmentation_app = flask.Blueprint(
     'segmentation', __name__,
@@ -58,6 +65,7 @@ def register_segmentation_blueprints(app):
 def next_image():
     user = User.query.get(flask.session['user_id'])
     project.set_image_seed(user.image_seed)
+    prelabeller.wake(flask.current_app._get_current_object())
 
     image_id = project.get_next_image(
         flask.request.args.get('image_id', project.get_start_image_id()),
@@ -83,7 +91,7 @@ def previous_image():
     )
 
 def get_mask_filenames(image_id, user_id=None):
-    """Get final and user mask filenames"""
+    """Get final and user mask filenames (format before the compact masks)"""
     final_mask = join(
         project['path'], 'segmentation', image_id,
         f'{user_id}_final.npy'
@@ -96,85 +104,440 @@ def get_mask_filenames(image_id, user_id=None):
 
     return final_mask, user_mask
 
+def get_mask_users(image_id):
+    """Get the ids of all users who saved a mask for this image"""
+    return get_mask_store().users(image_id)
+
 def read_masks(image_id, user_id):
     """Read the final and user mask"""
-    final_mask_file, user_mask_file = get_mask_filenames(image_id, user_id)
+    return get_mask_store().read(image_id, user_id)
+
+def read_legacy_masks(data, mask_shape):
+    """Read the masks from the original save_mask format
+
+    The octet stream (uint8) contains:
+        0 to 1: magic start byte 254
+        1 to mask_length: mask
+        mask_length to 2*mask_length: user mask
+        2*mask_length + 1: magic end byte 254
+
+    Args:
+        data: The request body (bytes).
+        mask_shape: (height, width) of the mask area.
+
+    Returns:
+        The final mask (class ids) and the user mask (true if the user
+        classified the pixel, false if the AI did).
+
+    Raises:
+        ValueError if the data is malformed.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    mask_length = mask_shape[0] * mask_shape[1]
+    if len(data) != 2*mask_length + 2:
+        raise ValueError(
+            f'Mask does not have correct format! Expected length: '
+            f'{2*mask_length + 2}, received length: {len(data)}'
+        )
+    elif data[0] != 254 and data[-1] != 254:
+        raise ValueError('Transferred data is not correct!')
 
-    final_mask = np.load(final_mask_file)
-    final_mask = np.argmax(final_mask, axis=-1)
-    user_mask = np.load(user_mask_file)
+    final_mask = data[1:mask_length+1].reshape(mask_shape)
+    user_mask = data[1+mask_length:-1].astype(bool).reshape(mask_shape)
     return final_mask, user_mask
 
-def merge_masks(image_id):
-    """Combine the masks of all users to a resulting mask"""
-    final_mask_paths = get_mask_filenames(image_id, user_id="*")[0]
-    users, final_masks = zip(*[
-        [basename(path).split('_')[0], np.argmax(np.load(path), axis=-1)]
-        for path in glob(final_mask_paths)
-    ])
-    final_masks = np.dstack(final_masks)
-
-    # Time to merge the masks, i.e. we are going to count which class is the
-    # most often:
-
-    # Unfortunately, there is no fast standard solution for mode in numpy or
-    # scipy (scipy.stats.mode is not optimised for our case):
-    classes = dict(enumerate(np.unique(final_masks)))
-    class_votes = np.zeros((*final_masks.shape[:-1], len(classes)))
-    for u in range(len(users)):
-        for i, klass in classes.items():
-            # We collect the votes for each class for each pixel.
-            # Instead of increasing by 1, we could also use the user's rank or
-            # etc. to weight their mask
-            class_votes[final_masks[..., u] == klass, i] += 1
-
-    # Create the final mask out of the elements occuring the most often:
-    winner_indices = np.argmax(class_votes, axis=-1)
-
-    # Retranslate to original classes (we initialised class_votes not with the
-    # original class indices):
-    merged_mask = np.vectorize(classes.__getitem__, otypes=[np.uint8])(winner_indices)
-
-    # Update the database for all users
-    for u, user_id in enumerate(users):
-        user = User.query.get(user_id)
-        if user is None:
+VOTES_NAME = 'votes.npz'
+DISAGREEMENT_NAME = 'disagreement.npz'
+
+def read_npz(image_id, name):
+    """Read arrays saved with `write_npz` from the mask store (or None)"""
+    data = get_mask_store().read_data(image_id, name)
+    if data is None:
+        return None
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        return dict(arrays)
+
+def write_npz(image_id, name, compress=False, **arrays):
+    """Save arrays as npz data of an image in the mask store"""
+    stream = io.BytesIO()
+    (np.savez_compressed if compress else np.savez)(stream, **arrays)
+    get_mask_store().write_data(image_id, name, stream.getvalue())
+
+def get_disagreement(votes, threshold=None):
+    """Find the pixels on which the annotators disagree
+
+    Args:
+        votes: Votes of an image (H x W x n_classes).
+        threshold: Minimal share of the votes the winning class needs (default:
+            `segmentation : disagreement_threshold`).
+
+    Returns:
+        Boolean array (H x W), true where the winning class got less than the
+        threshold of the votes.
+    """
+    if threshold is None:
+        threshold = project['segmentation']['disagreement_threshold']
+    n_votes = votes.sum(axis=-1, dtype=np.uint32)
+    return votes.max(axis=-1) < threshold * n_votes
+
+def write_disagreement(image_id, disagreement):
+    write_npz(
+        image_id, DISAGREEMENT_NAME, compress=True,
+        disagreement=pack_user_mask(disagreement), shape=np.array(disagreement.shape),
+    )
+
+def read_disagreement(image_id):
+    """Read the disagreement raster of an image (or None)"""
+    data = read_npz(image_id, DISAGREEMENT_NAME)
+    if data is None:
+        return None
+    return unpack_user_mask(data['disagreement'], tuple(data['shape']))
+
+def add_votes(votes, mask):
+    """Add one vote per pixel for the class in mask (in-place)"""
+    votes.reshape(-1, votes.shape[-1])[np.arange(mask.size), mask.ravel()] += 1
+
+def remove_votes(votes, mask):
+    """Remove the votes of a mask (in-place)"""
+    votes.reshape(-1, votes.shape[-1])[np.arange(mask.size), mask.ravel()] -= 1
+
+def count_votes(image_id, new_masks=None):
+    """Count the votes of all saved masks of an image
+
+    Args:
+        image_id: Id of the image.
+        new_masks: Optional dictionary with final masks by user id which are
+            counted instead of the saved ones (e.g. before they are saved).
+
+    Returns:
+        Tuple with the votes (H x W x n_classes, uint16) and the ids of the
+        users whose masks were counted.
+    """
+    new_masks = new_masks or {}
+    votes = None
+    users = sorted(set(get_mask_users(image_id)) | set(new_masks))
+    for user_id in users:
+        if user_id in new_masks:
+            final_mask = new_masks[user_id]
+        else:
+            final_mask, _ = read_masks(image_id, user_id)
+        if votes is None:
+            votes = np.zeros(
+                (*final_mask.shape, len(project['classes'])), dtype=np.uint16
+            )
+        add_votes(votes, final_mask)
+    return votes, users
+
+def read_votes(image_id):
+    """Read the persisted votes of an image (or None, [])"""
+    data = read_npz(image_id, VOTES_NAME)
+    if data is None:
+        return None, []
+    return data['votes'], data['users'].tolist()
+
+def write_votes(image_id, votes, users):
+    write_npz(image_id, VOTES_NAME, votes=votes, users=np.array(users, dtype=str))
+
+def get_updated_votes(image_id, user_id=None, old_mask=None, new_mask=None):
+    """Get the votes of an image after a user saved a mask
+
+    After a user saved a mask, only their old mask is removed and the new one
+    added. The votes are counted from scratch if they have not been persisted
+    yet, if the old mask is unknown, if classes were added to the project or
+    if they do not match the saved masks anymore.
+
+    Args:
+        image_id: Id of the image.
+        user_id: Id of the user who saved a mask (None if the persisted votes
+            should only be checked).
+        old_mask: Previous final mask of the user (class ids) or None if the
+            user had no mask before.
+        new_mask: New final mask of the user if it is not in the mask store
+            yet (default: read from the store).
+
+    Returns:
+        Tuple with the votes (H x W x n_classes), the ids of the users whose
+        masks were counted and whether they differ from the persisted votes.
+    """
+    votes, users = read_votes(image_id)
+    user_id = None if user_id is None else str(user_id)
+    new_masks = {} if new_mask is None else {user_id: new_mask}
+    changed = user_id is not None
+    if votes is None or votes.shape[-1] < len(project['classes']) \
+            or (user_id in users and old_mask is None):
+        votes = None
+    elif user_id is not None:
+        if user_id in users:
+            remove_votes(votes, old_mask)
+        else:
+            users.append(user_id)
+        add_votes(votes, new_mask if new_mask is not None else read_masks(image_id, user_id)[0])
+
+    if votes is None or sorted(users) != sorted(set(get_mask_users(image_id)) | set(new_masks)):
+        votes, users = count_votes(image_id, new_masks)
+        changed = True
+    return votes, users, changed
+
+def update_votes(image_id, user_id=None, old_mask=None):
+    """Update the persisted votes of an image (see `get_updated_votes`)
+
+    Returns:
+        The votes (H x W x n_classes).
+    """
+    votes, users, changed = get_updated_votes(image_id, user_id, old_mask)
+    if changed:
+        write_votes(image_id, votes, users)
+    return votes
+
+def merge_masks(image_id, user_id=None, old_mask=None):
+    """Combine the masks of all users to a resulting mask
+
+    Args:
+        image_id: Id of the image.
+        user_id: Id of the user who just saved a mask (optional).
+        old_mask: Previous final mask of this user (optional).
+    """
+    update_scores({image_id: merge_image(image_id, user_id, old_mask)})
+
+def merge_image(image_id, user_id=None, old_mask=None):
+    """Merge the masks of an image and save the merged mask
+
+    Does not access the database, so it can run in other processes as well
+    (see `update_scores`).
+
+    Args:
+        image_id: Id of the image.
+        user_id: Id of the user who just saved a mask (optional).
+        old_mask: Previous final mask of this user (optional).
+
+    Returns:
+        Dictionary with the `scores` of all users (by user id) and whether the
+        image is `unverified`.
+    """
+    # Only reading the votes and masks has to wait for saves of the image:
+    with merge_queue.lock(image_id):
+        votes = update_votes(image_id, user_id, old_mask)
+        users = get_mask_users(image_id)
+        masks = [read_masks(image_id, user) for user in users]
+
+    # Each pixel gets the class with the most votes. Since the last axis of the
+    # votes is indexed by class id, the winner index already is the class id
+    # (ties go to the lower class id):
+    merged_mask = np.argmax(votes, axis=-1).astype(np.uint8)
+
+    final_masks = [final_mask for final_mask, _ in masks]
+    n_classes = max(len(project['classes']), int(votes.shape[-1]))
+    scores = score_users(users, final_masks, merged_mask, n_classes)
+    class_counts = {
+        user_id: count_classes(final_mask, user_mask, n_classes)
+        for user_id, (final_mask, user_mask) in zip(users, masks)
+    }
+    # Pixels on which the annotators disagree (always none for a single user):
+    disagreement = get_disagreement(votes)
+    write_disagreement(image_id, disagreement)
+
+    # Agreement of each pair of annotators of this image:
+    agreement = {}
+    for a in range(len(users)):
+        for b in range(a + 1, len(users)):
+            agreeing_pixels = np.count_nonzero(final_masks[a] == final_masks[b])
+            agreement[users[a], users[b]] = (int(agreeing_pixels), final_masks[a].size)
+
+    encoding = project['segmentation']['mask_encoding']
+    merged_mask = encode_mask(merged_mask, mode=encoding)
+    filename = project['segmentation']['path'].format(id=image_id)
+    os.makedirs(dirname(filename), exist_ok=True)
+    save_encoded_mask(filename, merged_mask, encoding)
+
+    return {
+        'scores': scores,
+        'unverified': len(users) <= project['segmentation']['unverified_threshold'],
+        'class_counts': class_counts,
+        'agreement': agreement,
+        'conflict': {
+            'score': float(disagreement.mean()),
+            'disagreeing_pixels': int(np.count_nonzero(disagreement)),
+            'n_users': len(users),
+        },
+    }
+
+def count_classes(final_mask, user_mask, n_classes):
+    """Count the pixels of each class in a mask
+
+    Returns:
+        Two lists with the number of all pixels and of the pixels labelled by
+        the user for each class id.
+    """
+    final_mask = np.asarray(final_mask).ravel()
+    pixels = np.bincount(final_mask, minlength=n_classes)
+    user_pixels = np.bincount(
+        final_mask[np.asarray(user_mask, dtype=bool).ravel()], minlength=n_classes
+    )
+    return pixels.tolist(), user_pixels.tolist()
+
+def update_scores(results):
+    """Update the scores, class counts, agreement and conflicts of merged images
+
+    All changes are committed in one transaction.
+
+    Args:
+        results: Dictionary with the result of `merge_image` for each image id.
+    """
+    user_ids = {
+        int(user_id) for result in results.values()
+        for user_id in result['scores'] if user_id.isdigit()
+    }
+    known_users = {
+        user.id: user for user in User.query.filter(User.id.in_(user_ids))
+    }
+    actions = {
+        (action.image_id, action.user_id): action
+        for action in Action.query.filter(
+            Action.image_id.in_(list(results)), Action.type == "segmentation",
+            Action.user_id.in_(known_users)
+        )
+    }
+    for image_id, result in results.items():
+        for user_id, score in result['scores'].items():
+            user = known_users.get(int(user_id)) if user_id.isdigit() else None
+            if user is None:
+                continue
+            action = actions.get((image_id, user.id))
+            if action is None:
+                action = Action(user=user, image_id=image_id, type="segmentation")
+                db.session.add(action)
+            action.score = score
+            action.unverified = result['unverified']
+
+    # The merge counted the masks of all users, so the rows of these images
+    # are replaced:
+    ClassCount.query.filter(ClassCount.image_id.in_(list(results)))\
+        .delete(synchronize_session=False)
+    db.session.add_all(
+        ClassCount(
+            image_id=image_id, user_id=int(user_id), class_id=class_id,
+            pixels=n_pixels, user_pixels=n_user_pixels,
+        )
+        for image_id, result in results.items()
+        for user_id, (pixels, user_pixels) in result.get('class_counts', {}).items()
+        if user_id.isdigit() and int(user_id) in known_users
+        for class_id, (n_pixels, n_user_pixels) in enumerate(zip(pixels, user_pixels))
+        if n_pixels
+    )
+    Agreement.query.filter(Agreement.image_id.in_(list(results)))\
+        .delete(synchronize_session=False)
+    for image_id, result in results.items():
+        for pair, (agreeing_pixels, pixels) in result.get('agreement', {}).items():
+            if not all(user_id.isdigit() and int(user_id) in known_users for user_id in pair):
+                continue
+            user_a, user_b = sorted(map(int, pair))
+            db.session.add(Agreement(
+                image_id=image_id, user_a=user_a, user_b=user_b,
+                agreeing_pixels=agreeing_pixels, pixels=pixels,
+            ))
+
+    conflicts = {
+        conflict.image_id: conflict
+        for conflict in Conflict.query.filter(Conflict.image_id.in_(list(results)))
+    }
+    for image_id, result in results.items():
+        if 'conflict' not in result:
             continue
+        conflict = conflicts.get(image_id)
+        if conflict is None:
+            conflict = Conflict(image_id=image_id)
+            db.session.add(conflict)
+        conflict.score = result['conflict']['score']
+        conflict.disagreeing_pixels = result['conflict']['disagreeing_pixels']
+        conflict.n_users = result['conflict']['n_users']
+        conflict.updated = datetime.utcnow()
+
+    db.session.commit()
 
-        action = Action.query.filter_by(
-                user=user, image_id=image_id, type="segmentation"
-            ).first()
-        if not action:
-            action = Action(user=user, image_id=image_id, type="segmentation")
+def score_users(users, final_masks, merged_mask, n_classes):
+    """Score how much each user agrees with the others
 
+    Returns:
+        Dictionary with the score of each user id.
+    """
+    scores = {}
+    for u, user_id in enumerate(users):
         if len(users) == 2:
             # Just check how much the user agrees with the other one:
-            other_user = 0 if u else 1
-            action.score = get_score(final_masks[..., other_user].ravel(), final_masks[..., u].ravel())
+            reference = final_masks[1 - u]
         else:
-            action.score = get_score(merged_mask.ravel(), final_masks[..., u].ravel())
+            reference = merged_mask
+        scores[user_id] = score_confusion_matrix(
+            get_confusion_matrix(reference, final_masks[u], n_classes)
+        )
+    return scores
 
-        action.unverified = len(users) <= project['segmentation']['unverified_threshold']
+def get_confusion_matrix(reference, mask, n_classes):
+    """Count the pixels for each pair of classes with a single bincount
 
-    db.session.commit()
+    Returns:
+        n_classes x n_classes array; rows are the classes in reference,
+        columns the classes in mask.
+    """
+    pairs = n_classes * reference.ravel().astype(np.intp) + mask.ravel()
+    return np.bincount(pairs, minlength=n_classes**2).reshape(n_classes, n_classes)
 
-    merged_mask = encode_mask(
-        merged_mask, mode=project['segmentation']['mask_encoding']
-    )
-    filename = project['segmentation']['path'].format(id=image_id)
-    os.makedirs(dirname(filename), exist_ok=True)
-    if filename.endswith('npy'):
-        np.save(filename, merged_mask, allow_pickle=False)
+def score_confusion_matrix(matrix, score=None):
+    """Calculate the score (0-100) from a confusion matrix
+
+    Same definitions as scikit-learn's metrics: `jaccard` is the binary score
+    of class 1 if there are only the classes 0 and 1 (otherwise the mean over
+    all occurring classes), `f1` the mean over all occurring classes and
+    `accuracy` the share of agreeing pixels.
+    """
+    score = score or project['segmentation']['score']
+    true_positives = np.diag(matrix).astype(float)
+    false_positives = matrix.sum(axis=0) - true_positives
+    false_negatives = matrix.sum(axis=1) - true_positives
+    occurring = (matrix.sum(axis=0) + matrix.sum(axis=1)) > 0
+
+    if score == 'accuracy':
+        return round(100 * true_positives.sum() / max(matrix.sum(), 1))
+
+    if score == 'jaccard':
+        denominator = true_positives + false_positives + false_negatives
+    elif score == 'f1':
+        true_positives = 2 * true_positives
+        denominator = true_positives + false_positives + false_negatives
     else:
-        imsave(filename, merged_mask, check_contrast=False)
+        return None
+
+    per_class = np.divide(
+        true_positives, denominator,
+        out=np.zeros_like(true_positives), where=denominator > 0
+    )
+    if score == 'jaccard' and not occurring[2:].any():
+        return round(100 * per_class[1]) if len(per_class) > 1 else 0
+    return round(100 * per_class[occurring].mean()) if occurring.any() else 0
 
 def get_score(mask1, mask2):
-    if project['segmentation']['score'] == 'jaccard':
-        return round(100 * jaccard_score(mask1, mask2))
-    elif project['segmentation']['score'] == 'f1':
-        return round(100 * f1_score(mask1, mask2, average='macro'))
-    elif project['segmentation']['score'] == 'accuracy':
-        return round(100 * accuracy_score(mask1, mask2))
+    mask1, mask2 = np.asarray(mask1), np.asarray(mask2)
+    n_classes = int(max(mask1.max(initial=0), mask2.max(initial=0))) + 1
+    return score_confusion_matrix(get_confusion_matrix(mask1, mask2, n_classes))
+
+def get_colour_table(mode):
+    """Lookup table from class ids to their encoding
+
+    Returns:
+        Array with one row per class: a boolean one-hot vector for `binary`,
+        the uint8 RGB or RGBA colour for `rgb` and `rgba`.
+    """
+    if mode == 'binary':
+        return np.eye(len(project['classes']), dtype=bool)
+
+    colours = np.array(
+        [klass['colour'] for klass in project['classes']], dtype=np.uint8
+    )
+    if mode == 'rgb':
+        return colours[:, :3]
+    elif mode == 'rgba':
+        return colours
+    raise ValueError("Unknown encoding mode:", mode)
 
 def encode_mask(mask, mode='binary'):
     """Encode the mask to save it on disk
@@ -184,6 +547,8 @@ def encode_mask(mask, mode='binary'):
         mode: Defines how to encode the mask.
             * integer: Each class will be represented by an integer (does not
                 change the mask).
+            * palette: Like integer, but `save_encoded_mask` writes it as
+                indexed PNG with the class colours as palette.
             * binary: Each class gets its own boolean layer.
             * rgb: Each class will be saved with its original RGB colour.
             * rgba: Each class will be saved with its original RGBA colour.
@@ -191,30 +556,23 @@ def encode_mask(mask, mode='binary'):
     Returns:
         Encoded numpy array.
     """
-    if mode == 'integer':
+    if mode in ('integer', 'palette'):
         return mask.astype(np.uint8)
-    elif mode == 'binary':
-        n_last_dimension = len(project['classes'])
-    elif mode == 'rgb':
-        n_last_dimension = 3
-    elif mode == 'rgba':
-        n_last_dimension = 4
-    else:
-        raise ValueError("Unknown encoding mode:", mode)
 
-    encoded_mask = np.empty((*mask.shape, n_last_dimension))
-    for c, klass in enumerate(project['classes']):
-        if mode == 'binary':
-            encoded_mask[..., c] = mask == c
-        elif mode == 'rgb':
-            encoded_mask[mask == c] = klass['colour'][:3]
-        elif mode == 'rgba':
-            encoded_mask[mask == c] = klass['colour']
+    # One lookup per pixel instead of one pass per class:
+    return get_colour_table(mode)[mask]
 
-    if mode == 'binary':
-        return encoded_mask.astype(bool)
-
-    return encoded_mask.astype(np.uint8)
+def save_encoded_mask(filename, mask, mode):
+    """Save a mask encoded by `encode_mask` in the format of the filename"""
+    if filename.endswith('npy'):
+        np.save(filename, mask, allow_pickle=False)
+    elif mode == 'palette':
+        colours = get_colour_table('rgba')
+        image = PILImage.fromarray(mask)
+        image.putpalette(colours[:, :3].ravel().tolist())
+        image.save(filename, transparency=colours[:, 3].tobytes())
+    else:
+        imsave(filename, mask, check_contrast=False)
 
 @segmentation_app.route('/load_mask/<image_id>')
 @requires_auth
@@ -222,67 +580,83 @@ def load_mask(image_id):
     user_id = flask.session.get('user_id')
 
     try:
-        final_mask, user_mask = read_masks(image_id, user_id)
-
-        data = np.concatenate([final_mask.ravel(), user_mask.ravel()])
-        data = np.pad(data, 1, constant_values=(254, 254))
+        store = get_mask_store()
+        version = 0
+        if store.exists(image_id, user_id):
+            final_mask, user_mask = read_masks(image_id, user_id)
+            version = store.version(image_id, user_id)
+        else:
+            # Offer the pre-labelled draft, no pixel was set by the user yet:
+            final_mask = prelabeller.read_draft(image_id)
+            if final_mask is None:
+                raise FileNotFoundError(image_id)
+            user_mask = np.zeros_like(final_mask, dtype=bool)
+
+        if flask.request.args.get('encoding') == 'rle':
+            # Versioned binary format with run-length encoded planes:
+            data = encode_masks(final_mask, user_mask)
+        else:
+            data = np.concatenate([final_mask.ravel(), user_mask.ravel()])
+            data = np.pad(data, 1, constant_values=(254, 254))
+            data = data.astype(np.uint8).tobytes()
 
-        response = flask.make_response(
-            data.astype(np.uint8).tobytes()
-        )
+        response = flask.make_response(data)
         response.headers.set('Content-Type', 'application/octet-stream')
+        # Patches uploaded to save_mask must be based on this version:
+        response.headers.set(MASK_VERSION_HEADER, str(version))
         return response
     except:
         return flask.make_response("No user mask available!", 404)
 
-@segmentation_app.route('/save_mask/<image_id>', methods=['POST'])
+@segmentation_app.route('/draft_mask/<image_id>')
 @requires_auth
-def save_mask(image_id):
-    user_id = flask.session.get('user_id')
-
-    print('SAVING BY', user_id)
-
-    t = time.time()
-    data = np.frombuffer(flask.request.data, dtype=np.uint8)
-    print(f'transfer time: {time.time()-t:.2f}s')
-
-    # We will get an octet stream (uint8) from the website. It contains:
-    # 0 to 1: magic start byte 254
-    # 1 to mask_length: mask
-    # mask_length to 2*mask_length: user mask
-    # 2*mask_length + 1: magic end byte 254
-    mask_length = \
-        project['segmentation']['mask_shape'][0] \
-        * project['segmentation']['mask_shape'][1]
-
-    if len(data) != 2*mask_length + 2:
-        print('Error: Octet-stream does not have the expected length!')
-        print(f'Expected length: {2*mask_length + 2}, received length: {len(data)}')
-        return flask.make_response("Mask does not have correct format!", 400)
-    elif data[0] != 254 and data[-1] != 254:
-        print('Error: Magic numbers are not correct!')
-        print(f'Start number: {data[0]}, end number: {data[-1]}')
-        return flask.make_response("Transferred data is not correct!", 400)
-
-    # We get the mask in the form HxW where each element is a class id
-    final_mask = data[1:mask_length+1]
-    final_mask = final_mask.reshape(project['segmentation']['mask_shape'][::-1])
+def draft_mask(image_id):
+    """Get the prediction of the project model as initial mask"""
+    if image_id not in project.image_ids:
+        return flask.make_response('Unknown image id!', 404)
+
+    # The pre-labelling worker might have predicted the image already:
+    predictions = prelabeller.read_draft(image_id, current=True)
+    if predictions is None:
+        predictions = call_cooperatively(project_model.predict, image_id)
+    if predictions is None:
+        return flask.make_response("No project model available!", 404)
+
+    response = flask.make_response(predictions.tobytes())
+    response.headers.set('Content-Type', 'application/octet-stream')
+    return response
 
-    # The user mask denotes who classified the pixels in the mask:
-    #   if true: the user classified the pixel
-    #   if false: the AI classified the pixel
-    user_mask = data[1+mask_length:-1].astype(bool)
-    user_mask = user_mask.reshape(project['segmentation']['mask_shape'][::-1])
+def write_masks(image_id, user_id, final_mask, user_mask, old_version, old_masks):
+    """Store new masks of a user (call it under `merge_queue.lock(image_id)`)
 
-    final_mask_file, user_mask_file = get_mask_filenames(image_id, user_id)
-    os.makedirs(dirname(final_mask_file), exist_ok=True)
+    Writes the masks to the mask store, appends the changes to the journal and
+    updates the vote counts.
 
-    final_mask = encode_mask(final_mask, mode='binary')
+    Args:
+        image_id: Id of the image.
+        user_id: Id of the user.
+        final_mask: 2D array with the class id of each pixel.
+        user_mask: 2D boolean array, true for pixels labelled by the user.
+        old_version: Version of the previous masks (0 if there are none).
+        old_masks: Tuple with the previous final and user mask or None.
 
-    np.save(final_mask_file, final_mask, allow_pickle=False)
-    np.save(user_mask_file, user_mask.astype(bool), allow_pickle=False)
+    Returns:
+        The version of the new masks.
+    """
+    # The votes are updated before anything is written, so that an error
+    # cannot leave a new mask behind outdated votes:
+    votes, users, _ = get_updated_votes(
+        image_id, user_id, None if old_masks is None else old_masks[0], final_mask
+    )
+    version = get_mask_store().write(image_id, user_id, final_mask, user_mask)
+    write_votes(image_id, votes, users)
+    mask_journal.append(
+        image_id, user_id, version, old_version, old_masks, (final_mask, user_mask)
+    )
+    return version
 
-    # Update the database:
+def on_masks_saved(image_id, user_id):
+    """Record the save of a user and update everything that depends on it"""
     user = User.query.get(user_id)
     action = Action.query\
         .filter_by(user=user, image_id=image_id, type="segmentation")\
@@ -293,120 +667,106 @@ def save_mask(image_id):
     db.session.add(action)
     db.session.commit()
 
-    merge_masks(image_id)
+    # The merged mask and the scores are updated in the background:
+    merge_queue.schedule(flask.current_app._get_current_object(), image_id)
+    project_model.schedule(image_id)
+    prelabeller.discard(image_id)
 
-    # We need this to send a successful response to the client
-    return flask.make_response('Masks successfully saved!')
+@segmentation_app.route('/save_mask/<image_id>', methods=['POST'])
+@requires_auth
+def save_mask(image_id):
+    user_id = flask.session.get('user_id')
 
-def image_dict_to_array(image_dict):
-    if isinstance(image_dict, np.ndarray):
-        return image_dict
+    print('SAVING BY', user_id)
 
-    return np.dstack(
-        [image_dict_to_array(v) for v in image_dict.values()]
-    )
+    t = time.time()
+    data = flask.request.data
+    print(f'transfer time: {time.time()-t:.2f}s')
+
+    mask_shape = tuple(project['segmentation']['mask_shape'][::-1])
+    if is_mask_message(data):
+        # Versioned format: either the full masks or only the rectangles which
+        # changed since the version the client got from the server
+        try:
+            kind, base_version, patches = decode_masks(data, mask_shape)
+        except ValueError as error:
+            return flask.make_response(str(error), 400)
+    else:
+        kind, base_version = MASK_FULL, None
+        try:
+            patches = [(0, 0, *read_legacy_masks(data, mask_shape))]
+        except ValueError as error:
+            print('Error:', error)
+            return flask.make_response(str(error), 400)
+
+    # Unknown class ids would break the vote counts of the image:
+    n_classes = len(project['classes'])
+    for _, _, final_patch, _ in patches:
+        if final_patch.size and int(final_patch.max()) >= n_classes:
+            return flask.make_response(
+                f'Mask contains class ids >= the number of classes ({n_classes})!', 400
+            )
+
+    store = get_mask_store()
+    with merge_queue.lock(image_id):
+        version = store.version(image_id, user_id)
+        # Needed to update the vote counts of the merged mask:
+        old_mask = old_user_mask = None
+        if store.exists(image_id, user_id):
+            old_mask, old_user_mask = read_masks(image_id, user_id)
+
+        if kind == MASK_PATCH:
+            if base_version != version or old_mask is None:
+                response = flask.make_response(
+                    f'Mask has changed on the server (version {version})!', 409
+                )
+                response.headers.set(MASK_VERSION_HEADER, str(version))
+                return response
+            final_mask, user_mask = apply_patches(old_mask, old_user_mask, patches)
+        else:
+            _, _, final_mask, user_mask = patches[0]
+
+        version = write_masks(
+            image_id, user_id, final_mask, user_mask,
+            old_version=version, old_masks=(
+                None if old_mask is None else (old_mask, old_user_mask)
+            )
+        )
+
+    on_masks_saved(image_id, user_id)
+
+    # We need this to send a successful response to the client
+    response = flask.make_response('Masks successfully saved!')
+    response.headers.set(MASK_VERSION_HEADER, str(version))
+    return response
 
 @segmentation_app.route('/predict_mask/<image_id>', methods=['POST'])
 @requires_auth
 def predict_mask(image_id):
-    config = project.get_user_config(flask.session['user_id'])
+    user_id = flask.session['user_id']
+    config = project.get_user_config(user_id)
     config = config['segmentation']
 
     print('Fit options:', config)
 
-    # How to exclude certain bands?
-    image_dict = project.get_image(image_id, bands=config['ai_model']['bands'])
-    image = image_dict_to_array(image_dict)
-
-    n_channels = image.shape[-1]
-
-    # Select only the masking area:
-    mask_area = (
-        slice(config['mask_area'][1], config['mask_area'][3]),
-        slice(config['mask_area'][0], config['mask_area'][2]),
-        slice(None, None, None)
-    )
-    mask_size = config['mask_shape'][0] * config['mask_shape'][1]
-    image = image[mask_area]
-
-    data = json.loads(flask.request.data)
-    user_indices = np.array(data['user_pixels'])
-    user_labels = np.array(data['user_labels'])
-
-    inputs = [image]
-    if config['ai_model']['use_edge_filter']:
-        edges = np.dstack([
-            sobel(image[..., i])
-            for i in range(n_channels)
-        ])
-        inputs.append(edges)
-
-    if config['ai_model']['use_meshgrid']:
-        if config['ai_model']['meshgrid_cells'] == "pixelwise":
-            x_size, y_size = image.shape[0], image.shape[1]
-        else:
-            x_size, y_size = map(int, config['ai_model']['meshgrid_cells'].split('x'))
-        y_size = 3
-        x = np.repeat(np.arange(x_size), int(image.shape[0]/x_size)+1)
-        y = np.repeat(np.arange(y_size), int(image.shape[1]/y_size)+1)
-        x_grid, y_grid = np.meshgrid(x[:image.shape[0]], y[:image.shape[1]])
-        inputs.append(x_grid[..., np.newaxis])
-        inputs.append(y_grid[..., np.newaxis])
-
-    if config['ai_model']['use_superpixels']:
-        super_pixels = felzenszwalb(
-            image, scale=image.shape[0]/5, sigma=4, min_size=100
+    try:
+        user_indices, user_labels, region = read_prediction_request(
+            flask.request.get_data(), flask.request.mimetype, config
         )
-        inputs.append(super_pixels)
-
-    inputs = np.dstack(inputs).reshape(mask_size, -1)
-
-    train_indices, val_indices, train_labels, val_labels = train_test_split(
-        user_indices, user_labels, stratify=user_labels,
-        test_size=0.3, random_state=42
-    )
-
-    gbm = lgb.LGBMClassifier(
-        num_leaves=config['ai_model']['n_leaves'],
-        max_bin=128,
-        max_depth=config['ai_model']['max_depth'],
-        # min_data_in_leaf=1000,
-        # bagging_fraction=0.2,
-        # boosting_type='dart',
-        tree_learner='data',
-        learning_rate=0.05,
-        n_estimators=config['ai_model']['n_estimators'],
-        n_jobs=10,
-    )
-    early_stopping = lgb.early_stopping(4, verbose=False)
-    gbm.fit(
-        inputs[train_indices, :], train_labels,
-        eval_set=[(inputs[val_indices, :], val_labels)],
-        callbacks=[early_stopping]
-    )
+        predictions = predict(
+            image_id, user_id, config, user_indices, user_labels, region,
+            output=flask.request.args.get('output', 'classes'),
+        )
+    except ValueError as error:
+        return flask.make_response(str(error), 400)
 
-    # predict the mask for the whole image:
-    predictions = gbm.predict(
-        inputs, num_iteration=gbm.best_iteration_
-    )
-    predictions = predictions.astype(np.uint8)
-
-    # Apply suppression filter:
-    if config['ai_model']['suppression_threshold'] != 0:
-        other_classes = (predictions != config['ai_model']['suppression_default_class']).astype(int)
-        other_classes = other_classes.reshape(*config['mask_shape'])
-        window_size = config['ai_model']['suppression_filter_size']
-        window = np.ones((window_size, window_size))
-        window[window_size//2, window_size//2] = 0
-        neighbourhood_ratio = convolve(
-            other_classes, window, mode='constant', cval=0.5
-        ) / (window_size**2 - 1)
-        suppress = 100 * neighbourhood_ratio.ravel() < config['ai_model']['suppression_threshold']
-        predictions[suppress] = config['ai_model']['suppression_default_class']
-
-    # Return the results:
+    # Return the results (class ids or, with ?output=probabilities, one uint8
+    # plane of probabilities per class):
     response = flask.make_response(
         predictions.tobytes()
     )
     response.headers.set('Content-Type', 'application/octet-stream')
+    if not region.is_full(config['mask_shape']):
+        # Only the bounding box of the region was predicted:
+        response.headers.set(REGION_HEADER, ",".join(map(str, region.bbox)))
     return response
@@ -0,0 +1,655 @@
+"""
+AI model helpers for the segmentation mode.
+
+Holds the feature extraction, the post-processing (suppression filter) and a
+cache of trained models so that requests which only differ in their
+post-processing options do not have to retrain the model.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+from scipy.ndimage import convolve
+from skimage.draw import polygon2mask
+from skimage.filters import sobel
+from skimage.segmentation import felzenszwalb
+
+from iris.project import project
+from iris.segmentation.backends import get_backend
+from iris.segmentation.codec import decode_training_pixels
+from iris.segmentation.scheduler import scheduler
+
+# Response header with the bounding box of a region prediction:
+REGION_HEADER = 'X-IRIS-Region'
+
+# Possible outputs of a prediction: hard class ids (after post-processing) or
+# the class probabilities (quantised to uint8, one plane per project class):
+PREDICTION_OUTPUTS = ('classes', 'probabilities')
+
+# These options are only used after the model has predicted the class
+# probabilities. Changing them must not invalidate a cached model:
+POSTPROCESSING_OPTIONS = (
+    'suppression_threshold', 'suppression_filter_size', 'suppression_default_class'
+)
+
+
+def image_dict_to_array(image_dict):
+    if isinstance(image_dict, np.ndarray):
+        return image_dict
+
+    return np.dstack(
+        [image_dict_to_array(v) for v in image_dict.values()]
+    )
+
+
+class PixelFeatures:
+    """The per-pixel features of the mask area
+
+    Instead of building one dense (H*W)xN_features matrix, the features are
+    kept in blocks (image bands, edges, ...) and the feature rows are only
+    assembled for the pixels which are requested, e.g. the training pixels or
+    a chunk of pixels for inference.
+
+    Args:
+        image: Image array with shape HxWxC (already cropped to the mask area).
+        ai_config: The `ai_model` section of the user config.
+    """
+    def __init__(self, image, ai_config):
+        height, width, n_channels = image.shape
+        self.shape = (height, width)
+        self.n_pixels = height * width
+
+        self.blocks = [np.ascontiguousarray(image).reshape(self.n_pixels, n_channels)]
+        if ai_config['use_edge_filter']:
+            edges = np.empty((self.n_pixels, n_channels), dtype=np.float32)
+            for i in range(n_channels):
+                edges[:, i] = sobel(image[..., i]).ravel()
+            self.blocks.append(edges)
+
+        if ai_config['use_superpixels']:
+            super_pixels = felzenszwalb(
+                image, scale=image.shape[0]/5, sigma=4, min_size=100
+            )
+            self.blocks.append(super_pixels.reshape(self.n_pixels, 1))
+
+        # The meshgrid features are calculated on the fly from the pixel
+        # positions:
+        self.grid = None
+        if ai_config['use_meshgrid']:
+            if ai_config['meshgrid_cells'] == "pixelwise":
+                x_size, y_size = width, height
+            else:
+                x_size, y_size = map(int, ai_config['meshgrid_cells'].split('x'))
+            y_size = 3
+            x = np.repeat(np.arange(x_size), int(width/x_size)+1)[:width]
+            y = np.repeat(np.arange(y_size), int(height/y_size)+1)[:height]
+            self.grid = (x, y)
+
+        self.n_features = sum(block.shape[1] for block in self.blocks)
+        if self.grid is not None:
+            self.n_features += 2
+
+    def rows(self, pixels):
+        """Get the feature rows of some pixels
+
+        Args:
+            pixels: Indices of the pixels in the flattened mask area, either as
+                integer array or as slice.
+
+        Returns:
+            A float32 array with shape N_pixelsxN_features.
+        """
+        if isinstance(pixels, slice):
+            pixels = np.arange(*pixels.indices(self.n_pixels))
+
+        rows = np.empty((len(pixels), self.n_features), dtype=np.float32)
+        column = 0
+        for block in self.blocks:
+            rows[:, column:column+block.shape[1]] = block[pixels]
+            column += block.shape[1]
+
+        if self.grid is not None:
+            y, x = np.divmod(pixels, self.shape[1])
+            rows[:, column] = self.grid[0][x]
+            rows[:, column+1] = self.grid[1][y]
+
+        return rows
+
+
+def predict_chunks(model, features, chunk_size, n_threads=1, parallel=False, **predict_options):
+    """Predict all pixels chunk by chunk
+
+    Only one chunk of feature rows (per thread) is held in memory at a time.
+    The results are written into preallocated uint8 arrays.
+
+    Args:
+        model: Fitted classifier with `predict_proba` and `classes_`.
+        features: PixelFeatures of the mask area.
+        chunk_size: Number of pixels per chunk.
+        n_threads: Number of threads which may be used.
+        parallel: If true, the chunks are predicted in a thread pool with
+            `n_threads` workers (each using one thread). Otherwise, the chunks
+            are predicted one after another, each using `n_threads` threads.
+        **predict_options: Passed on to `model.predict_proba`.
+
+    Returns:
+        A tuple with the predicted class ids (uint8, shape N_pixels) and the
+        class probabilities quantised to 0-255 (uint8, shape
+        N_pixelsxN_classes).
+    """
+    classes = np.asarray(model.classes_)
+    predictions = np.empty(features.n_pixels, dtype=np.uint8)
+    probabilities = np.empty((features.n_pixels, len(classes)), dtype=np.uint8)
+
+    def predict_chunk(start, num_threads):
+        chunk = slice(start, min(start+chunk_size, features.n_pixels))
+        chunk_probabilities = model.predict_proba(
+            features.rows(chunk), num_threads=num_threads, **predict_options
+        )
+        predictions[chunk] = classes[np.argmax(chunk_probabilities, axis=-1)]
+        probabilities[chunk] = np.rint(255 * chunk_probabilities)
+
+    starts = range(0, features.n_pixels, chunk_size)
+    if parallel and n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # list() to raise any exceptions from the workers:
+            list(executor.map(lambda start: predict_chunk(start, 1), starts))
+    else:
+        for start in starts:
+            predict_chunk(start, n_threads)
+
+    return predictions, probabilities
+
+
+class Region:
+    """A region of interest within the mask area
+
+    Training and inference can be restricted to a region, e.g. when the user
+    only refines a small part of the mask. The region is a bounding box,
+    optionally with a (lasso) polygon inside of it. All coordinates are in
+    pixels relative to the mask area.
+
+    Args:
+        bbox: [x_min, y_min, x_max, y_max] (max values are exclusive).
+        polygon: Optional list of [x, y] vertices.
+    """
+    # Value for pixels in the bounding box but outside of the polygon, i.e.
+    # pixels which the client should leave unchanged:
+    NO_PREDICTION = 255
+
+    def __init__(self, bbox, polygon=None):
+        self.bbox = [int(v) for v in bbox]
+        self.polygon = polygon
+        x_min, y_min, x_max, y_max = self.bbox
+        self.shape = (y_max - y_min, x_max - x_min)
+
+    @classmethod
+    def full(cls, mask_shape):
+        """Region covering the complete mask area (mask_shape as in the config)"""
+        return cls([0, 0, mask_shape[0], mask_shape[1]])
+
+    @classmethod
+    def from_json(cls, data, mask_shape):
+        """Create a region from the request data
+
+        Args:
+            data: Dictionary with `bbox` and/or `polygon`, or None.
+            mask_shape: Shape of the mask area as given in the config.
+
+        Returns:
+            The region (the full mask area if data is empty).
+
+        Raises:
+            ValueError if the region is invalid or empty.
+        """
+        if not data:
+            return cls.full(mask_shape)
+
+        polygon = data.get('polygon')
+        if polygon is not None:
+            polygon = np.asarray(polygon, dtype=float)
+            if polygon.ndim != 2 or polygon.shape[1] != 2 or len(polygon) < 3:
+                raise ValueError('The polygon must be a list of at least 3 [x, y] points!')
+
+        bbox = data.get('bbox')
+        if bbox is None:
+            if polygon is None:
+                raise ValueError('The region needs a bbox or a polygon!')
+            bbox = [
+                *np.floor(polygon.min(axis=0)), *(np.ceil(polygon.max(axis=0)) + 1)
+            ]
+        if len(bbox) != 4:
+            raise ValueError('The bbox must be given as [x_min, y_min, x_max, y_max]!')
+
+        # Clip the bounding box to the mask area:
+        bbox = [
+            int(np.clip(bbox[0], 0, mask_shape[0])), int(np.clip(bbox[1], 0, mask_shape[1])),
+            int(np.clip(bbox[2], 0, mask_shape[0])), int(np.clip(bbox[3], 0, mask_shape[1])),
+        ]
+        if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            raise ValueError('The region is empty!')
+
+        return cls(bbox, None if polygon is None else polygon.tolist())
+
+    def is_full(self, mask_shape):
+        return self.polygon is None and self.bbox == [0, 0, mask_shape[0], mask_shape[1]]
+
+    @property
+    def inside(self):
+        """Boolean array (shape of the bbox) which is true inside the polygon"""
+        if self.polygon is None:
+            return np.ones(self.shape, dtype=bool)
+
+        # polygon2mask expects (row, column) coordinates:
+        vertices = np.asarray(self.polygon)[:, ::-1] - [self.bbox[1], self.bbox[0]]
+        return polygon2mask(self.shape, vertices)
+
+    def crop(self, image):
+        """Crop an array with the shape of the mask area to the bbox"""
+        x_min, y_min, x_max, y_max = self.bbox
+        return image[y_min:y_max, x_min:x_max]
+
+    def select(self, indices, labels, mask_width):
+        """Select the pixels inside of the region
+
+        Args:
+            indices: Pixel indices in the flattened mask area.
+            labels: Class ids of the pixels.
+            mask_width: Width of the mask area.
+
+        Returns:
+            The pixel indices (in the flattened region) and labels of the
+            pixels inside the region.
+        """
+        x_min, y_min, x_max, y_max = self.bbox
+        y, x = np.divmod(indices, mask_width)
+        selected = (x >= x_min) & (x < x_max) & (y >= y_min) & (y < y_max)
+        y, x = y[selected] - y_min, x[selected] - x_min
+        if self.polygon is not None:
+            in_polygon = self.inside[y, x]
+            y, x = y[in_polygon], x[in_polygon]
+            selected[selected] = in_polygon
+        return y * self.shape[1] + x, labels[selected]
+
+    def to_json(self):
+        return {'bbox': self.bbox, 'polygon': self.polygon}
+
+
+def read_prediction_request(body, content_type, config):
+    """Get the training pixels and the region from the request body
+
+    Args:
+        body: Raw request body. Either JSON with `user_pixels`, `user_labels`
+            and an optional `roi` (see Region.from_json), or the binary format
+            from iris.segmentation.codec if the content type is
+            `application/octet-stream`.
+        content_type: Mimetype of the request.
+        config: The `segmentation` section of the user config.
+
+    Returns:
+        user_indices, user_labels, region
+
+    Raises:
+        ValueError if the request is malformed.
+    """
+    mask_size = config['mask_shape'][0] * config['mask_shape'][1]
+    if content_type == 'application/octet-stream':
+        user_indices, user_labels, options = decode_training_pixels(body, mask_size)
+    else:
+        options = json.loads(body)
+        user_indices = np.array(options['user_pixels'])
+        user_labels = np.array(options['user_labels'])
+
+    region = Region.from_json(options.get('roi'), config['mask_shape'])
+    return user_indices, user_labels, region
+
+
+def get_model_key(image_id, config, user_indices, user_labels, region=None):
+    """Hash everything that influences the trained model
+
+    The post-processing options are deliberately left out, so a request which
+    only changes them maps to the same key as the request before.
+    """
+    ai_config = {
+        k: v for k, v in config['ai_model'].items()
+        if k not in POSTPROCESSING_OPTIONS
+    }
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(image_id.encode())
+    hasher.update(json.dumps(
+        [ai_config, config['mask_area'], region and region.to_json()],
+        sort_keys=True, default=str
+    ).encode())
+    hasher.update(np.ascontiguousarray(user_indices, dtype=np.int64).tobytes())
+    hasher.update(np.ascontiguousarray(user_labels, dtype=np.int64).tobytes())
+    return hasher.hexdigest()
+
+
+def _balanced_quota(counts, budget):
+    """Distribute a budget of pixels as evenly as possible over the classes
+
+    Classes with fewer pixels than their share keep all of them and pass the
+    remainder on to the bigger classes.
+    """
+    quota = np.zeros_like(counts)
+    remaining = budget
+    order = np.argsort(counts, kind='stable')
+    for i, c in enumerate(order):
+        share = remaining // (len(order) - i)
+        quota[c] = min(counts[c], share)
+        remaining -= quota[c]
+    return quota
+
+
+def sample_training_pixels(user_indices, user_labels, max_pixels, train_ratio, seed):
+    """Split the user pixels into a class-balanced training and validation set
+
+    Each class is split by `train_ratio` (keeping at least one pixel for
+    training and, if possible, one for validation). The training set is then
+    limited to `max_pixels` which are distributed evenly over the classes, so
+    rare classes are kept completely. The validation set is limited
+    accordingly.
+
+    Args:
+        user_indices: 1D array with the pixel indices.
+        user_labels: 1D array with the class ids.
+        max_pixels: Maximum number of training pixels.
+        train_ratio: Ratio of the pixels of each class used for training.
+        seed: Seed for the random sampling, the same seed gives the same split.
+
+    Returns:
+        train_indices, val_indices, train_labels, val_labels
+    """
+    rng = np.random.default_rng(seed)
+    _, inverse, counts = np.unique(user_labels, return_inverse=True, return_counts=True)
+
+    # Shuffle the pixels and group them by class afterwards:
+    order = rng.permutation(len(user_labels))
+    order = order[np.argsort(inverse[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    if train_ratio >= 1:
+        n_train = counts
+        val_budget = 0
+    else:
+        n_train = np.where(
+            counts > 1, np.clip(np.round(counts * train_ratio), 1, counts - 1), counts
+        ).astype(int)
+        val_budget = int(round(max_pixels * (1 - train_ratio) / train_ratio))
+
+    train_quota = _balanced_quota(n_train, max_pixels)
+    val_quota = _balanced_quota(counts - n_train, val_budget)
+
+    train = np.concatenate([
+        order[start:start+quota]
+        for start, quota in zip(starts, train_quota)
+    ])
+    val = np.concatenate([
+        order[start+n:start+n+quota]
+        for start, n, quota in zip(starts, n_train, val_quota)
+    ])
+    return user_indices[train], user_indices[val], user_labels[train], user_labels[val]
+
+
+class CachedModel:
+    """A trained model together with its raw predictions
+
+    Args:
+        model: The fitted classifier.
+        classes: Class id of each column in probabilities.
+        predictions: uint8 array with the predicted class id per pixel (before
+            any post-processing).
+        probabilities: uint8 array with the class probabilities per pixel
+            quantised to 0-255.
+    """
+    def __init__(self, model, classes, predictions, probabilities):
+        self.model = model
+        self.classes = classes
+        self.predictions = predictions
+        self.probabilities = probabilities
+
+    def predict(self):
+        """Get the hard class ids (before post-processing)"""
+        return self.predictions
+
+    def planar_probabilities(self, n_classes):
+        """Get the probabilities as planes (n_classes x n_pixels, uint8)
+
+        Classes which the model does not know (no training pixels) get zeros.
+        """
+        planes = np.zeros((n_classes, len(self.probabilities)), dtype=np.uint8)
+        planes[np.asarray(self.classes, dtype=int)] = self.probabilities.T
+        return planes
+
+    @property
+    def nbytes(self):
+        """Memory used by the cached predictions and probabilities"""
+        return sum(
+            getattr(array, 'nbytes', 0)
+            for array in (self.predictions, self.probabilities)
+        )
+
+
+class ModelCache:
+    """Keep the last trained model per user and image
+
+    Entries are identified by (user_id, image_id) and only reused if the
+    training data and training options hash to the same key. Each entry holds
+    the class probabilities of every pixel, so the cache is bounded by the
+    memory of these arrays (`compute : model_cache_mb` in the project config
+    unless `max_bytes` is given) and by `max_entries`. The least recently used
+    entries are dropped first.
+    """
+    def __init__(self, max_entries=32, max_bytes=None):
+        self.max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        max_mb = project.config.get('compute', {}).get('model_cache_mb')
+        return int((256 if max_mb is None else max_mb) * 2**20)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of all cached models"""
+        with self._lock:
+            return self._nbytes
+
+    def get(self, user_id, image_id, key):
+        with self._lock:
+            entry = self._entries.get((user_id, image_id))
+            if entry is None or entry[0] != key:
+                return None
+            self._entries.move_to_end((user_id, image_id))
+            return entry[1]
+
+    def put(self, user_id, image_id, key, model):
+        max_bytes = self.max_bytes
+        with self._lock:
+            self._pop((user_id, image_id))
+            self._entries[(user_id, image_id)] = (key, model)
+            self._nbytes += getattr(model, 'nbytes', 0)
+            # A model larger than the whole cache is not kept either:
+            while self._entries and (
+                    len(self._entries) > self.max_entries or self._nbytes > max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            self._nbytes -= getattr(entry[1], 'nbytes', 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+model_cache = ModelCache()
+
+
+def suppress(predictions, ai_config, mask_shape):
+    """Apply the suppression filter to the predicted classes
+
+    Pixels whose neighbourhood mostly consists of the default class are set to
+    the default class as well.
+
+    Args:
+        predictions: 1D uint8 array with class ids (will be copied).
+        ai_config: The `ai_model` section of the user config.
+        mask_shape: Shape of the predicted area as (height, width).
+
+    Returns:
+        The filtered predictions.
+    """
+    predictions = predictions.copy()
+    if ai_config['suppression_threshold'] == 0:
+        return predictions
+
+    default_class = ai_config['suppression_default_class']
+    other_classes = (predictions != default_class).astype(int)
+    other_classes = other_classes.reshape(*mask_shape)
+    window_size = ai_config['suppression_filter_size']
+    window = np.ones((window_size, window_size))
+    window[window_size//2, window_size//2] = 0
+    neighbourhood_ratio = convolve(
+        other_classes, window, mode='constant', cval=0.5
+    ) / (window_size**2 - 1)
+    suppressed = 100 * neighbourhood_ratio.ravel() < ai_config['suppression_threshold']
+    predictions[suppressed] = default_class
+    return predictions
+
+
+def predict(image_id, user_id, config, user_indices, user_labels, region=None,
+            output='classes', job=None):
+    """Train a model on the user pixels and predict the mask area (or region)
+
+    Args:
+        image_id: Id of the image.
+        user_id: Id of the user (used for the model cache).
+        config: The `segmentation` section of the user config.
+        user_indices: 1D array with the indices of the training pixels in the
+            flattened mask area.
+        user_labels: 1D array with the class ids of the training pixels.
+        region: Optional Region to which training and prediction are
+            restricted.
+        output: 'classes' or 'probabilities' (see Returns).
+        job: Optional `PredictionJob` which receives progress reports and
+            can abort the prediction when it is cancelled.
+
+    Returns:
+        For output='classes', a 1D uint8 array with the predicted class id for
+        each pixel of the region (pixels outside the region's polygon are
+        Region.NO_PREDICTION). For output='probabilities', a 2D uint8 array
+        with one plane of probabilities (0-255) per project class (n_classes x
+        n_pixels) without any post-processing; pixels outside the polygon are
+        0 in all planes.
+
+    Raises:
+        ValueError if the region contains training pixels of less than two
+        classes.
+    """
+    if output not in PREDICTION_OUTPUTS:
+        raise ValueError(f"Unknown prediction output '{output}'!")
+
+    ai_config = config['ai_model']
+    # Memory and thread options are server-wide and cannot be set by the user:
+    compute_config = project['compute']
+
+    if region is None:
+        region = Region.full(config['mask_shape'])
+    elif not region.is_full(config['mask_shape']):
+        user_indices, user_labels = region.select(
+            user_indices, user_labels, mask_width=config['mask_shape'][0]
+        )
+        if len(np.unique(user_labels)) < 2:
+            raise ValueError('The region must contain training pixels of at least two classes!')
+
+    # The trained model (and its class probabilities) only depend on the
+    # training data and the training options. If the user just changed the
+    # post-processing options, we can skip the fitting:
+    model_key = get_model_key(image_id, config, user_indices, user_labels, region)
+    cached_model = model_cache.get(user_id, image_id, model_key)
+
+    if cached_model is None:
+        if job is not None:
+            job.report('features')
+
+        # How to exclude certain bands?
+        image_dict = project.get_image(image_id, bands=ai_config['bands'])
+        image = image_dict_to_array(image_dict)
+
+        # Select only the masking area:
+        mask_area = (
+            slice(config['mask_area'][1], config['mask_area'][3]),
+            slice(config['mask_area'][0], config['mask_area'][2]),
+            slice(None, None, None)
+        )
+        image = region.crop(image[mask_area])
+        features = PixelFeatures(image, ai_config)
+
+        # Bound the training time by limiting the number of training pixels.
+        # The split only depends on the training data, so the same request
+        # gives always the same model:
+        train_indices, val_indices, train_labels, val_labels = sample_training_pixels(
+            user_indices, user_labels,
+            max_pixels=ai_config['max_train_pixels'],
+            train_ratio=ai_config['train_ratio'],
+            seed=int(model_key[:8], 16),
+        )
+
+        if job is not None:
+            job.report('waiting', n_features=features.n_features)
+
+        queued = time.time()
+        with scheduler.slot(name=f'predict {image_id}') as n_threads:
+            if job is not None:
+                job.report(
+                    'training', iteration=0, n_iterations=ai_config['n_estimators'],
+                    n_threads=n_threads, wait_time=round(time.time() - queued, 4),
+                )
+
+            model = get_backend(ai_config, n_threads).fit(
+                features.rows(train_indices), train_labels,
+                validation=(features.rows(val_indices), val_labels), job=job,
+            )
+
+            if job is not None:
+                job.report('predicting')
+
+            # predict the class probabilities for the whole image:
+            predictions, probabilities = predict_chunks(
+                model, features,
+                chunk_size=compute_config['inference_chunk_size'],
+                n_threads=n_threads,
+                parallel=compute_config['parallel_inference'],
+            )
+        cached_model = CachedModel(model, model.classes_, predictions, probabilities)
+        model_cache.put(user_id, image_id, model_key, cached_model)
+
+    if output == 'probabilities':
+        # The client applies thresholds itself, so no post-processing here:
+        planes = cached_model.planar_probabilities(len(project['classes']))
+        if region.polygon is not None:
+            planes[:, ~region.inside.ravel()] = 0
+        return planes
+
+    if job is not None:
+        job.report('postprocessing')
+
+    predictions = cached_model.predict()
+
+    # Apply suppression filter:
+    predictions = suppress(predictions, ai_config, region.shape)
+    if region.polygon is not None:
+        predictions[~region.inside.ravel()] = Region.NO_PREDICTION
+    return predictions
@@ -7,6 +7,14 @@ import flask
 import json
 from iris.user import requires_auth
 from iris.project import project
+from iris.segmentation.ai import (
+    PREDICTION_OUTPUTS, REGION_HEADER, predict, read_prediction_request
+)
+from iris.segmentation.codec import MASK_VERSION_HEADER
+from iris.segmentation.jobs import job_manager
+from iris.segmentation.journal import mask_journal
+from iris.segmentation.merge_queue import merge_queue
+from iris.segmentation.storage import get_mask_store
 
 api_bp = flask.Blueprint(
     'segmentation_api', __name__,
@@ -41,4 +49,147 @@ def save_user_config():
     
     project.save_user_config(user_id, user_config)
     
-    return flask.jsonify({'message': 'Saved user config successfully!'})
\ No newline at end of file
+    return flask.jsonify({'message': 'Saved user config successfully!'})
+
+@api_bp.route('/predict-jobs/<image_id>', methods=['POST'])
+@requires_auth
+def submit_predict_job(image_id):
+    """Submit a prediction job; older unfinished jobs of the user are cancelled."""
+    user_id = flask.session['user_id']
+    config = project.get_user_config(user_id)['segmentation']
+
+    try:
+        user_indices, user_labels, region = read_prediction_request(
+            flask.request.get_data(), flask.request.mimetype, config
+        )
+    except ValueError as error:
+        return flask.make_response(str(error), 400)
+
+    output = flask.request.args.get('output', 'classes')
+    if output not in PREDICTION_OUTPUTS:
+        return flask.make_response(f"Unknown prediction output '{output}'!", 400)
+
+    details = {'output': output}
+    if not region.is_full(config['mask_shape']):
+        details['region'] = region.bbox
+
+    job = job_manager.submit(
+        user_id, image_id, predict,
+        args=(image_id, user_id, config, user_indices, user_labels, region),
+        kwargs={'output': output},
+        details=details,
+    )
+    return flask.jsonify({'job': job.to_json()}), 202
+
+
+def _get_user_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None or job.user_id != flask.session['user_id']:
+        return None
+    return job
+
+
+@api_bp.route('/predict-jobs/<job_id>', methods=['GET'])
+@requires_auth
+def get_predict_job(job_id):
+    """Get status and progress of a prediction job."""
+    job = _get_user_job(job_id)
+    if job is None:
+        return flask.make_response('Unknown job id!', 404)
+
+    return flask.jsonify({'job': job.to_json()})
+
+
+@api_bp.route('/predict-jobs/<job_id>/result', methods=['GET'])
+@requires_auth
+def get_predict_job_result(job_id):
+    """Get the predicted mask of a finished job (same format as predict_mask)."""
+    job = _get_user_job(job_id)
+    if job is None:
+        return flask.make_response('Unknown job id!', 404)
+    if job.status != job.FINISHED:
+        return flask.make_response(f'Job is {job.status}!', 409)
+
+    response = flask.make_response(job.result.tobytes())
+    response.headers.set('Content-Type', 'application/octet-stream')
+    if 'region' in job.details:
+        response.headers.set(REGION_HEADER, ",".join(map(str, job.details['region'])))
+    return response
+
+
+@api_bp.route('/merge-status/<image_id>', methods=['GET'])
+@requires_auth
+def get_merge_status(image_id):
+    """Get the status of the background merge of an image's masks."""
+    if image_id not in project.image_ids:
+        return flask.make_response('Unknown image id!', 404)
+
+    return flask.jsonify({'merge': merge_queue.get_status(image_id)})
+
+
+@api_bp.route('/masks/<image_id>/history', methods=['GET'])
+@requires_auth
+def get_mask_history(image_id):
+    """Get all saved versions of the masks of an image and time statistics.
+
+    Query parameters:
+        user_id: only the versions of this user (default: all users)
+    """
+    if image_id not in project.image_ids:
+        return flask.make_response('Unknown image id!', 404)
+
+    return flask.jsonify({
+        'image_id': image_id,
+        'versions': mask_journal.get_history(
+            image_id, flask.request.args.get('user_id')
+        ),
+        'statistics': mask_journal.get_statistics(image_id),
+    })
+
+
+@api_bp.route('/masks/<image_id>/restore', methods=['POST'])
+@requires_auth
+def restore_mask(image_id):
+    """Restore a previous version of the current user's masks.
+
+    Expects JSON {"version": <version>}. The restored masks are saved as a
+    new version, so the restore itself can be undone as well.
+    """
+    # Imported here to avoid circular imports:
+    from iris.segmentation import on_masks_saved, read_masks, write_masks
+
+    if image_id not in project.image_ids:
+        return flask.make_response('Unknown image id!', 404)
+
+    user_id = flask.session['user_id']
+    data = flask.request.get_json(silent=True) or {}
+    try:
+        version = int(data['version'])
+    except (KeyError, TypeError, ValueError):
+        return flask.make_response('Expected JSON with the version to restore!', 400)
+
+    mask_shape = tuple(project['segmentation']['mask_shape'][::-1])
+    store = get_mask_store()
+    with merge_queue.lock(image_id):
+        try:
+            final_mask, user_mask = mask_journal.restore(
+                image_id, user_id, version, mask_shape
+            )
+        except ValueError as error:
+            return flask.make_response(str(error), 404)
+
+        old_version = store.version(image_id, user_id)
+        old_masks = None
+        if store.exists(image_id, user_id):
+            old_masks = read_masks(image_id, user_id)
+        new_version = write_masks(
+            image_id, user_id, final_mask, user_mask, old_version, old_masks
+        )
+
+    on_masks_saved(image_id, user_id)
+
+    response = flask.jsonify({
+        'image_id': image_id, 'restored': version, 'version': new_version
+    })
+    response.headers.set(MASK_VERSION_HEADER, str(new_version))
+    return response
@@ -0,0 +1,189 @@
+"""
+Classifier backends for the per-image AI model.
+
+Each backend wraps one classifier behind the same small interface, so that the
+training in `iris.segmentation.ai.predict` does not depend on the library which
+is used. The backend is selected by `ai_model : backend` in the project config:
+
+    lightgbm                LightGBM gradient boosting (default)
+    hist_gradient_boosting  scikit-learn's HistGradientBoostingClassifier
+    random_forest           scikit-learn's RandomForestClassifier
+    nearest_centroid        distance to the mean feature vector of each class
+
+A fitted backend has `classes_` and `predict_proba(X, num_threads=1)`, i.e. it
+can be passed to `predict_chunks` directly.
+"""
+import lightgbm as lgb
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from threadpoolctl import threadpool_limits
+
+
+class Backend:
+    """Interface of a classifier backend
+
+    Args:
+        ai_config: The `ai_model` section of the config.
+        n_threads: Number of threads which may be used for fitting.
+    """
+    def __init__(self, ai_config, n_threads=1):
+        self.ai_config = ai_config
+        self.n_threads = n_threads
+        self.classes_ = None
+
+    def fit(self, X, y, validation=None, job=None):
+        """Fit the classifier
+
+        Args:
+            X: Feature rows (n_pixels x n_features).
+            y: Class ids of the rows.
+            validation: Optional tuple (X, y) for early stopping. Backends
+                without early stopping ignore it.
+            job: Optional `PredictionJob` which receives progress reports.
+
+        Returns:
+            The backend itself.
+        """
+        raise NotImplementedError
+
+    def predict_proba(self, X, num_threads=1):
+        """Class probabilities of the rows (n_pixels x n_classes)"""
+        raise NotImplementedError
+
+
+class LightGBMBackend(Backend):
+    def fit(self, X, y, validation=None, job=None):
+        callbacks = []
+        fit_options = {}
+        if validation is not None and len(validation[1]):
+            callbacks.append(lgb.early_stopping(4, verbose=False))
+            fit_options['eval_set'] = [validation]
+        if job is not None:
+            callbacks.append(job.lightgbm_callback)
+
+        self.model = lgb.LGBMClassifier(
+            num_leaves=self.ai_config['n_leaves'],
+            max_bin=128,
+            max_depth=self.ai_config['max_depth'],
+            # min_data_in_leaf=1000,
+            # bagging_fraction=0.2,
+            # boosting_type='dart',
+            tree_learner='data',
+            learning_rate=0.05,
+            n_estimators=self.ai_config['n_estimators'],
+            n_jobs=self.n_threads,
+        )
+        self.model.fit(X, y, callbacks=callbacks, **fit_options)
+        self.classes_ = self.model.classes_
+        return self
+
+    def predict_proba(self, X, num_threads=1):
+        return self.model.predict_proba(
+            X, num_threads=num_threads, num_iteration=self.model.best_iteration_
+        )
+
+
+class SklearnBackend(Backend):
+    """Base class for scikit-learn classifiers
+
+    scikit-learn parallelises either with joblib (`n_jobs`) or with OpenMP,
+    so the thread limit is enforced with threadpoolctl as well.
+    """
+    def create(self):
+        raise NotImplementedError
+
+    def fit(self, X, y, validation=None, job=None):
+        self.model = self.create()
+        with threadpool_limits(limits=self.n_threads):
+            self.model.fit(X, y)
+        if job is not None:
+            job.raise_if_cancelled()
+        self.classes_ = self.model.classes_
+        return self
+
+    def predict_proba(self, X, num_threads=1):
+        if hasattr(self.model, 'n_jobs'):
+            self.model.n_jobs = num_threads
+        with threadpool_limits(limits=num_threads):
+            return self.model.predict_proba(X)
+
+
+class HistGradientBoostingBackend(SklearnBackend):
+    def create(self):
+        return HistGradientBoostingClassifier(
+            max_iter=self.ai_config['n_estimators'],
+            max_depth=self.ai_config['max_depth'],
+            max_leaf_nodes=max(self.ai_config['n_leaves'], 2),
+            max_bins=128,
+            learning_rate=0.1,
+            early_stopping=False,
+            random_state=0,
+        )
+
+
+class RandomForestBackend(SklearnBackend):
+    def create(self):
+        return RandomForestClassifier(
+            n_estimators=self.ai_config['n_estimators'],
+            max_depth=self.ai_config['max_depth'],
+            min_samples_leaf=5,
+            n_jobs=self.n_threads,
+            random_state=0,
+        )
+
+
+class NearestCentroidBackend(Backend):
+    """Baseline: assign each pixel to the class with the closest mean
+
+    The features are standardised first, so that no feature dominates the
+    distance. The probabilities are a softmax over the negative squared
+    distances.
+    """
+    def fit(self, X, y, validation=None, job=None):
+        X = np.asarray(X, dtype=np.float32)
+        self.mean = X.mean(axis=0)
+        self.scale = X.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        X = (X - self.mean) / self.scale
+
+        self.classes_ = np.unique(y)
+        self.centroids = np.stack([X[y == label].mean(axis=0) for label in self.classes_])
+        return self
+
+    def predict_proba(self, X, num_threads=1):
+        X = (np.asarray(X, dtype=np.float32) - self.mean) / self.scale
+        distances = (
+            (X**2).sum(axis=1, keepdims=True) - 2 * X @ self.centroids.T
+            + (self.centroids**2).sum(axis=1)
+        )
+        logits = -0.5 * distances
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+BACKENDS = {
+    'lightgbm': LightGBMBackend,
+    'hist_gradient_boosting': HistGradientBoostingBackend,
+    'random_forest': RandomForestBackend,
+    'nearest_centroid': NearestCentroidBackend,
+}
+
+
+def get_backend(ai_config, n_threads=1, name=None):
+    """Create the backend selected in the config
+
+    Args:
+        ai_config: The `ai_model` section of the config.
+        n_threads: Number of threads which may be used for fitting.
+        name: Name of the backend (overrides `ai_config['backend']`).
+
+    Raises:
+        ValueError if the backend is unknown.
+    """
+    name = name or ai_config.get('backend', 'lightgbm')
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown AI backend '{name}'! Choose from: {', '.join(BACKENDS)}"
+        )
+    return BACKENDS[name](ai_config, n_threads)
@@ -0,0 +1,143 @@
+"""
+Benchmark the classifier backends on the existing annotations of a project.
+
+For every saved mask, each backend is trained on the pixels which the user
+labelled by hand (the user mask) and predicts the whole mask area, as in the
+interactive mode. The result is compared with the saved mask. This shows how
+fast each backend is and how close it gets to the final annotations, so one
+can choose the fastest acceptable backend for a dataset.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.ai import predict_chunks, sample_training_pixels
+from iris.segmentation.backends import BACKENDS, get_backend
+from iris.segmentation.project_model import get_image_features
+
+
+def get_training_pixels(final_mask, user_mask, max_pixels, seed=0):
+    """Training pixels as a user would have given them
+
+    Uses the pixels set by the user or, if they do not contain at least two
+    classes, a sample of the whole mask.
+
+    Returns:
+        Tuple with the pixel indices and labels.
+    """
+    labels = final_mask.ravel()
+    indices = np.flatnonzero(user_mask.ravel())
+    if len(np.unique(labels[indices])) < 2:
+        indices = np.arange(len(labels))
+
+    indices, _, labels, _ = sample_training_pixels(
+        indices, labels[indices], max_pixels=max_pixels, train_ratio=1., seed=seed
+    )
+    return indices, labels
+
+
+def fit_and_predict(name, features, indices, labels, n_threads=1):
+    """Fit one backend and predict the whole mask area
+
+    Returns:
+        Tuple with the predictions and the times after fitting and after
+        predicting (from `time.perf_counter`).
+    """
+    ai_config = project['segmentation']['ai_model']
+    model = get_backend(ai_config, n_threads, name=name).fit(
+        features.rows(indices), labels
+    )
+    fitted = time.perf_counter()
+    predictions, _ = predict_chunks(
+        model, features, chunk_size=project['compute']['inference_chunk_size'],
+        n_threads=n_threads,
+    )
+    return predictions, fitted, time.perf_counter()
+
+
+def benchmark_backend(name, features, final_mask, user_mask, n_threads=1):
+    """Fit and evaluate one backend on one mask
+
+    Tracing the allocations slows down the backends, so the times and the
+    memory are measured in two separate runs.
+
+    Returns:
+        Dictionary with fit_time, predict_time (seconds), peak_memory (MB of
+        memory allocated through Python, native allocations of the libraries
+        are not included) and agreement (share of pixels which agree with the
+        saved mask).
+    """
+    indices, labels = get_training_pixels(
+        final_mask, user_mask,
+        max_pixels=project['segmentation']['ai_model']['max_train_pixels']
+    )
+
+    started = time.perf_counter()
+    predictions, fitted, predicted = fit_and_predict(
+        name, features, indices, labels, n_threads
+    )
+
+    tracemalloc.start()
+    try:
+        fit_and_predict(name, features, indices, labels, n_threads)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'fit_time': fitted - started,
+        'predict_time': predicted - fitted,
+        'peak_memory': peak_memory / 2**20,
+        'agreement': float(np.mean(predictions == final_mask.ravel())),
+    }
+
+
+def run_benchmark(backends=None, image_ids=None, n_threads=1):
+    """Benchmark backends on all saved masks
+
+    Args:
+        backends: Names of the backends (default: all).
+        image_ids: Images to use (default: all images with masks).
+        n_threads: Number of threads for each backend.
+
+    Returns:
+        A list with one dictionary per backend and mask (see
+        `benchmark_backend`, plus backend, image_id and user_id).
+    """
+    # Imported here to avoid circular imports:
+    from iris.segmentation import get_mask_users, read_masks
+
+    backends = backends or list(BACKENDS)
+    for name in backends:
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown AI backend '{name}'!")
+
+    results = []
+    for image_id in image_ids or project.image_ids:
+        users = get_mask_users(image_id)
+        if not users:
+            continue
+        features = get_image_features(image_id, project['segmentation']['ai_model'])
+        for user_id in users:
+            final_mask, user_mask = read_masks(image_id, user_id)
+            for name in backends:
+                results.append({
+                    'backend': name, 'image_id': image_id, 'user_id': user_id,
+                    **benchmark_backend(name, features, final_mask, user_mask, n_threads)
+                })
+    return results
+
+
+def summarise(results):
+    """Mean of all measures per backend"""
+    summary = {}
+    for name in dict.fromkeys(result['backend'] for result in results):
+        rows = [result for result in results if result['backend'] == name]
+        summary[name] = {
+            measure: float(np.mean([row[measure] for row in rows]))
+            for measure in ('fit_time', 'predict_time', 'peak_memory', 'agreement')
+        }
+        summary[name]['n_masks'] = len(rows)
+    return summary
@@ -0,0 +1,336 @@
+"""
+Binary encodings exchanged with the segmentation client.
+
+Training pixels for the AI model can be sent as JSON (`user_pixels` and
+`user_labels` arrays) or, much cheaper for large numbers of pixels, as an
+`application/octet-stream` body. All numbers are little-endian:
+
+    magic        4 bytes  b'IRPX'
+    version      uint8    1
+    encoding     uint8    0: pixel list, 1: run-length encoded label image
+    options_len  uint16   length of the JSON options block (may be 0)
+    count        uint32   number of pixels (encoding 0) or runs (encoding 1)
+    options      options_len bytes of UTF-8 JSON, e.g. {"roi": {...}}
+
+followed by either
+
+    encoding 0:  count x uint32 pixel indices, count x uint8 labels
+    encoding 1:  count x uint32 run lengths, count x uint8 run values
+
+The run-length encoded label image covers the whole flattened mask area;
+pixels with the value 255 are not labelled.
+
+Masks are exchanged by `load_mask` and `save_mask` in a similar format:
+
+    magic         4 bytes  b'IRMK'
+    version       uint8    1
+    kind          uint8    0: full mask, 1: patch
+    n_rects       uint16   number of rectangles (1 for a full mask)
+    base_version  uint32   mask version the patch is based on (0 for full)
+    height        uint32   height of the mask area
+    width         uint32   width of the mask area
+
+followed by n_rects times
+
+    rect          4 x uint32: x, y, width, height
+    final plane   class ids of the rectangle (row by row)
+    user plane    1 if the user labelled the pixel, 0 if the AI did
+
+Each plane starts with its encoding (uint8, 0: raw, 1: run-length) and the
+number of bytes (uint32), followed by the raw uint8 values or by the run
+lengths (uint32) and run values (uint8).
+"""
+import json
+import struct
+
+import numpy as np
+
+PIXELS_MAGIC = b'IRPX'
+PIXELS_VERSION = 1
+PIXELS_HEADER = struct.Struct('<4sBBHI')
+
+ENCODING_PIXEL_LIST = 0
+ENCODING_RUN_LENGTH = 1
+
+# Label of pixels without annotation in a run-length encoded label image:
+UNLABELLED = 255
+
+# Header with the version of the stored mask (sent by load_mask and save_mask):
+MASK_VERSION_HEADER = 'X-IRIS-Mask-Version'
+
+MASK_MAGIC = b'IRMK'
+MASK_VERSION = 1
+MASK_HEADER = struct.Struct('<4sBBHIII')
+RECT = struct.Struct('<IIII')
+PLANE = struct.Struct('<BI')
+
+MASK_FULL = 0
+MASK_PATCH = 1
+
+PLANE_RAW = 0
+PLANE_RUN_LENGTH = 1
+
+
+def rle_encode(array):
+    """Run-length encode a 1D array
+
+    Returns:
+        Tuple with the run lengths (uint32) and the run values.
+    """
+    array = np.asarray(array).ravel()
+    if not len(array):
+        return np.zeros(0, dtype=np.uint32), array[:0]
+
+    starts = np.flatnonzero(np.concatenate([[True], array[1:] != array[:-1]]))
+    lengths = np.diff(np.append(starts, len(array)))
+    return lengths.astype(np.uint32), array[starts]
+
+
+def rle_decode(lengths, values, size=None):
+    """Decode a run-length encoded 1D array
+
+    Raises:
+        ValueError if the decoded array does not have `size` elements.
+    """
+    # Check the size before decoding, so huge run lengths cannot allocate
+    # arbitrary amounts of memory:
+    total = int(np.sum(lengths, dtype=np.uint64))
+    if size is not None and total != size:
+        raise ValueError(
+            f'Run-length encoded data has {total} elements, expected {size}!'
+        )
+    return np.repeat(values, lengths)
+
+
+def encode_training_pixels(indices, labels, options=None, run_length=False, mask_size=None):
+    """Encode training pixels to the binary format (mainly for clients and tests)
+
+    Args:
+        indices: Pixel indices in the flattened mask area.
+        labels: Class ids of the pixels.
+        options: Optional dictionary, e.g. {'roi': {...}}.
+        run_length: If true, send a run-length encoded label image.
+        mask_size: Number of pixels in the mask area (needed for run_length).
+
+    Returns:
+        The encoded bytes.
+    """
+    options = json.dumps(options).encode() if options else b''
+    if run_length:
+        label_image = np.full(mask_size, UNLABELLED, dtype=np.uint8)
+        label_image[indices] = labels
+        first, second = rle_encode(label_image)
+    else:
+        first, second = indices, labels
+
+    header = PIXELS_HEADER.pack(
+        PIXELS_MAGIC, PIXELS_VERSION,
+        ENCODING_RUN_LENGTH if run_length else ENCODING_PIXEL_LIST,
+        len(options), len(first)
+    )
+    return b''.join([
+        header, options,
+        np.asarray(first, dtype='<u4').tobytes(),
+        np.asarray(second, dtype=np.uint8).tobytes(),
+    ])
+
+
+def decode_training_pixels(data, mask_size):
+    """Decode training pixels from the binary format
+
+    Args:
+        data: The request body (bytes).
+        mask_size: Number of pixels in the mask area.
+
+    Returns:
+        A tuple with the pixel indices, labels and the options dictionary.
+
+    Raises:
+        ValueError if the data is malformed.
+    """
+    if len(data) < PIXELS_HEADER.size:
+        raise ValueError('Training data is too short!')
+
+    magic, version, encoding, options_length, count = PIXELS_HEADER.unpack_from(data)
+    if magic != PIXELS_MAGIC or version != PIXELS_VERSION:
+        raise ValueError('Unknown format of training data!')
+
+    offset = PIXELS_HEADER.size
+    expected_length = offset + options_length + 5 * count
+    if len(data) != expected_length:
+        raise ValueError(
+            f'Training data has {len(data)} bytes, expected {expected_length}!'
+        )
+
+    options = {}
+    if options_length:
+        options = json.loads(bytes(data[offset:offset+options_length]))
+        offset += options_length
+
+    first = np.frombuffer(data, dtype='<u4', count=count, offset=offset)
+    second = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset + 4*count)
+
+    if encoding == ENCODING_PIXEL_LIST:
+        indices, labels = first, second
+        if count and indices.max() >= mask_size:
+            raise ValueError('Pixel index outside of the mask area!')
+    elif encoding == ENCODING_RUN_LENGTH:
+        label_image = rle_decode(first, second, size=mask_size)
+        indices = np.flatnonzero(label_image != UNLABELLED)
+        labels = label_image[indices]
+    else:
+        raise ValueError(f'Unknown encoding of training data: {encoding}!')
+
+    return indices, labels, options
+
+
+def encode_plane(array, run_length=True):
+    """Encode a 2D uint8 plane (header and payload)"""
+    array = np.asarray(array, dtype=np.uint8).ravel()
+    if run_length:
+        lengths, values = rle_encode(array)
+        payload = lengths.astype('<u4').tobytes() + values.tobytes()
+        return PLANE.pack(PLANE_RUN_LENGTH, len(payload)) + payload
+    return PLANE.pack(PLANE_RAW, array.size) + array.tobytes()
+
+
+def decode_plane(data, offset, size):
+    """Decode a plane with `size` pixels starting at offset
+
+    Returns:
+        The 1D uint8 array and the offset after the plane.
+    """
+    if len(data) < offset + PLANE.size:
+        raise ValueError('Mask data is too short!')
+    encoding, length = PLANE.unpack_from(data, offset)
+    offset += PLANE.size
+    if len(data) < offset + length:
+        raise ValueError('Mask data is too short!')
+
+    if encoding == PLANE_RAW:
+        if length != size:
+            raise ValueError(f'Mask plane has {length} pixels, expected {size}!')
+        array = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+    elif encoding == PLANE_RUN_LENGTH:
+        if length % 5:
+            raise ValueError('Run-length encoded mask plane is malformed!')
+        count = length // 5
+        lengths = np.frombuffer(data, dtype='<u4', count=count, offset=offset)
+        values = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset + 4*count)
+        array = rle_decode(lengths, values, size=size)
+    else:
+        raise ValueError(f'Unknown encoding of mask plane: {encoding}!')
+    return array, offset + length
+
+
+def encode_masks(final_mask, user_mask, rects=None, base_version=0, run_length=True):
+    """Encode the final and user mask (or patches of them)
+
+    Args:
+        final_mask: 2D array with the class ids.
+        user_mask: 2D boolean array.
+        rects: Optional list of (x, y, width, height). If given, only these
+            rectangles are sent as patch against `base_version`.
+        base_version: Version of the mask on the server the patch is based on.
+        run_length: If true, the planes are run-length encoded.
+
+    Returns:
+        The encoded bytes.
+    """
+    height, width = final_mask.shape
+    kind = MASK_FULL if rects is None else MASK_PATCH
+    if rects is None:
+        rects = [(0, 0, width, height)]
+
+    parts = [MASK_HEADER.pack(
+        MASK_MAGIC, MASK_VERSION, kind, len(rects), base_version, height, width
+    )]
+    for x, y, rect_width, rect_height in rects:
+        window = (slice(y, y + rect_height), slice(x, x + rect_width))
+        parts.append(RECT.pack(x, y, rect_width, rect_height))
+        parts.append(encode_plane(final_mask[window], run_length))
+        parts.append(encode_plane(user_mask[window], run_length))
+    return b''.join(parts)
+
+
+def is_mask_message(data):
+    return bytes(data[:len(MASK_MAGIC)]) == MASK_MAGIC
+
+
+def decode_masks(data, mask_shape):
+    """Decode masks sent in the IRMK format
+
+    Args:
+        data: The request body (bytes).
+        mask_shape: (height, width) of the mask area.
+
+    Returns:
+        A tuple with the kind (MASK_FULL or MASK_PATCH), the base version and
+        a list of patches (x, y, final_patch, user_patch).
+
+    Raises:
+        ValueError if the data is malformed or does not fit to the mask.
+    """
+    if len(data) < MASK_HEADER.size:
+        raise ValueError('Mask data is too short!')
+    magic, version, kind, n_rects, base_version, height, width = \
+        MASK_HEADER.unpack_from(data)
+    if magic != MASK_MAGIC or version != MASK_VERSION:
+        raise ValueError('Unknown format of mask data!')
+    if (height, width) != tuple(mask_shape):
+        raise ValueError(
+            f'Mask has shape {(height, width)}, expected {tuple(mask_shape)}!'
+        )
+    if kind not in (MASK_FULL, MASK_PATCH):
+        raise ValueError(f'Unknown kind of mask data: {kind}!')
+
+    offset = MASK_HEADER.size
+    patches = []
+    for _ in range(n_rects):
+        if len(data) < offset + RECT.size:
+            raise ValueError('Mask data is too short!')
+        x, y, rect_width, rect_height = RECT.unpack_from(data, offset)
+        offset += RECT.size
+        if x + rect_width > width or y + rect_height > height:
+            raise ValueError('Patch is outside of the mask area!')
+        if kind == MASK_FULL and (x, y, rect_width, rect_height) != (0, 0, width, height):
+            raise ValueError('A full mask must cover the whole mask area!')
+
+        size = rect_width * rect_height
+        final_patch, offset = decode_plane(data, offset, size)
+        user_patch, offset = decode_plane(data, offset, size)
+        patches.append((
+            x, y, final_patch.reshape(rect_height, rect_width),
+            user_patch.reshape(rect_height, rect_width).astype(bool),
+        ))
+
+    if offset != len(data):
+        raise ValueError('Mask data has trailing bytes!')
+    if kind == MASK_FULL and len(patches) != 1:
+        raise ValueError('A full mask must have exactly one rectangle!')
+    return kind, base_version, patches
+
+
+def apply_patches(final_mask, user_mask, patches):
+    """Write patches into copies of the masks
+
+    Returns:
+        The patched final and user mask.
+    """
+    final_mask, user_mask = final_mask.copy(), user_mask.copy()
+    for x, y, final_patch, user_patch in patches:
+        height, width = final_patch.shape
+        final_mask[y:y+height, x:x+width] = final_patch
+        user_mask[y:y+height, x:x+width] = user_patch
+    return final_mask, user_mask
+
+
+def get_changed_rect(old, new):
+    """Bounding box (x, y, width, height) of the changed pixels or None"""
+    rows, cols = np.nonzero(old != new)
+    if not len(rows):
+        return None
+    return (
+        int(cols.min()), int(rows.min()),
+        int(cols.max() - cols.min() + 1), int(rows.max() - rows.min() + 1)
+    )
@@ -0,0 +1,233 @@
+"""
+Export the consensus masks and statistics of a project.
+
+For every image with saved masks, the masks of all users are merged (each
+pixel gets the class with the most votes, as in `merge_masks`) and written to
+the output folder as
+
+    png      indexed PNG with the class ids as pixel values and the class
+             colours as palette
+    npz      compressed numpy file with the class ids (`mask`) and the
+             georeferencing of the source image (`crs`, `transform`)
+    geotiff  single band GeoTIFF with the CRS and transform of the source
+             image and the class colours as colour map
+
+The images are processed in a pool of worker processes. Only image ids are
+sent to the workers and only a few numbers come back, which are streamed into
+`images.csv` (one row per image) and `users.csv` (one row per image and
+user) as soon as they arrive. So the memory stays flat for projects with any
+number of images.
+
+The export never changes the project: persisted votes are used if they are
+up to date, otherwise the votes are counted from the saved masks.
+"""
+import csv
+from multiprocessing import Pool
+import os
+from os.path import join
+import warnings
+
+import numpy as np
+import rasterio as rio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import Affine
+
+from iris.project import project
+
+EXPORT_FORMATS = {
+    'png': '.png',
+    'npz': '.npz',
+    'geotiff': '.tif',
+}
+
+
+def get_georeference(image_id):
+    """Get the CRS and transform of the mask area of an image
+
+    Returns:
+        Tuple with the CRS (or None) and the affine transform (or None if the
+        source image has no georeferencing).
+    """
+    path = project.get_image_path(image_id)
+    if isinstance(path, dict):
+        path = next(iter(path.values()))
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            with rio.open(path) as file:
+                crs, transform = file.crs, file.transform
+    except rio.errors.RasterioIOError:
+        return None, None
+
+    if crs is None and transform == Affine.identity():
+        return None, None
+
+    # The mask only covers the mask area of the image, so its origin moves by
+    # the offset of the area:
+    left, top = project['segmentation']['mask_area'][:2]
+    return crs, Affine(
+        transform.a, transform.b, transform.c + transform.a*left + transform.b*top,
+        transform.d, transform.e, transform.f + transform.d*left + transform.e*top,
+    )
+
+
+def get_consensus(image_id):
+    """Merge the masks of all users of an image
+
+    Returns:
+        Tuple with the merged mask, the user ids and their final masks.
+    """
+    # Imported here to avoid circular imports:
+    from iris.segmentation import count_votes, get_mask_users, read_masks, read_votes
+
+    users = get_mask_users(image_id)
+    votes, voters = read_votes(image_id)
+    if votes is None or sorted(voters) != users \
+            or votes.shape[-1] < len(project['classes']):
+        votes, users = count_votes(image_id)
+    merged_mask = np.argmax(votes, axis=-1).astype(np.uint8)
+    final_masks = [read_masks(image_id, user_id)[0] for user_id in users]
+    return merged_mask, users, final_masks
+
+
+def write_mask(filename, mask, format, crs=None, transform=None):
+    """Write a merged mask in one of the export formats"""
+    # Imported here to avoid circular imports:
+    from iris.segmentation import get_colour_table, save_encoded_mask
+
+    if format == 'png':
+        save_encoded_mask(filename, mask, 'palette')
+    elif format == 'npz':
+        transform = transform or Affine.identity()
+        np.savez_compressed(
+            filename, mask=mask, crs=np.array('' if crs is None else crs.to_string()),
+            transform=np.array([
+                transform.a, transform.b, transform.c, transform.d, transform.e, transform.f
+            ]),
+        )
+    elif format == 'geotiff':
+        height, width = mask.shape
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            with rio.open(
+                filename, 'w', driver='GTiff', height=height, width=width,
+                count=1, dtype='uint8', crs=crs, transform=transform,
+                compress='deflate',
+            ) as file:
+                file.write(mask, 1)
+                file.write_colormap(1, {
+                    class_id: tuple(colour)
+                    for class_id, colour in enumerate(get_colour_table('rgba').tolist())
+                })
+    else:
+        raise ValueError(f"Unknown export format '{format}'!")
+
+
+def export_image(image_id, directory, format):
+    """Export the consensus mask of one image
+
+    Returns:
+        Tuple with the statistics row of the image and the rows of its users
+        (None and [] if there are no masks for this image).
+    """
+    # Imported here to avoid circular imports:
+    from iris.segmentation import score_users
+
+    merged_mask, users, final_masks = get_consensus(image_id)
+    if not users:
+        return None, []
+
+    crs, transform = get_georeference(image_id)
+    write_mask(
+        join(directory, image_id + EXPORT_FORMATS[format]), merged_mask, format,
+        crs=crs, transform=transform,
+    )
+
+    classes = [klass['name'] for klass in project['classes']]
+    n_classes = max(len(classes), int(merged_mask.max()) + 1)
+    scores = score_users(users, final_masks, merged_mask, n_classes)
+
+    def count_pixels(mask):
+        counts = np.bincount(mask.ravel(), minlength=n_classes)
+        return {f'pixels_{name}': int(counts[c]) for c, name in enumerate(classes)}
+
+    image_row = {
+        'image_id': image_id,
+        'n_users': len(users),
+        'unverified': len(users) <= project['segmentation']['unverified_threshold'],
+        'mean_score': float(np.mean(list(scores.values()))),
+        **count_pixels(merged_mask),
+    }
+    user_rows = [
+        {
+            'image_id': image_id, 'user_id': user_id, 'score': scores[user_id],
+            **count_pixels(final_mask),
+        }
+        for user_id, final_mask in zip(users, final_masks)
+    ]
+    return image_row, user_rows
+
+
+def _init_worker(project_file):
+    project.load_from(project_file)
+
+
+def _export_image(args):
+    return export_image(*args)
+
+
+def export_project(directory, format='png', workers=1, image_ids=None):
+    """Export the consensus masks and statistics of all images
+
+    Args:
+        directory: Output folder (created if necessary).
+        format: One of `EXPORT_FORMATS`.
+        workers: Number of worker processes (1: export in this process).
+        image_ids: Images to export (default: all).
+
+    Returns:
+        The number of exported images.
+
+    Raises:
+        ValueError if the format is unknown.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown export format '{format}'! Choose from: {', '.join(EXPORT_FORMATS)}"
+        )
+
+    os.makedirs(directory, exist_ok=True)
+    classes = [f"pixels_{klass['name']}" for klass in project['classes']]
+    tasks = ((image_id, directory, format) for image_id in image_ids or project.image_ids)
+
+    n_images = 0
+    with open(join(directory, 'images.csv'), 'w', newline='') as image_stream, \
+            open(join(directory, 'users.csv'), 'w', newline='') as user_stream:
+        image_table = csv.DictWriter(
+            image_stream, ['image_id', 'n_users', 'unverified', 'mean_score', *classes]
+        )
+        user_table = csv.DictWriter(user_stream, ['image_id', 'user_id', 'score', *classes])
+        image_table.writeheader()
+        user_table.writeheader()
+
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(project.file,))
+            results = pool.imap(_export_image, tasks)
+        else:
+            pool = None
+            results = map(_export_image, tasks)
+
+        try:
+            for image_row, user_rows in results:
+                if image_row is None:
+                    continue
+                image_table.writerow(image_row)
+                user_table.writerows(user_rows)
+                n_images += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    return n_images
@@ -0,0 +1,170 @@
+"""
+Asynchronous prediction jobs for the segmentation mode.
+
+Training a model can take several seconds. Running it inside the HTTP request
+blocks the (single threaded) production server for all other users, so the
+predictions can also be submitted as jobs to a separate worker pool. The client
+polls the status of its job and downloads the mask once it is finished.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job after it has been cancelled"""
+
+
+class PredictionJob:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, user_id, image_id, details=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.image_id = image_id
+        # Additional information for the client, e.g. the region of interest:
+        self.details = details or {}
+        self.status = self.QUEUED
+        self.progress = {'stage': 'queued'}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in (self.FINISHED, self.FAILED, self.CANCELLED)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            # The job has not started yet:
+            self.status = self.CANCELLED
+            self.finished = time.time()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f'Job {self.id} was cancelled')
+
+    def report(self, stage, **progress):
+        """Update the progress of the job (called from the worker)"""
+        self.raise_if_cancelled()
+        self.progress = {**self.progress, 'stage': stage, **progress}
+
+    def lightgbm_callback(self, env):
+        """Callback for LightGBM to report the boosting iterations"""
+        self.raise_if_cancelled()
+        self.progress = {
+            **self.progress,
+            'iteration': env.iteration + 1,
+            'n_iterations': env.end_iteration,
+        }
+
+    def run(self, function, *args, **kwargs):
+        if self.cancelled:
+            self.status = self.CANCELLED
+            self.finished = time.time()
+            return
+
+        self.status = self.RUNNING
+        self.started = time.time()
+        try:
+            self.result = function(*args, job=self, **kwargs)
+            self.status = self.FINISHED
+            self.progress = {**self.progress, 'stage': 'finished'}
+        except JobCancelled:
+            self.status = self.CANCELLED
+        except Exception as error:
+            print(f'Prediction job {self.id} failed:', error)
+            self.error = str(error)
+            self.status = self.FAILED
+        finally:
+            self.finished = time.time()
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'details': self.details,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """Run prediction jobs in a worker pool
+
+    Each user can only have one active job: submitting a new job cancels all
+    unfinished jobs of the same user. Finished jobs are kept for `keep_seconds`
+    so that the client can collect their results.
+    """
+    def __init__(self, max_workers=2, keep_seconds=600):
+        self.max_workers = max_workers
+        self.keep_seconds = keep_seconds
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='iris-predict'
+            )
+        return self._executor
+
+    def submit(self, user_id, image_id, function, args=(), kwargs=None, details=None):
+        """Submit a new job
+
+        Args:
+            user_id: Id of the user who owns the job.
+            image_id: Id of the image.
+            function: Callable doing the actual work. It gets the job as
+                keyword argument `job`; its return value becomes the result.
+            args: Positional arguments for the function.
+            kwargs: Keyword arguments for the function.
+            details: Optional dictionary with information for the client.
+
+        Returns:
+            The new PredictionJob.
+        """
+        job = PredictionJob(user_id, image_id, details)
+        with self._lock:
+            self._prune()
+            for other in self._jobs.values():
+                if other.user_id == user_id and not other.done:
+                    other.cancel()
+            self._jobs[job.id] = job
+            job.future = self.executor.submit(job.run, function, *args, **(kwargs or {}))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        expired = time.time() - self.keep_seconds
+        for job_id in [
+            job_id for job_id, job in self._jobs.items()
+            if job.done and job.finished < expired
+        ]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager()
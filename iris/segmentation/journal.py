@@ -0,0 +1,349 @@
+"""
+Append-only journal of all mask edits.
+
+Every save of a user mask appends one entry with the pixels which changed to
+the `journal.bin` data of the image in the mask store (with the file store:
+`<project>.iris/segmentation/<image_id>/journal.bin`). Entries of all users of
+an image share the journal. Each entry starts with
+
+    kind          uint8    0: changed pixels, 1: full masks
+    user_length   uint16   length of the user id
+    version       uint32   version of the mask after this save
+    timestamp     float64  time of the save (UNIX epoch)
+    payload_len   uint32   length of the payload
+
+followed by the UTF-8 user id and the payload:
+
+    kind 0:  count (uint32), count x uint32 pixel indices, count x uint8 class
+             ids, count x uint8 user mask values
+    kind 1:  final and user plane as in the IRMK mask format (see codec.py)
+
+Appending a save therefore costs O(changed pixels). Full entries are only
+written if the journal does not know the previous version of the mask (e.g.
+masks saved before the journal existed) or if most pixels changed.
+
+Replaying a long journal to restore a version would get slow, so a background
+thread writes a snapshot of the masks every `snapshot_interval` saves of a
+user to `journal/<user_id>_<version>.npz`. A restore starts from the latest
+snapshot before the requested version and only replays the entries after it.
+"""
+import io
+import json
+import re
+import struct
+import threading
+import time
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.codec import decode_plane, encode_plane
+from iris.segmentation.storage import get_mask_store, pack_user_mask, unpack_user_mask
+
+JOURNAL_NAME = 'journal.bin'
+INDEX_NAME = 'journal.json'
+SNAPSHOT_PREFIX = 'journal/'
+
+ENTRY_HEADER = struct.Struct('<BHIdI')
+ENTRY_PIXELS = 0
+ENTRY_FULL = 1
+
+
+def encode_entry(user_id, version, timestamp, old_masks, new_masks):
+    """Encode the journal entry for a save
+
+    Args:
+        user_id: Id of the user.
+        version: Version of the new mask.
+        timestamp: Time of the save.
+        old_masks: Tuple with the previous final and user mask or None if the
+            previous version is unknown.
+        new_masks: Tuple with the new final and user mask.
+
+    Returns:
+        Tuple with the encoded bytes and the number of changed pixels.
+    """
+    final_mask = np.asarray(new_masks[0], dtype=np.uint8).ravel()
+    user_mask = np.asarray(new_masks[1], dtype=np.uint8).ravel()
+
+    changed = None
+    if old_masks is not None:
+        changed = np.flatnonzero(
+            (np.asarray(old_masks[0], dtype=np.uint8).ravel() != final_mask)
+            | (np.asarray(old_masks[1], dtype=np.uint8).ravel() != user_mask)
+        )
+
+    # A pixel entry needs 6 bytes per changed pixel:
+    if changed is not None and 6 * len(changed) < final_mask.size:
+        kind = ENTRY_PIXELS
+        payload = b''.join([
+            struct.pack('<I', len(changed)), changed.astype('<u4').tobytes(),
+            final_mask[changed].tobytes(), user_mask[changed].tobytes(),
+        ])
+        n_changed = len(changed)
+    else:
+        kind = ENTRY_FULL
+        payload = encode_plane(final_mask) + encode_plane(user_mask)
+        n_changed = final_mask.size if changed is None else len(changed)
+
+    user_id = str(user_id).encode()
+    header = ENTRY_HEADER.pack(kind, len(user_id), version, timestamp, len(payload))
+    return header + user_id + payload, n_changed
+
+
+def read_entries(data, offset=0):
+    """Iterate over the entries of a journal
+
+    Yields:
+        Dictionaries with kind, user_id, version, timestamp, the payload and
+        the offset after the entry.
+    """
+    while offset + ENTRY_HEADER.size <= len(data):
+        kind, user_length, version, timestamp, payload_length = \
+            ENTRY_HEADER.unpack_from(data, offset)
+        start = offset + ENTRY_HEADER.size + user_length
+        end = start + payload_length
+        if end > len(data):
+            # Incomplete entry at the end (e.g. the server crashed):
+            return
+        yield {
+            'kind': kind,
+            'user_id': bytes(data[offset + ENTRY_HEADER.size:start]).decode(),
+            'version': version,
+            'timestamp': timestamp,
+            'payload': data[start:end],
+            'end': end,
+        }
+        offset = end
+
+
+def apply_entry(entry, final_mask, user_mask):
+    """Apply an entry to flattened masks (in-place)"""
+    payload = entry['payload']
+    if entry['kind'] == ENTRY_PIXELS:
+        count, = struct.unpack_from('<I', payload)
+        indices = np.frombuffer(payload, dtype='<u4', count=count, offset=4)
+        final_mask[indices] = np.frombuffer(
+            payload, dtype=np.uint8, count=count, offset=4 + 4*count
+        )
+        user_mask[indices] = np.frombuffer(
+            payload, dtype=np.uint8, count=count, offset=4 + 5*count
+        )
+    else:
+        final_mask[:], offset = decode_plane(payload, 0, final_mask.size)
+        user_mask[:], _ = decode_plane(payload, offset, user_mask.size)
+
+
+class MaskJournal:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._thread = None
+
+    @property
+    def config(self):
+        return project['segmentation']['journal']
+
+    @property
+    def enabled(self):
+        return self.config['enabled']
+
+    def get_snapshot_name(self, user_id, version):
+        return f'{SNAPSHOT_PREFIX}{user_id}_{version}.npz'
+
+    def read_index(self, image_id):
+        """Last journalled version and number of entries per user"""
+        data = get_mask_store().read_data(image_id, INDEX_NAME)
+        if data is None:
+            return {}
+        return json.loads(data)
+
+    def append(self, image_id, user_id, version, old_version, old_masks, new_masks):
+        """Append a save to the journal (call it under the image's lock)
+
+        Args:
+            image_id: Id of the image.
+            user_id: Id of the user.
+            version: Version of the new mask.
+            old_version: Version of the previous mask (0 if there was none).
+            old_masks: Tuple with the previous final and user mask or None.
+            new_masks: Tuple with the new final and user mask.
+        """
+        if not self.enabled:
+            return
+
+        user_id = str(user_id)
+        index = self.read_index(image_id)
+        user_index = index.get(user_id, {'version': 0, 'entries': 0})
+
+        if old_masks is None:
+            # The first mask is stored relative to an empty mask:
+            shape = np.shape(new_masks[0])
+            old_masks = (np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=bool))
+        elif user_id not in index or user_index['version'] != old_version:
+            # The journal does not know the previous mask (e.g. it was saved
+            # before the journal was enabled), so the full masks are stored:
+            old_masks = None
+
+        entry, n_changed = encode_entry(
+            user_id, version, time.time(), old_masks, new_masks
+        )
+        store = get_mask_store()
+        store.append_data(image_id, JOURNAL_NAME, entry)
+
+        user_index = {
+            'version': version,
+            'entries': user_index['entries'] + 1,
+            'changed_pixels': user_index.get('changed_pixels', 0) + n_changed,
+        }
+        index[user_id] = user_index
+        store.write_data(image_id, INDEX_NAME, json.dumps(index).encode())
+
+        if user_index['entries'] % self.config['snapshot_interval'] == 0:
+            self.schedule_snapshot(image_id, user_id, version, np.shape(new_masks[0]))
+
+    def read_journal(self, image_id):
+        return get_mask_store().read_data(image_id, JOURNAL_NAME) or b''
+
+    def get_history(self, image_id, user_id=None):
+        """Get all saves of an image (optionally only of one user)
+
+        Returns:
+            List of dictionaries with user_id, version, timestamp and kind.
+        """
+        return [
+            {
+                'user_id': entry['user_id'], 'version': entry['version'],
+                'timestamp': entry['timestamp'],
+                'kind': 'pixels' if entry['kind'] == ENTRY_PIXELS else 'full',
+            }
+            for entry in read_entries(self.read_journal(image_id))
+            if user_id is None or entry['user_id'] == str(user_id)
+        ]
+
+    def get_snapshots(self, image_id, user_id):
+        """Versions of all snapshots of a user (sorted)"""
+        pattern = re.compile(rf'^{re.escape(SNAPSHOT_PREFIX + str(user_id))}_(\d+)\.npz$')
+        names = get_mask_store().list_data(image_id, SNAPSHOT_PREFIX)
+        return sorted(
+            int(match.group(1)) for match in map(pattern.match, names) if match
+        )
+
+    def restore(self, image_id, user_id, version, mask_shape):
+        """Reconstruct the masks of a user at a previous version
+
+        Args:
+            image_id: Id of the image.
+            user_id: Id of the user.
+            version: The version to restore.
+            mask_shape: (height, width) of the mask area.
+
+        Returns:
+            The final mask (class ids) and the user mask.
+
+        Raises:
+            ValueError if the journal does not contain this version.
+        """
+        user_id = str(user_id)
+        final_mask = np.zeros(int(np.prod(mask_shape)), dtype=np.uint8)
+        user_mask = np.zeros(int(np.prod(mask_shape)), dtype=np.uint8)
+        offset = 0
+        found = False
+
+        snapshots = [v for v in self.get_snapshots(image_id, user_id) if v <= version]
+        if snapshots:
+            data = get_mask_store().read_data(
+                image_id, self.get_snapshot_name(user_id, snapshots[-1])
+            )
+            with np.load(io.BytesIO(data), allow_pickle=False) as snapshot:
+                final_mask[:] = snapshot['labels'].ravel()
+                user_mask[:] = unpack_user_mask(snapshot['user'], mask_shape).ravel()
+                offset = int(snapshot['offset'])
+            found = snapshots[-1] == version
+
+        if not found:
+            for entry in read_entries(self.read_journal(image_id), offset):
+                if entry['user_id'] != user_id or entry['version'] > version:
+                    continue
+                apply_entry(entry, final_mask, user_mask)
+                if entry['version'] == version:
+                    found = True
+                    break
+
+        if not found:
+            raise ValueError(f'Version {version} of the mask is not in the journal!')
+        return final_mask.reshape(mask_shape), user_mask.astype(bool).reshape(mask_shape)
+
+    def get_statistics(self, image_id):
+        """Time and edits each user spent on an image
+
+        Returns:
+            Dictionary with a dictionary per user: n_saves, first_save,
+            last_save, time_to_completion (seconds between first and last
+            save) and changed_pixels.
+        """
+        statistics = {}
+        for entry in self.get_history(image_id):
+            user = statistics.setdefault(entry['user_id'], {
+                'n_saves': 0, 'first_save': entry['timestamp'],
+            })
+            user['n_saves'] += 1
+            user['last_save'] = entry['timestamp']
+            user['time_to_completion'] = entry['timestamp'] - user['first_save']
+
+        for user_id, user_index in self.read_index(image_id).items():
+            if user_id in statistics:
+                statistics[user_id]['changed_pixels'] = user_index.get('changed_pixels', 0)
+        return statistics
+
+    def schedule_snapshot(self, image_id, user_id, version, mask_shape):
+        """Write a snapshot of a mask version in the background"""
+        with self._condition:
+            self._pending.add((image_id, user_id, version, tuple(mask_shape)))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name='iris-journal', daemon=True
+                )
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                image_id, user_id, version, mask_shape = self._pending.pop()
+
+            try:
+                self.write_snapshot(image_id, user_id, version, mask_shape)
+            except Exception as error:
+                print(f'Could not write snapshot of {image_id}:', error)
+
+    def write_snapshot(self, image_id, user_id, version, mask_shape):
+        """Compact the journal of a user up to a version into a snapshot"""
+        final_mask, user_mask = self.restore(image_id, user_id, version, mask_shape)
+
+        # The restore stopped at the entry of this version; continue after it:
+        offset = 0
+        for entry in read_entries(self.read_journal(image_id)):
+            if entry['user_id'] == str(user_id) and entry['version'] == version:
+                offset = entry['end']
+                break
+
+        stream = io.BytesIO()
+        np.savez_compressed(
+            stream, labels=final_mask, user=pack_user_mask(user_mask),
+            offset=np.array(offset),
+        )
+        get_mask_store().write_data(
+            image_id, self.get_snapshot_name(user_id, version), stream.getvalue()
+        )
+
+    def wait(self, timeout=None):
+        """Wait until all snapshots are written (mainly for tests)"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+mask_journal = MaskJournal()
@@ -0,0 +1,174 @@
+"""
+Debounced merging of the saved masks in the background.
+
+Annotators save their masks often (e.g. autosave), but the merged mask and the
+scores only need to be up to date eventually. `save_mask` therefore updates the
+vote counts of the image and queues the image here; the merge runs in a
+background thread after `segmentation : merge_delay` seconds without a new
+save, so a burst of saves leads to a single merge.
+
+Two per-image locks keep the saves of an image consistent without making them
+wait for its merge: `lock` serialises the writes to the masks and votes and is
+only held for short moments (the store write in `save_mask`, reading the votes
+and masks in `merge_image`), `merge_lock` serialises the merges (and remerges)
+of an image. Locks are dropped as soon as nobody holds or waits for them.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from iris.project import project
+from iris.segmentation.scheduler import POLL_INTERVAL, get_cooperative_gevent
+
+
+def _acquire(lock):
+    """Acquire a lock without blocking the gevent hub
+
+    The production server runs the request handlers as greenlets in the main
+    thread (without monkey patching), so a blocking acquire would stall all
+    requests while a background thread holds the lock. There, the lock is
+    polled instead.
+    """
+    gevent = get_cooperative_gevent()
+    if gevent is None:
+        lock.acquire()
+        return
+    while not lock.acquire(blocking=False):
+        gevent.sleep(POLL_INTERVAL)
+
+
+class MergeQueue:
+    # The merge of a busy image is delayed at most this many times merge_delay:
+    MAX_DELAYS = 5
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._status = {}
+        self._locks = {}
+        self._merge_locks = {}
+        self._thread = None
+
+    @property
+    def delay(self):
+        return project['segmentation'].get('merge_delay', 0)
+
+    @contextmanager
+    def _hold(self, locks, image_id):
+        """Hold the lock of an image and drop it when nobody needs it anymore"""
+        with self._condition:
+            entry = locks.setdefault(image_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            _acquire(entry[0])
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._condition:
+                entry[1] -= 1
+                if not entry[1]:
+                    del locks[image_id]
+
+    def lock(self, image_id):
+        """Serialise all writes to the masks and votes of an image"""
+        return self._hold(self._locks, image_id)
+
+    def merge_lock(self, image_id):
+        """Serialise the merges of an image"""
+        return self._hold(self._merge_locks, image_id)
+
+    def schedule(self, app, image_id):
+        """Queue the merge of an image (coalesced with pending merges)
+
+        Args:
+            app: The flask app (the worker needs its context for the database).
+            image_id: Id of the image.
+        """
+        now = time.time()
+        with self._condition:
+            first_queued = self._pending.get(image_id, (None, now))[1]
+            due = min(now + self.delay, first_queued + self.MAX_DELAYS * self.delay)
+            self._pending[image_id] = (due, first_queued)
+            status = self._status.setdefault(image_id, {'merged': None, 'error': None})
+            status.update(status='pending', queued=first_queued, due=due)
+            status['pending_saves'] = status.get('pending_saves', 0) + 1
+            self._condition.notify_all()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, args=(app,), name='iris-merge', daemon=True
+                )
+                self._thread.start()
+
+    def _next(self, wait=True):
+        """Get the next due image id (blocks until one is due) or None"""
+        with self._condition:
+            while self._pending:
+                image_id, (due, _) = min(self._pending.items(), key=lambda item: item[1][0])
+                if wait and due > time.time():
+                    self._condition.wait(due - time.time())
+                    continue
+                del self._pending[image_id]
+                return image_id
+            return None
+
+    def _work(self, app):
+        while True:
+            image_id = self._next()
+            if image_id is None:
+                with self._condition:
+                    if not self._pending:
+                        self._thread = None
+                        return
+                continue
+            with app.app_context():
+                self.merge(image_id)
+
+    def merge(self, image_id):
+        """Merge the masks of an image now (needs an app context)"""
+        # Imported here to avoid circular imports:
+        from iris.segmentation import merge_masks
+
+        with self.merge_lock(image_id):
+            with self._condition:
+                status = self._status.setdefault(image_id, {})
+                status.update(
+                    status='merging', started=time.time(),
+                    merged_saves=status.get('pending_saves', 0), pending_saves=0,
+                )
+            try:
+                merge_masks(image_id)
+                with self._condition:
+                    # The image might have been saved again in the meantime:
+                    self._status[image_id].update(
+                        status='pending' if image_id in self._pending else 'done',
+                        merged=time.time(), error=None,
+                    )
+            except Exception as error:
+                print(f'Could not merge the masks of {image_id}:', error)
+                self._set_status(image_id, status='failed', error=str(error))
+
+    def _set_status(self, image_id, **status):
+        with self._condition:
+            self._status.setdefault(image_id, {}).update(status)
+
+    def flush(self):
+        """Merge all queued images immediately (needs an app context)"""
+        while True:
+            image_id = self._next(wait=False)
+            if image_id is None:
+                return
+            self.merge(image_id)
+
+    def get_status(self, image_id):
+        """Merge status of an image"""
+        with self._condition:
+            status = dict(self._status.get(image_id, {}))
+        status.setdefault('status', 'idle')
+        status['image_id'] = image_id
+        return status
+
+
+merge_queue = MergeQueue()
@@ -0,0 +1,246 @@
+"""
+Background pre-labelling of images which nobody has annotated yet.
+
+A worker thread walks through the images in the order in which the annotators
+will receive them and predicts a draft mask for each of them, so that
+`/segmentation/load_mask` can offer a draft instead of an empty mask. The
+drafts only come from the project model: the features of its training samples
+are the features of the whole mask area, so it can predict any image. Models
+trained interactively by users are not used, they can depend on the user's
+feature configuration and may only have seen a region of interest.
+
+The queue is bounded: the worker only keeps `queue_size` drafts ready ahead of
+the annotators. It is resumable: the drafts and the model version they were
+made with are stored under `<project>.iris/drafts/`, so a restarted server only
+redoes drafts which are missing or outdated. It runs at low priority: before
+each draft it waits until the thread scheduler is idle and then only uses a
+single thread, so it never slows down interactive predictions.
+"""
+import json
+import os
+from os.path import exists, join
+import threading
+import time
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.ai import predict_chunks
+from iris.segmentation.project_model import get_image_features, project_model
+from iris.segmentation.scheduler import scheduler
+
+
+def get_annotation_order(users, annotated):
+    """Order of the images in which the annotators will probably receive them
+
+    Every user walks through the images in the order given by their image seed,
+    starting after the image they annotated last. The orders of all users are
+    interleaved, so that the next image of each user comes first.
+
+    Args:
+        users: List of (image_seed, last_image_id) tuples. last_image_id can be
+            None.
+        annotated: Set of image ids which already have masks.
+
+    Returns:
+        List of image ids without masks.
+    """
+    n_images = len(project.image_ids)
+    orders = []
+    for image_seed, last_image_id in users or [(0, None)]:
+        order = list(range(n_images))
+        np.random.RandomState(seed=image_seed).shuffle(order)
+        if last_image_id in project.image_ids:
+            start = order.index(project.image_ids.index(last_image_id)) + 1
+            order = order[start:] + order[:start]
+        orders.append(order)
+
+    image_ids = []
+    seen = set()
+    for position in range(n_images):
+        for order in orders:
+            image_id = project.image_ids[order[position]]
+            if image_id not in seen and image_id not in annotated:
+                seen.add(image_id)
+                image_ids.append(image_id)
+    return image_ids
+
+
+class Prelabeller:
+    def __init__(self, poll_interval=1.):
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._pending = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        return project['segmentation']['prelabelling']
+
+    @property
+    def enabled(self):
+        return self.config['enabled']
+
+    @property
+    def directory(self):
+        return join(project['path'], 'drafts')
+
+    @property
+    def state_file(self):
+        return join(self.directory, 'drafts.json')
+
+    def get_draft_file(self, image_id):
+        return join(self.directory, f'{image_id}.npy')
+
+    def read_state(self):
+        """Get the model version of each draft"""
+        if not exists(self.state_file):
+            return {}
+        with open(self.state_file) as stream:
+            return json.load(stream)
+
+    def write_state(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.state_file + '.tmp', 'w') as stream:
+            json.dump(state, stream)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def read_draft(self, image_id, current=False):
+        """Get the draft mask of an image (H x W uint8) or None
+
+        Args:
+            image_id: Id of the image.
+            current: Only return the draft if it was made with the current
+                project model.
+        """
+        filename = self.get_draft_file(image_id)
+        if not exists(filename):
+            return None
+        if current and self.read_state().get(image_id) != f'project:{project_model.version}':
+            return None
+        return np.load(filename, allow_pickle=False)
+
+    def discard(self, image_id):
+        """Remove the draft of an image (e.g. after it got a real mask)"""
+        with self._lock:
+            state = self.read_state()
+            if state.pop(image_id, None) is not None:
+                self.write_state(state)
+            if exists(self.get_draft_file(image_id)):
+                os.remove(self.get_draft_file(image_id))
+
+    def wake(self, app):
+        """Let the worker fill up the queue of drafts
+
+        Args:
+            app: The flask app (the worker needs its context for the database).
+        """
+        if not self.enabled:
+            return
+
+        with self._condition:
+            self._pending = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, args=(app,), name='iris-prelabel',
+                    daemon=True
+                )
+                self._thread.start()
+
+    def _work(self, app):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+
+            try:
+                with app.app_context():
+                    image_ids = self.get_queue()
+                self.fill(image_ids)
+            except Exception as error:
+                print('Could not pre-label images:', error)
+
+    def get_queue(self):
+        """Images without masks in the order of the annotators"""
+        from iris.models import Action, User, db
+
+        annotated = {
+            image_id for image_id, in
+            db.session.query(Action.image_id).filter_by(type='segmentation').distinct()
+        }
+        users = []
+        for user in User.query.all():
+            last_action = user.actions.filter_by(type='segmentation')\
+                .order_by(Action.last_modification.desc()).first()
+            users.append((
+                user.image_seed, last_action.image_id if last_action else None
+            ))
+        return get_annotation_order(users, annotated)
+
+    def get_model(self):
+        """Get the model for the drafts and its version (or None, None)"""
+        model = project_model.load()
+        if model is None:
+            return None, None
+        return model, f'project:{project_model.version}'
+
+    def fill(self, image_ids):
+        """Make sure that the next `queue_size` images have current drafts"""
+        n_ready = 0
+        for image_id in image_ids:
+            if n_ready >= self.config['queue_size']:
+                break
+
+            model, version = self.get_model()
+            if model is None:
+                return
+            if self.read_state().get(image_id) == version \
+                    and exists(self.get_draft_file(image_id)):
+                n_ready += 1
+                continue
+
+            self.wait_until_idle()
+            if self._pending:
+                # The queue has changed, e.g. a new mask was saved:
+                return
+
+            self.make_draft(image_id, model, version)
+            n_ready += 1
+
+    def wait_until_idle(self):
+        """Block until no interactive job is running or waiting"""
+        while not scheduler.idle:
+            time.sleep(self.poll_interval)
+
+    def make_draft(self, image_id, model, version):
+        features = get_image_features(image_id, project['segmentation']['ai_model'])
+        with scheduler.slot(name=f'prelabel {image_id}', max_threads=1) as n_threads:
+            predictions, _ = predict_chunks(
+                model, features,
+                chunk_size=project['compute']['inference_chunk_size'],
+                n_threads=n_threads,
+            )
+
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.get_draft_file(image_id)
+        np.save(
+            filename + '.tmp.npy', predictions.reshape(features.shape),
+            allow_pickle=False
+        )
+        with self._lock:
+            os.replace(filename + '.tmp.npy', filename)
+            state = self.read_state()
+            state[image_id] = version
+            self.write_state(state)
+
+    def wait(self, timeout=None):
+        """Wait until the queue is filled (mainly for tests)"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+prelabeller = Prelabeller()
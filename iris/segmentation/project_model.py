@@ -0,0 +1,315 @@
+"""
+Project-wide AI model trained on all saved masks.
+
+The per-image models from `predict_mask` only know the image they were trained
+on. The project model learns from the masks of all images instead, so it can
+provide a draft mask for images which nobody has annotated yet.
+
+Training happens in a background thread after masks were saved. Like the
+merges (see `merge_queue`), the refits are debounced: the model is updated
+`project_model : refit_delay` seconds after the last save, so a burst of saves
+leads to a single refit. For each image, a class-balanced sample of labelled
+feature rows is kept under `<project>.iris/models/samples/`, so an update only
+has to sample the images whose masks changed before the model is refitted on
+all samples. Refits are background work: they wait until no interactive job
+is running or waiting and then use at most `MAX_THREADS` threads. The model
+itself is persisted as LightGBM text file under `<project>.iris/models/`.
+Predictions are cached per image and model version.
+"""
+from collections import OrderedDict
+import json
+import os
+from os.path import exists, getmtime, join
+import threading
+import time
+
+import lightgbm as lgb
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.ai import (
+    PixelFeatures, image_dict_to_array, predict_chunks, sample_training_pixels
+)
+from iris.segmentation.scheduler import scheduler
+
+
+class LoadedModel:
+    """Classifier interface (as used by predict_chunks) for a saved booster"""
+    def __init__(self, booster, classes):
+        self.booster = booster
+        self.classes_ = np.asarray(classes)
+
+    def predict_proba(self, X, num_threads=1, **kwargs):
+        probabilities = self.booster.predict(X, num_threads=num_threads, **kwargs)
+        if probabilities.ndim == 1:
+            # Binary objective only gives the probability of the second class:
+            probabilities = np.stack([1 - probabilities, probabilities], axis=-1)
+        return probabilities
+
+
+def get_image_features(image_id, ai_config):
+    """Get the features of the mask area of an image"""
+    image = image_dict_to_array(
+        project.get_image(image_id, bands=ai_config['bands'])
+    )
+    mask_area = project['segmentation']['mask_area']
+    image = image[mask_area[1]:mask_area[3], mask_area[0]:mask_area[2]]
+    return PixelFeatures(image, ai_config)
+
+
+class ProjectModel:
+    # A refit is delayed at most this many times refit_delay by further saves:
+    MAX_DELAYS = 5
+    # Number of predictions which are kept in memory:
+    MAX_PREDICTIONS = 16
+    # Threads of a refit (interactive predictions get the rest of the budget):
+    MAX_THREADS = 2
+
+    def __init__(self, poll_interval=1.):
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._pending = set()
+        self._first_scheduled = None
+        self._due = None
+        self._thread = None
+        self._model = None
+        self._model_mtime = None
+        self._predictions = OrderedDict()
+
+    @property
+    def config(self):
+        return project['segmentation']['project_model']
+
+    @property
+    def enabled(self):
+        return self.config['enabled']
+
+    @property
+    def delay(self):
+        return self.config.get('refit_delay', 0)
+
+    @property
+    def directory(self):
+        return join(project['path'], 'models')
+
+    @property
+    def model_file(self):
+        return join(self.directory, 'project_model.txt')
+
+    @property
+    def info_file(self):
+        return join(self.directory, 'project_model.json')
+
+    def get_sample_file(self, image_id):
+        return join(self.directory, 'samples', f'{image_id}.npz')
+
+    def schedule(self, image_id):
+        """Update the model in the background with the masks of this image
+
+        The update is coalesced with all updates scheduled before it starts.
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._condition:
+            if not self._pending:
+                self._first_scheduled = now
+            self._due = min(
+                now + self.delay, self._first_scheduled + self.MAX_DELAYS * self.delay
+            )
+            self._pending.add(image_id)
+            self._condition.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name='iris-project-model', daemon=True
+                )
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._pending and self._due > time.time():
+                    self._condition.wait(self._due - time.time())
+                if not self._pending:
+                    self._thread = None
+                    return
+                image_ids, self._pending = self._pending, set()
+
+            try:
+                self.wait_until_idle()
+                for image_id in sorted(image_ids):
+                    self.update_samples(image_id)
+                self.train()
+            except Exception as error:
+                print('Could not update the project model:', error)
+
+    def wait_until_idle(self):
+        """Block until no interactive job is running or waiting"""
+        while not scheduler.idle:
+            time.sleep(self.poll_interval)
+
+    def update_samples(self, image_id):
+        """Sample labelled feature rows from all masks of an image"""
+        # Imported here to avoid circular imports:
+        from iris.segmentation import get_mask_users, read_masks
+
+        ai_config = project['segmentation']['ai_model']
+        indices, labels = [], []
+        for user_id in get_mask_users(image_id):
+            final_mask, _ = read_masks(image_id, user_id)
+            user_labels = final_mask.ravel()
+            user_indices, _, user_labels, _ = sample_training_pixels(
+                np.arange(len(user_labels)), user_labels,
+                max_pixels=self.config['pixels_per_image'], train_ratio=1.,
+                seed=len(indices),
+            )
+            indices.append(user_indices)
+            labels.append(user_labels)
+
+        filename = self.get_sample_file(image_id)
+        if not indices:
+            if exists(filename):
+                os.remove(filename)
+            return
+
+        features = get_image_features(image_id, ai_config)
+        indices = np.concatenate(indices)
+        os.makedirs(join(self.directory, 'samples'), exist_ok=True)
+        # Write to a temporary file first, so that the training never reads a
+        # half-written sample:
+        temporary = filename + '.tmp.npz'
+        np.savez_compressed(
+            temporary, features=features.rows(indices),
+            labels=np.concatenate(labels).astype(np.uint8)
+        )
+        os.replace(temporary, filename)
+
+    def train(self):
+        """Fit the model on the samples of all images and save it"""
+        samples_dir = join(self.directory, 'samples')
+        if not exists(samples_dir):
+            return
+
+        features, labels, image_ids = [], [], []
+        for filename in sorted(os.listdir(samples_dir)):
+            if not filename.endswith('.npz') or '.tmp.' in filename:
+                continue
+            with np.load(join(samples_dir, filename)) as sample:
+                features.append(sample['features'])
+                labels.append(sample['labels'])
+            image_ids.append(filename[:-len('.npz')])
+
+        if not labels or len(np.unique(np.concatenate(labels))) < 2:
+            return
+
+        features = np.concatenate(features)
+        labels = np.concatenate(labels)
+        train_indices, val_indices, train_labels, val_labels = sample_training_pixels(
+            np.arange(len(labels)), labels,
+            max_pixels=self.config['max_train_pixels'],
+            train_ratio=project['segmentation']['ai_model']['train_ratio'],
+            seed=0,
+        )
+
+        ai_config = project['segmentation']['ai_model']
+        callbacks, fit_options = [], {}
+        if len(val_indices):
+            callbacks.append(lgb.early_stopping(4, verbose=False))
+            fit_options['eval_set'] = [(features[val_indices], val_labels)]
+
+        started = time.time()
+        with scheduler.slot(name='project model', max_threads=self.MAX_THREADS) as n_threads:
+            gbm = lgb.LGBMClassifier(
+                num_leaves=ai_config['n_leaves'],
+                max_bin=128,
+                max_depth=ai_config['max_depth'],
+                learning_rate=0.05,
+                n_estimators=ai_config['n_estimators'],
+                n_jobs=n_threads,
+                verbose=-1,
+            )
+            gbm.fit(
+                features[train_indices], train_labels,
+                callbacks=callbacks, **fit_options
+            )
+
+        os.makedirs(self.directory, exist_ok=True)
+        gbm.booster_.save_model(
+            self.model_file + '.tmp', num_iteration=gbm.best_iteration_ or None
+        )
+        with open(self.info_file + '.tmp', 'w') as stream:
+            json.dump({
+                'classes': gbm.classes_.tolist(),
+                'image_ids': image_ids,
+                'n_train_pixels': len(train_indices),
+                'training_time': round(time.time() - started, 3),
+                'updated': time.time(),
+            }, stream)
+        os.replace(self.info_file + '.tmp', self.info_file)
+        os.replace(self.model_file + '.tmp', self.model_file)
+
+    def load(self):
+        """Get the saved model (reloaded if the file changed), or None"""
+        if not exists(self.model_file) or not exists(self.info_file):
+            return None
+
+        mtime = getmtime(self.model_file)
+        if self._model is None or mtime != self._model_mtime:
+            with open(self.info_file) as stream:
+                info = json.load(stream)
+            booster = lgb.Booster(model_file=self.model_file)
+            self._model = LoadedModel(booster, info['classes'])
+            self._model_mtime = mtime
+        return self._model
+
+    @property
+    def version(self):
+        """Version of the saved model (None if there is none yet)"""
+        if not exists(self.model_file):
+            return None
+        return getmtime(self.model_file)
+
+    def predict(self, image_id, max_threads=None):
+        """Predict a draft mask for an image
+
+        Args:
+            image_id: Id of the image.
+            max_threads: Optional limit for the number of threads.
+
+        Returns:
+            1D uint8 array with the class ids of the mask area or None if there
+            is no project model yet.
+        """
+        model = self.load()
+        if model is None:
+            return None
+
+        key = (self.model_file, self._model_mtime, image_id)
+        with self._condition:
+            if key in self._predictions:
+                self._predictions.move_to_end(key)
+                return self._predictions[key]
+
+        features = get_image_features(image_id, project['segmentation']['ai_model'])
+        with scheduler.slot(name=f'draft {image_id}', max_threads=max_threads) as n_threads:
+            predictions, _ = predict_chunks(
+                model, features,
+                chunk_size=project['compute']['inference_chunk_size'],
+                n_threads=n_threads,
+            )
+
+        with self._condition:
+            self._predictions[key] = predictions
+            while len(self._predictions) > self.MAX_PREDICTIONS:
+                self._predictions.popitem(last=False)
+        return predictions
+
+    def wait(self, timeout=None):
+        """Wait until all scheduled updates are done (mainly for tests)"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+project_model = ProjectModel()
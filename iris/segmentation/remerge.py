@@ -0,0 +1,164 @@
+"""
+Re-merge and re-score all annotated images.
+
+`merge_masks` only runs after a save, so changing `segmentation : score`,
+`unverified_threshold` or `mask_encoding` only affects images which are saved
+afterwards. A remerge merges the masks of every image with saved masks again,
+rewrites the merged masks and recomputes `Action.score` and
+`Action.unverified` of all users.
+
+The images are merged in parallel by `merge_image`, which does not need the
+database. The scores are committed in batches from the calling thread. Run
+from the command line (`iris remerge`), the images are merged in worker
+processes, so the server should not be running at the same time. Started from
+the admin API, the merges run in threads of the server which take the
+per-image merge locks of the merge queue, so they cannot interfere with the
+merges after saves.
+"""
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from iris.project import project
+from iris.segmentation.merge_queue import merge_queue
+from iris.segmentation.storage import get_mask_store
+
+
+def _init_worker(project_file):
+    project.load_from(project_file)
+
+
+def _merge(image_id, lock=False):
+    """Merge one image and catch errors (they are reported, not raised)"""
+    # Imported here to avoid circular imports:
+    from iris.segmentation import merge_image
+
+    try:
+        if lock:
+            with merge_queue.merge_lock(image_id):
+                return image_id, merge_image(image_id), None
+        return image_id, merge_image(image_id), None
+    except Exception as error:
+        return image_id, None, str(error)
+
+
+def _merge_locked(image_id):
+    return _merge(image_id, lock=True)
+
+
+class Remerger:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = {'status': 'idle'}
+        self._thread = None
+
+    def get_status(self):
+        with self._lock:
+            return dict(self._status)
+
+    def _set_status(self, **status):
+        with self._lock:
+            self._status.update(status)
+
+    def run(self, workers=1, batch_size=50, processes=True, image_ids=None, progress=None):
+        """Re-merge all images with saved masks (needs an app context)
+
+        Args:
+            workers: Number of parallel merges.
+            batch_size: Number of images whose scores are committed together.
+            processes: Merge in worker processes (True) or in threads which
+                take the per-image merge locks (False).
+            image_ids: Images to merge (default: all with saved masks).
+            progress: Optional callback which gets the number of merged and
+                the total number of images after each committed batch.
+
+        Returns:
+            The final status with the number of merged images and the images
+            which failed (with their errors).
+        """
+        # Imported here to avoid circular imports:
+        from iris.segmentation import update_scores
+
+        if image_ids is None:
+            image_ids = sorted({image_id for image_id, _ in get_mask_store().items()})
+        with self._lock:
+            self._status = {
+                'status': 'running', 'total': len(image_ids), 'done': 0,
+                'failed': {}, 'started': time.time(),
+            }
+
+        if processes and workers > 1:
+            pool = Pool(workers, initializer=_init_worker, initargs=(project.file,))
+            task = _merge
+        else:
+            pool = ThreadPool(workers)
+            task = _merge_locked
+
+        batch = {}
+        failed = {}
+        n_done = 0
+
+        def commit():
+            nonlocal batch
+            if batch:
+                update_scores(batch)
+            self._set_status(done=n_done, failed=dict(failed))
+            if progress is not None:
+                progress(n_done, len(image_ids))
+            batch = {}
+
+        try:
+            for image_id, result, error in pool.imap_unordered(task, image_ids):
+                n_done += 1
+                if error is None:
+                    batch[image_id] = result
+                else:
+                    print(f'Could not merge the masks of {image_id}:', error)
+                    failed[image_id] = error
+                if len(batch) >= batch_size:
+                    commit()
+            if batch or self.get_status()['done'] != n_done or not image_ids:
+                commit()
+        except Exception as error:
+            self._set_status(status='failed', error=str(error), finished=time.time())
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self._set_status(status='done', finished=time.time())
+        return self.get_status()
+
+    def start(self, app, workers=1, batch_size=50):
+        """Run a remerge in a background thread of the server
+
+        Returns:
+            False if a remerge is already running.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._status = {'status': 'running', 'total': None, 'done': 0}
+            self._thread = threading.Thread(
+                target=self._work, args=(app, workers, batch_size),
+                name='iris-remerge', daemon=True
+            )
+            self._thread.start()
+        return True
+
+    def _work(self, app, workers, batch_size):
+        with app.app_context():
+            try:
+                self.run(workers=workers, batch_size=batch_size, processes=False)
+            except Exception as error:
+                print('Remerge failed:', error)
+
+    def wait(self, timeout=None):
+        """Wait until a remerge in the background is finished"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+remerger = Remerger()
@@ -0,0 +1,167 @@
+"""
+Server-wide CPU budget for training and inference.
+
+LightGBM uses OpenMP threads for fitting and predicting. If every request
+started as many threads as it liked, concurrent users would oversubscribe the
+CPU and all of them would become slow. The scheduler hands out thread slots
+from a fixed budget (`compute : thread_budget` in the project config) and lets
+jobs wait in FIFO order when the budget is used up. A single job gets at most
+half of the budget by default, so one job cannot make all others wait.
+
+The production server runs the request handlers as greenlets in the main
+thread (gevent without monkey patching). There, blocking on a lock or a
+condition would stall all requests, so waiting request handlers poll and
+yield to the gevent hub instead (see `get_cooperative_gevent`).
+"""
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import os
+import sys
+import threading
+import time
+
+from iris.project import project
+
+# Seconds between two checks while a greenlet waits:
+POLL_INTERVAL = 0.005
+
+
+def get_cooperative_gevent():
+    """Get the gevent module if waiting has to yield to the gevent hub
+
+    Returns:
+        The gevent module if gevent is used and this is the thread of its hub
+        (the main thread), otherwise None (blocking waits are fine).
+    """
+    gevent = sys.modules.get('gevent')
+    if gevent is None or threading.current_thread() is not threading.main_thread():
+        return None
+    return gevent
+
+
+def call_cooperatively(function, *args, **kwargs):
+    """Call a long running function without blocking the gevent hub
+
+    Under gevent, the function runs in the thread pool of the hub while the
+    calling greenlet waits cooperatively. Otherwise, it is simply called.
+    """
+    gevent = get_cooperative_gevent()
+    if gevent is None:
+        return function(*args, **kwargs)
+    return gevent.get_hub().threadpool.apply(function, args, kwargs)
+
+
+class ThreadScheduler:
+    def __init__(self, history=100):
+        self._condition = threading.Condition()
+        self._in_use = 0
+        self._running = {}
+        self._waiting = deque()
+        self._ids = itertools.count()
+        self._history = deque(maxlen=history)
+        self._totals = {'jobs': 0, 'wait_time': 0., 'run_time': 0.}
+
+    @property
+    def budget(self):
+        budget = project.config.get('compute', {}).get('thread_budget')
+        return budget or os.cpu_count() or 1
+
+    @property
+    def max_threads_per_job(self):
+        max_threads = project.config.get('compute', {}).get('max_threads_per_job')
+        return min(max_threads or max(1, self.budget // 2), self.budget)
+
+    def _share(self, max_threads=None):
+        """Number of threads the next waiting job would get right now"""
+        free = self.budget - self._in_use
+        n_jobs = len(self._running) + len(self._waiting)
+        fair_share = max(1, self.budget // max(n_jobs, 1))
+        return min(free, fair_share, max_threads or self.max_threads_per_job)
+
+    @property
+    def idle(self):
+        """True if no job is running or waiting"""
+        with self._condition:
+            return not self._running and not self._waiting
+
+    @contextmanager
+    def slot(self, name='', max_threads=None):
+        """Reserve threads for a job
+
+        Blocks until threads are free and the job is first in the queue.
+
+        Args:
+            name: Label of the job for the metrics.
+            max_threads: Optional lower limit than `max_threads_per_job`,
+                e.g. for background work.
+
+        Yields:
+            The number of threads the job may use.
+        """
+        job_id = next(self._ids)
+        queued = time.time()
+        with self._condition:
+            self._waiting.append(job_id)
+            while self._waiting[0] != job_id or self._share() < 1:
+                self._wait()
+            self._waiting.popleft()
+            n_threads = self._share(max_threads)
+            self._in_use += n_threads
+            self._running[job_id] = n_threads
+            # The next job in the queue might still fit into the budget:
+            self._condition.notify_all()
+
+        started = time.time()
+        try:
+            yield n_threads
+        finally:
+            finished = time.time()
+            with self._condition:
+                self._in_use -= n_threads
+                del self._running[job_id]
+                self._record(name, n_threads, started - queued, finished - started)
+                self._condition.notify_all()
+
+    def _wait(self):
+        """Wait for a change of the slots (call it with the condition held)"""
+        gevent = get_cooperative_gevent()
+        if gevent is None:
+            self._condition.wait()
+            return
+        self._condition.release()
+        try:
+            gevent.sleep(POLL_INTERVAL)
+        finally:
+            self._condition.acquire()
+
+    def _record(self, name, n_threads, wait_time, run_time):
+        self._history.append({
+            'name': name,
+            'n_threads': n_threads,
+            'wait_time': round(wait_time, 4),
+            'run_time': round(run_time, 4),
+            'finished': time.time(),
+        })
+        self._totals['jobs'] += 1
+        self._totals['wait_time'] += wait_time
+        self._totals['run_time'] += run_time
+
+    def stats(self):
+        """Current load and the metrics of the last jobs"""
+        with self._condition:
+            n_jobs = self._totals['jobs']
+            return {
+                'thread_budget': self.budget,
+                'max_threads_per_job': self.max_threads_per_job,
+                'threads_in_use': self._in_use,
+                'running_jobs': len(self._running),
+                'waiting_jobs': len(self._waiting),
+                'total_jobs': n_jobs,
+                'mean_wait_time': self._totals['wait_time'] / n_jobs if n_jobs else 0.,
+                'mean_run_time': self._totals['run_time'] / n_jobs if n_jobs else 0.,
+                'recent_jobs': list(self._history),
+            }
+
+
+scheduler = ThreadScheduler()
@@ -1147,6 +1147,11 @@ async function load_mask(){
         vars.user_mask.fill(0);
     }
 
+    // Later saves only upload what changed compared to this version:
+    vars.mask_version = parseInt(results.response.headers.get("X-IRIS-Mask-Version") || "0");
+    vars.saved_mask = vars.mask.slice();
+    vars.saved_user_mask = vars.user_mask.slice();
+
     set_mask_type(vars.mask_type);
     hide_loader();
     update_drawn_pixels();
@@ -1280,15 +1285,31 @@ function save_mask(call_afterwards=null){
         return;
     }
 
-    // Combine both masks together to one byte array only with padding magic
-    // numbers 254 to make sure the transaction was done successfully
     var m_length = vars.mask_shape[0]*vars.mask_shape[1];
-    var data = new Uint8Array(2*m_length+2);
-    var padding = new Uint8Array([254]);
-    data.set(padding);
-    data.set(vars.mask, 1);
-    data.set(vars.user_mask, m_length+1);
-    data.set(padding, 2*m_length+1);
+    var sent_mask = vars.mask.slice();
+    var sent_user_mask = vars.user_mask.slice();
+    var data;
+    if (vars.mask_version > 0 && vars.saved_mask){
+        // Only send the rectangle which changed since the last save:
+        let rect = get_changed_rect(vars.saved_mask, vars.saved_user_mask);
+        if (rect === null){
+            show_message('Mask saved', 1000);
+            if(call_afterwards !== null){
+              call_afterwards();
+            }
+            return;
+        }
+        data = encode_mask_patch(rect, vars.mask_version);
+    } else {
+        // Combine both masks together to one byte array only with padding magic
+        // numbers 254 to make sure the transaction was done successfully
+        data = new Uint8Array(2*m_length+2);
+        var padding = new Uint8Array([254]);
+        data.set(padding);
+        data.set(sent_mask, 1);
+        data.set(sent_user_mask, m_length+1);
+        data.set(padding, 2*m_length+1);
+    }
 
     fetch(vars.url.segmentation+"save_mask/" + vars.image_id, {
         method: "POST",
@@ -1296,7 +1317,93 @@ function save_mask(call_afterwards=null){
         headers: {
             "Content-Type": "application/octet-stream"
         }
-    }).then((response) => {save_mask_finished(response, call_afterwards);});
+    }).then((response) => {
+        if (response.status === 409){
+            // The mask was changed elsewhere, send the full mask instead:
+            vars.mask_version = 0;
+            save_mask(call_afterwards);
+            return;
+        }
+        if (response.status === 200){
+            vars.mask_version = parseInt(response.headers.get("X-IRIS-Mask-Version") || "0");
+            vars.saved_mask = sent_mask;
+            vars.saved_user_mask = sent_user_mask;
+        }
+        save_mask_finished(response, call_afterwards);
+    });
+}
+
+function get_changed_rect(saved_mask, saved_user_mask){
+    // Bounding box [x, y, width, height] of all changed pixels or null
+    let width = vars.mask_shape[0];
+    let x0 = width, y0 = vars.mask_shape[1], x1 = -1, y1 = -1;
+    for (let i = 0; i < vars.mask.length; i++){
+        if (vars.mask[i] != saved_mask[i] || vars.user_mask[i] != saved_user_mask[i]){
+            let x = i % width, y = Math.floor(i / width);
+            x0 = Math.min(x0, x); x1 = Math.max(x1, x);
+            y0 = Math.min(y0, y); y1 = Math.max(y1, y);
+        }
+    }
+    if (x1 < 0){
+        return null;
+    }
+    return [x0, y0, x1-x0+1, y1-y0+1];
+}
+
+function encode_plane(values){
+    // Run-length encoded plane (see iris/segmentation/codec.py)
+    let lengths = [], runs = [];
+    for (let i = 0; i < values.length; i++){
+        if (runs.length && runs[runs.length-1] == values[i]){
+            lengths[lengths.length-1]++;
+        } else {
+            lengths.push(1);
+            runs.push(values[i]);
+        }
+    }
+    let n = runs.length;
+    let buffer = new ArrayBuffer(5 + 5*n);
+    let view = new DataView(buffer);
+    view.setUint8(0, 1); // encoding: run-length
+    view.setUint32(1, 5*n, true);
+    for (let i = 0; i < n; i++){
+        view.setUint32(5 + 4*i, lengths[i], true);
+    }
+    new Uint8Array(buffer, 5 + 4*n, n).set(runs);
+    return new Uint8Array(buffer);
+}
+
+function encode_mask_patch(rect, base_version){
+    // Patch with one rectangle in the versioned mask format (IRMK, see
+    // iris/segmentation/codec.py)
+    let [x, y, w, h] = rect;
+    let width = vars.mask_shape[0];
+    let final_values = new Uint8Array(w*h);
+    let user_values = new Uint8Array(w*h);
+    for (let row = 0; row < h; row++){
+        let start = (y+row)*width + x;
+        final_values.set(vars.mask.subarray(start, start+w), row*w);
+        user_values.set(vars.user_mask.subarray(start, start+w), row*w);
+    }
+    let final_plane = encode_plane(final_values);
+    let user_plane = encode_plane(user_values);
+
+    let data = new Uint8Array(20 + 16 + final_plane.length + user_plane.length);
+    let header = new DataView(data.buffer);
+    data.set([73, 82, 77, 75]); // IRMK
+    header.setUint8(4, 1); // version
+    header.setUint8(5, 1); // kind: patch
+    header.setUint16(6, 1, true); // one rectangle
+    header.setUint32(8, base_version, true);
+    header.setUint32(12, vars.mask_shape[1], true);
+    header.setUint32(16, width, true);
+    header.setUint32(20, x, true);
+    header.setUint32(24, y, true);
+    header.setUint32(28, w, true);
+    header.setUint32(32, h, true);
+    data.set(final_plane, 36);
+    data.set(user_plane, 36 + final_plane.length);
+    return data;
 }
 
 async function save_mask_finished(response, call_afterwards){
@@ -1316,6 +1423,78 @@ async function save_mask_finished(response, call_afterwards){
     }
 }
 
+function encode_training_pixels(pixels, labels){
+    // Binary format of the training pixels (see iris/segmentation/codec.py):
+    // 12 bytes header, uint32 pixel indices and uint8 labels (little-endian)
+    let n = pixels.length;
+    let buffer = new ArrayBuffer(12 + 5*n);
+    let header = new DataView(buffer, 0, 12);
+    header.setUint8(0, 73); // I
+    header.setUint8(1, 82); // R
+    header.setUint8(2, 80); // P
+    header.setUint8(3, 88); // X
+    header.setUint8(4, 1); // version
+    header.setUint8(5, 0); // encoding: pixel list
+    header.setUint16(6, 0, true); // no options
+    header.setUint32(8, n, true);
+    let indices = new DataView(buffer, 12, 4*n);
+    for (let i = 0; i < n; i++){
+        indices.setUint32(4*i, pixels[i], true);
+    }
+    new Uint8Array(buffer, 12 + 4*n, n).set(labels);
+    return buffer;
+}
+
+function predict_job_message(job){
+    let progress = job.progress;
+    if (progress.stage == "queued" || progress.stage == "waiting"){
+        return "Wait for the server...";
+    } else if (progress.stage == "features"){
+        return "Prepare training data...";
+    } else if (progress.stage == "training" && progress.n_iterations){
+        return "Train AI... (" + progress.iteration + "/" + progress.n_iterations + ")";
+    } else if (progress.stage == "predicting"){
+        return "Predict mask...";
+    }
+    return "Train AI...";
+}
+
+// Trains and predicts in a background job on the server and polls its status
+// until it has finished. Returns the result like download() does.
+async function run_predict_job(body){
+    let url = vars.url.segmentation + "api/predict-jobs/";
+    let response = await fetch(url + vars.image_id, {
+        method: "POST",
+        body: body,
+        headers: {
+            "Content-Type": "application/octet-stream"
+        }
+    });
+
+    while (true){
+        if (response.status >= 400){
+            if (response.status == 403) {
+                dialogue_login();
+            }
+            return {"response": response, "data": null};
+        }
+
+        let job = (await response.json()).job;
+        if (job.status == "finished"){
+            return await download(url + job.id + "/result");
+        } else if (job.status == "cancelled"){
+            return {"response": {"status": 409}, "data": null};
+        } else if (job.status == "failed"){
+            console.log("Prediction job failed: " + job.error);
+            return {"response": {"status": 500}, "data": null};
+        }
+
+        show_loader(predict_job_message(job));
+        await new Promise(resolve => setTimeout(resolve, 500));
+        response = await fetch(url + job.id);
+    }
+}
+
 async function predict_mask(){
     var user_classes = [];
     for (var i=0; i < vars.classes.length; i++){
@@ -1390,19 +1569,16 @@ async function predict_mask(){
     }
 
     show_loader("Train AI...");
-    let results = await download(
-            vars.url.segmentation+"predict_mask/" + vars.image_id,
-            {
-                method: "POST",
-                body: JSON.stringify({
-                    "user_pixels": train_user_pixels,
-                    "user_labels": train_user_labels
-                })
-            }
-        );
+    let results = await run_predict_job(
+        encode_training_pixels(train_user_pixels, train_user_labels)
+    );
 
+    if (results.response.status == 409) {
+        // The job was cancelled because a newer one was submitted:
+        return;
+    }
     show_loader("Process results...");
-    if (results.response.status >= 500) {
+    if (results.response.status >= 400) {
         hide_loader();
         console.log("Could not predict the mask! Code: " + results.response.status);
         show_dialogue(
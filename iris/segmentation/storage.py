@@ -0,0 +1,421 @@
+"""
+Storage of the masks saved by the users.
+
+Each user mask is stored in one compressed file
+`<project>.iris/segmentation/<image_id>/<user_id>_mask.npz` with
+
+    labels  uint8 label image (H x W) with the class id of each pixel
+    user    bit-packed user mask (1 bit per pixel): set if the user labelled
+            the pixel, unset if the AI did
+    shape   (H, W)
+    version number of saves (used to validate patch uploads)
+
+Files are written to a temporary file first and then renamed, so a crash never
+leaves a half-written mask behind. Older projects stored the masks as
+uncompressed `<user_id>_final.npy` (one-hot H x W x C) and `<user_id>_user.npy`
+files; they can still be read and are converted by `iris migrate-masks`.
+
+Projects with very many images can set `segmentation : mask_store` to
+`sqlite` instead. Then all user masks are kept in a single SQLite file
+`<project>.iris/masks.db`, indexed by (image id, user id), which avoids one
+file per image and user. `iris migrate-masks --to files --from-sqlite`
+exports such a store back to the per-file layout.
+
+Besides the masks, each store keeps named data of an image which is derived
+from them (`read_data`, `write_data`, `append_data`): the vote counts
+(`votes.npz`), the disagreement map (`disagreement.npz`), the journal
+(`journal.bin`, `journal.json`) and its snapshots (`journal/*.npz`). The file
+store writes them next to the masks, the SQLite store into the `data` table
+of `masks.db`, so it does not create any file per image. Only the merged
+masks are always written to `segmentation : path`.
+"""
+from contextlib import closing
+from glob import escape, glob
+import os
+from os.path import basename, exists, join
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from iris.project import project
+
+MASK_SUFFIX = '_mask.npz'
+LEGACY_FINAL_SUFFIX = '_final.npy'
+LEGACY_USER_SUFFIX = '_user.npy'
+
+
+def pack_user_mask(user_mask):
+    """Pack a boolean mask to 1 bit per pixel"""
+    return np.packbits(np.asarray(user_mask, dtype=bool).ravel())
+
+
+def unpack_user_mask(packed, shape):
+    """Unpack a bit-packed boolean mask"""
+    size = int(np.prod(shape))
+    return np.unpackbits(packed, count=size).astype(bool).reshape(shape)
+
+
+class FileMaskStore:
+    """One compressed file per image and user"""
+
+    @property
+    def directory(self):
+        return join(project['path'], 'segmentation')
+
+    def get_filename(self, image_id, user_id):
+        return join(self.directory, image_id, f'{user_id}{MASK_SUFFIX}')
+
+    def get_legacy_filenames(self, image_id, user_id):
+        return (
+            join(self.directory, image_id, f'{user_id}{LEGACY_FINAL_SUFFIX}'),
+            join(self.directory, image_id, f'{user_id}{LEGACY_USER_SUFFIX}'),
+        )
+
+    def exists(self, image_id, user_id):
+        return exists(self.get_filename(image_id, user_id)) \
+            or exists(self.get_legacy_filenames(image_id, user_id)[0])
+
+    def users(self, image_id):
+        """Get the ids of all users who saved a mask for this image (sorted)"""
+        users = set()
+        for suffix in (MASK_SUFFIX, LEGACY_FINAL_SUFFIX):
+            for path in glob(join(self.directory, escape(image_id), f'*{suffix}')):
+                users.add(basename(path)[:-len(suffix)])
+        return sorted(users)
+
+    def version(self, image_id, user_id):
+        """Get the version of a mask (0 if there is none)"""
+        filename = self.get_filename(image_id, user_id)
+        if not exists(filename):
+            return 0
+        with np.load(filename, allow_pickle=False) as data:
+            return int(data['version']) if 'version' in data else 0
+
+    def read(self, image_id, user_id):
+        """Read the final mask (class ids) and the user mask
+
+        Raises:
+            FileNotFoundError if the user has no mask for this image.
+        """
+        filename = self.get_filename(image_id, user_id)
+        if exists(filename):
+            with np.load(filename, allow_pickle=False) as data:
+                shape = tuple(data['shape'])
+                return data['labels'], unpack_user_mask(data['user'], shape)
+
+        final_mask_file, user_mask_file = self.get_legacy_filenames(image_id, user_id)
+        final_mask = np.argmax(np.load(final_mask_file), axis=-1)
+        user_mask = np.load(user_mask_file)
+        return final_mask, user_mask
+
+    def write(self, image_id, user_id, final_mask, user_mask, version=None):
+        """Write the masks of a user atomically
+
+        Args:
+            image_id: Id of the image.
+            user_id: Id of the user.
+            final_mask: 2D array with the class id of each pixel.
+            user_mask: 2D boolean array, true for pixels labelled by the user.
+            version: Version of the new mask (default: increment the current).
+
+        Returns:
+            The version of the new mask.
+        """
+        if version is None:
+            version = self.version(image_id, user_id) + 1
+        filename = self.get_filename(image_id, user_id)
+        os.makedirs(join(self.directory, image_id), exist_ok=True)
+        temporary = filename + '.tmp.npz'
+        np.savez_compressed(
+            temporary, labels=np.asarray(final_mask, dtype=np.uint8),
+            user=pack_user_mask(user_mask), shape=np.array(final_mask.shape),
+            version=np.array(version),
+        )
+        os.replace(temporary, filename)
+
+        # The new file supersedes masks in the old format:
+        for legacy_file in self.get_legacy_filenames(image_id, user_id):
+            if exists(legacy_file):
+                os.remove(legacy_file)
+        return version
+
+    def items(self):
+        """Get (image_id, user_id) of all saved masks"""
+        items = set()
+        for suffix in (MASK_SUFFIX, LEGACY_FINAL_SUFFIX):
+            for path in glob(join(self.directory, '*', f'*{suffix}')):
+                items.add((basename(os.path.dirname(path)), basename(path)[:-len(suffix)]))
+        return sorted(items)
+
+    def migrate(self):
+        """Convert all masks in the old format
+
+        Returns:
+            The number of converted masks.
+        """
+        n_masks = 0
+        for path in sorted(glob(join(self.directory, '*', f'*{LEGACY_FINAL_SUFFIX}'))):
+            image_id = basename(os.path.dirname(path))
+            user_id = basename(path)[:-len(LEGACY_FINAL_SUFFIX)]
+            final_mask, user_mask = self.read(image_id, user_id)
+            self.write(image_id, user_id, final_mask, user_mask)
+            n_masks += 1
+        return n_masks
+
+    def get_data_filename(self, image_id, name):
+        return join(self.directory, image_id, *name.split('/'))
+
+    def read_data(self, image_id, name):
+        """Read named data of an image (bytes or None)"""
+        filename = self.get_data_filename(image_id, name)
+        if not exists(filename):
+            return None
+        with open(filename, 'rb') as stream:
+            return stream.read()
+
+    def write_data(self, image_id, name, data):
+        """Replace named data of an image atomically"""
+        filename = self.get_data_filename(image_id, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + '.tmp', 'wb') as stream:
+            stream.write(data)
+        os.replace(filename + '.tmp', filename)
+
+    def append_data(self, image_id, name, data):
+        """Append to named data of an image (flushed to disk)"""
+        filename = self.get_data_filename(image_id, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'ab') as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+
+    def list_data(self, image_id, prefix=''):
+        """Names of the data of an image which start with prefix (sorted)"""
+        directory = join(self.directory, image_id)
+        names = []
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                name = os.path.relpath(join(root, filename), directory).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith(
+                    ('.tmp', MASK_SUFFIX, LEGACY_FINAL_SUFFIX, LEGACY_USER_SUFFIX)
+                ):
+                    names.append(name)
+        return sorted(names)
+
+
+class SQLiteMaskStore:
+    """All masks of a project in one SQLite file"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS masks (
+            image_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            width INTEGER NOT NULL,
+            labels BLOB NOT NULL,
+            user BLOB NOT NULL,
+            modified REAL NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (image_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS data (
+            image_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            part INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (image_id, name, part)
+        );
+    """
+
+    def __init__(self):
+        self._initialised = set()
+
+    @property
+    def filename(self):
+        return join(project['path'], 'masks.db')
+
+    def _connect(self):
+        filename = self.filename
+        connection = sqlite3.connect(filename, timeout=30)
+        if filename not in self._initialised:
+            os.makedirs(project['path'], exist_ok=True)
+            with connection:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(self.SCHEMA)
+            self._initialised.add(filename)
+        return connection
+
+    def exists(self, image_id, user_id):
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT 1 FROM masks WHERE image_id = ? AND user_id = ?',
+                (image_id, str(user_id))
+            ).fetchone()
+        return row is not None
+
+    def version(self, image_id, user_id):
+        """Get the version of a mask (0 if there is none)"""
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT version FROM masks WHERE image_id = ? AND user_id = ?',
+                (image_id, str(user_id))
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def users(self, image_id):
+        """Get the ids of all users who saved a mask for this image (sorted)"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'SELECT user_id FROM masks WHERE image_id = ? ORDER BY user_id',
+                (image_id,)
+            ).fetchall()
+        return [user_id for user_id, in rows]
+
+    def items(self):
+        """Get (image_id, user_id) of all saved masks"""
+        with closing(self._connect()) as connection:
+            return connection.execute(
+                'SELECT image_id, user_id FROM masks ORDER BY image_id, user_id'
+            ).fetchall()
+
+    def read(self, image_id, user_id):
+        """Read the final mask (class ids) and the user mask
+
+        Raises:
+            FileNotFoundError if the user has no mask for this image.
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT height, width, labels, user FROM masks '
+                'WHERE image_id = ? AND user_id = ?',
+                (image_id, str(user_id))
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f'No mask of user {user_id} for image {image_id}!')
+
+        height, width, labels, user = row
+        final_mask = np.frombuffer(zlib.decompress(labels), dtype=np.uint8)
+        user_mask = unpack_user_mask(np.frombuffer(user, dtype=np.uint8), (height, width))
+        return final_mask.reshape(height, width), user_mask
+
+    def write(self, image_id, user_id, final_mask, user_mask, version=None):
+        """Write the masks of a user (in one transaction)
+
+        Returns:
+            The version of the new mask.
+        """
+        height, width = final_mask.shape
+        labels = zlib.compress(np.asarray(final_mask, dtype=np.uint8).tobytes())
+        with closing(self._connect()) as connection, connection:
+            if version is None:
+                row = connection.execute(
+                    'SELECT version FROM masks WHERE image_id = ? AND user_id = ?',
+                    (image_id, str(user_id))
+                ).fetchone()
+                version = 1 if row is None else row[0] + 1
+            connection.execute(
+                'INSERT OR REPLACE INTO masks '
+                '(image_id, user_id, height, width, labels, user, modified, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    image_id, str(user_id), height, width, labels,
+                    pack_user_mask(user_mask).tobytes(), time.time(), version
+                )
+            )
+        return version
+
+    def read_data(self, image_id, name):
+        """Read named data of an image (bytes or None)"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'SELECT data FROM data WHERE image_id = ? AND name = ? ORDER BY part',
+                (image_id, name)
+            ).fetchall()
+        if not rows:
+            return None
+        return b''.join(data for data, in rows)
+
+    def write_data(self, image_id, name, data):
+        """Replace named data of an image (in one transaction)"""
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'DELETE FROM data WHERE image_id = ? AND name = ?', (image_id, name)
+            )
+            connection.execute(
+                'INSERT INTO data (image_id, name, part, data) VALUES (?, ?, 0, ?)',
+                (image_id, name, data)
+            )
+
+    def append_data(self, image_id, name, data):
+        """Append to named data of an image
+
+        Each append is stored as a new part, so the existing data is never
+        rewritten.
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'INSERT INTO data (image_id, name, part, data) VALUES (?, ?, '
+                '(SELECT COALESCE(MAX(part) + 1, 0) FROM data WHERE image_id = ? AND name = ?), ?)',
+                (image_id, name, image_id, name, data)
+            )
+
+    def list_data(self, image_id, prefix=''):
+        """Names of the data of an image which start with prefix (sorted)"""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'SELECT DISTINCT name FROM data WHERE image_id = ? ORDER BY name',
+                (image_id,)
+            ).fetchall()
+        return [name for name, in rows if name.startswith(prefix)]
+
+
+MASK_STORES = {
+    'files': FileMaskStore(),
+    'sqlite': SQLiteMaskStore(),
+}
+
+
+def get_mask_store(name=None):
+    """Get the mask store selected by `segmentation : mask_store`
+
+    Raises:
+        ValueError if the store is unknown.
+    """
+    name = name or project['segmentation'].get('mask_store', 'files')
+    if name not in MASK_STORES:
+        raise ValueError(
+            f"Unknown mask store '{name}'! Choose from: {', '.join(MASK_STORES)}"
+        )
+    return MASK_STORES[name]
+
+
+def copy_masks(source, target):
+    """Copy all masks and the data of their images from one store to another
+
+    Masks which have a newer version in the target store (e.g. because they
+    were saved after the target was last used) are not overwritten, and the
+    data of their images (votes, journal, ...) is not copied either.
+
+    Returns:
+        The number of copied masks.
+    """
+    n_masks = 0
+    skipped = set()
+    for image_id, user_id in source.items():
+        version = source.version(image_id, user_id)
+        if target.version(image_id, user_id) > version:
+            print(f'Skipped the mask of user {user_id} for image {image_id}: newer in target')
+            skipped.add(image_id)
+            continue
+        target.write(
+            image_id, user_id, *source.read(image_id, user_id), version=version
+        )
+        n_masks += 1
+
+    for image_id in sorted({image_id for image_id, _ in source.items()} - skipped):
+        for name in source.list_data(image_id):
+            target.write_data(image_id, name, source.read_data(image_id, name))
+    return n_masks
@@ -1,6 +1,7 @@
 import pytest
 import tempfile
 import os
+import numpy as np
 from iris.models import db
 
 @pytest.fixture(scope='session')
@@ -97,3 +98,31 @@ def project_snapshot():
         # restore
         for k, v in saved.items():
             setattr(project, k, deepcopy(v))
+
+
+def save_user_masks(image_id, user_id, final_mask):
+    """Save a mask of a user in the legacy file format (one-hot final mask)."""
+    from iris.segmentation import encode_mask, get_mask_filenames
+
+    final_file, user_file = get_mask_filenames(image_id, user_id)
+    os.makedirs(os.path.dirname(final_file), exist_ok=True)
+    np.save(final_file, encode_mask(final_mask, mode='binary'), allow_pickle=False)
+    np.save(user_file, np.ones_like(final_mask, dtype=bool), allow_pickle=False)
+
+
+def striped_mask():
+    """Mask of the project's mask shape: class 0 on the left, 1 on the right."""
+    from iris.project import project
+
+    width, height = project['segmentation']['mask_shape']
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[:, width // 2:] = 1
+    return mask
+
+
+def random_mask(seed):
+    """Random mask of the project's mask shape with the classes 0 to 2."""
+    from iris.project import project
+
+    width, height = project['segmentation']['mask_shape']
+    return np.random.RandomState(seed).randint(0, 3, (height, width)).astype(np.uint8)
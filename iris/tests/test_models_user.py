@@ -1,6 +1,6 @@
-import types
+from sqlalchemy import event, inspect
 
-from iris.models import User, Action
+from iris.models import Action, User, create_tables, db
 
 
 def test_user_password_roundtrip():
@@ -11,21 +11,66 @@ def test_user_password_roundtrip():
     assert not u.check_password("wrong")
 
 
-def test_user_to_json_counts_masks(monkeypatch, app):
-    u = User()
-    u.id = 1
-    # fake masks
-    class FakeQuery:
-        def __init__(self, masks):
-            self._masks = masks
-        def all(self):
-            return self._masks
-
-    fake_masks = [types.SimpleNamespace(unverified=False, score=5),
-                  types.SimpleNamespace(unverified=True, score=2)]
-    monkeypatch.setattr(Action, "query", types.SimpleNamespace(filter_by=lambda **kw: FakeQuery(fake_masks)))
-    data = u.to_json()
+def test_user_to_json_counts_masks(app):
+    user = User(id=1, name="user1")
+    db.session.add(user)
+    db.session.add_all([
+        Action(user=user, image_id="a", type="segmentation", unverified=False, score=5),
+        Action(user=user, image_id="b", type="segmentation", unverified=True, score=2),
+        Action(user=user, image_id="c", type="classification", unverified=False, score=7),
+    ])
+    db.session.commit()
+
+    data = user.to_json()
     assert 'password_hash' not in data
     assert data['segmentation']['n_masks'] == 2
     assert data['segmentation']['score'] == 5
     assert data['segmentation']['score_unverified'] == 2
+    assert User(id=2).to_json()['segmentation']['n_masks'] == 0
+
+
+def test_users_api_aggregates_stats_in_one_query(client, logged_in_user):
+    other = User(id=2, name="other")
+    db.session.add(other)
+    for user, score in ((logged_in_user, 10), (other, 20)):
+        db.session.add_all([
+            Action(user=user, image_id=image_id, type="segmentation", unverified=False, score=score)
+            for image_id in ("a", "b")
+        ])
+    db.session.commit()
+
+    def get_users():
+        statements = []
+        def count_statement(*args):
+            statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            return client.get('/admin/api/users').json['users'], statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    users, statements = get_users()
+    assert [user['segmentation'] for user in users] == [
+        {'score': 20, 'score_unverified': 0, 'n_masks': 2},
+        {'score': 40, 'score_unverified': 0, 'n_masks': 2},
+    ]
+    action_queries = [statement for statement in statements if 'FROM action' in statement]
+    assert len(action_queries) == 1
+
+    # Users without masks do not need any further queries:
+    db.session.add_all([User(id=user_id, name=f"new{user_id}") for user_id in range(3, 6)])
+    db.session.commit()
+    users, more_statements = get_users()
+    assert len(users) == 5
+    assert users[-1]['segmentation'] == {'score': 0, 'score_unverified': 0, 'n_masks': 0}
+    assert len(more_statements) == len(statements)
+
+
+def test_create_tables_adds_missing_indexes(app):
+    # A database created before the index existed:
+    db.session.execute(db.text("DROP INDEX ix_action_type_user"))
+    db.session.commit()
+
+    create_tables()
+    indexes = {index['name'] for index in inspect(db.engine).get_indexes('action')}
+    assert 'ix_action_type_user' in indexes
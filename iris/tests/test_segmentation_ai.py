@@ -0,0 +1,306 @@
+import json
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from iris.project import project
+from iris.segmentation.ai import (
+    REGION_HEADER, CachedModel, ModelCache, PixelFeatures, Region, get_model_key, model_cache,
+    predict_chunks, sample_training_pixels, suppress
+)
+
+
+def _segmentation_config():
+    return deepcopy(project['segmentation'])
+
+
+def test_model_key_ignores_postprocessing_options():
+    config = _segmentation_config()
+    indices, labels = np.arange(10), np.repeat([0, 1], 5)
+    key = get_model_key("IMG", config, indices, labels)
+
+    config['ai_model']['suppression_threshold'] = 50
+    config['ai_model']['suppression_filter_size'] = 7
+    config['ai_model']['suppression_default_class'] = 1
+    assert get_model_key("IMG", config, indices, labels) == key
+
+    config['ai_model']['n_estimators'] += 1
+    assert get_model_key("IMG", config, indices, labels) != key
+    config['ai_model']['n_estimators'] -= 1
+    assert get_model_key("IMG", config, indices, labels[::-1]) != key
+    assert get_model_key("OTHER", config, indices, labels) != key
+
+
+def test_model_cache_lru_and_key_mismatch():
+    cache = ModelCache(max_entries=2)
+    cache.put(1, "a", "k1", "model-a")
+    cache.put(1, "b", "k2", "model-b")
+    assert cache.get(1, "a", "k1") == "model-a"
+    assert cache.get(1, "a", "other-key") is None
+
+    # "b" is now the least recently used entry:
+    cache.put(2, "a", "k3", "model-c")
+    assert cache.get(1, "b", "k2") is None
+    assert cache.get(1, "a", "k1") == "model-a"
+    assert cache.get(2, "a", "k3") == "model-c"
+
+
+def test_model_cache_is_bounded_by_bytes(project_snapshot):
+    def cached_model(n_pixels):
+        return CachedModel(
+            None, [0, 1], np.zeros(n_pixels, dtype=np.uint8),
+            np.zeros((n_pixels, 2), dtype=np.uint8),
+        )
+
+    cache = ModelCache(max_bytes=1000)
+    cache.put(1, "a", "k1", cached_model(100))
+    cache.put(1, "b", "k2", cached_model(200))
+    assert cache.nbytes == 900
+    # Replacing an entry frees its old arrays:
+    cache.put(1, "b", "k3", cached_model(200))
+    assert cache.nbytes == 900
+
+    # "a" is the least recently used entry and has to make room:
+    cache.put(2, "a", "k4", cached_model(100))
+    assert cache.get(1, "a", "k1") is None
+    assert cache.get(1, "b", "k3") is not None
+    assert cache.nbytes == 900
+
+    # Too large for the whole cache:
+    cache.put(3, "a", "k5", cached_model(1000))
+    assert cache.get(3, "a", "k5") is None
+
+    # The limit defaults to the project config:
+    project['compute']['model_cache_mb'] = 0
+    cache = ModelCache()
+    cache.put(1, "a", "k1", cached_model(1))
+    assert cache.get(1, "a", "k1") is None and cache.nbytes == 0
+
+
+def test_pixel_features_rows_match_dense_features():
+    rng = np.random.RandomState(0)
+    image = rng.rand(6, 6, 2).astype(np.float32)
+    ai_config = {
+        'use_edge_filter': True, 'use_superpixels': True,
+        'use_meshgrid': True, 'meshgrid_cells': '2x2',
+    }
+    features = PixelFeatures(image, ai_config)
+    # 2 bands + 2 edges + 1 superpixels + 2 grid coordinates:
+    assert features.n_features == 7
+    dense = features.rows(slice(None))
+    assert dense.shape == (36, 7)
+    assert dense.dtype == np.float32
+    assert np.allclose(dense[:, :2], image.reshape(36, 2))
+
+    pixels = np.array([35, 0, 7])
+    assert np.array_equal(features.rows(pixels), dense[pixels])
+    # Pixel 7 is in row 1, column 1, i.e. in the first grid cell:
+    assert dense[7, -2:].tolist() == [0, 0]
+    assert dense[35, -2:].tolist() == [1, 1]
+
+
+def test_predict_chunks_serial_and_parallel_agree():
+    from sklearn.linear_model import LogisticRegression
+
+    rng = np.random.RandomState(0)
+    image = rng.rand(10, 13, 3)
+    ai_config = {'use_edge_filter': False, 'use_superpixels': False, 'use_meshgrid': False}
+    features = PixelFeatures(image, ai_config)
+    labels = (image[..., 0] > 0.5).ravel().astype(int) * 2
+
+    class Model(LogisticRegression):
+        def predict_proba(self, X, num_threads=1):
+            return super().predict_proba(X)
+
+    model = Model().fit(features.rows(slice(None)), labels)
+    expected = model.predict(features.rows(slice(None)))
+
+    serial = predict_chunks(model, features, chunk_size=16, n_threads=2)
+    parallel = predict_chunks(model, features, chunk_size=16, n_threads=3, parallel=True)
+    assert serial[0].dtype == np.uint8 and serial[1].dtype == np.uint8
+    assert serial[1].shape == (130, 2)
+    assert np.array_equal(serial[0], expected)
+    assert np.array_equal(parallel[0], expected)
+    assert np.array_equal(serial[1], parallel[1])
+
+
+def test_suppress_sets_isolated_pixels_to_default_class():
+    predictions = np.zeros(25, dtype=np.uint8)
+    predictions[12] = 1
+    ai_config = {
+        'suppression_threshold': 50,
+        'suppression_filter_size': 3,
+        'suppression_default_class': 0,
+    }
+    suppressed = suppress(predictions, ai_config, (5, 5))
+    assert suppressed[12] == 0
+    # The input must not be modified:
+    assert predictions[12] == 1
+
+    ai_config['suppression_threshold'] = 0
+    assert suppress(predictions, ai_config, (5, 5))[12] == 1
+
+
+def test_sample_training_pixels_is_bounded_balanced_and_deterministic():
+    labels = np.concatenate([np.zeros(10000), np.ones(5000), np.full(6, 2)]).astype(int)
+    indices = np.arange(len(labels)) * 3
+
+    train_indices, val_indices, train_labels, val_labels = sample_training_pixels(
+        indices, labels, max_pixels=1000, train_ratio=0.8, seed=7
+    )
+    assert len(train_indices) <= 1000
+    assert len(val_indices) <= 250
+    # The rare class is kept completely (split by train_ratio):
+    assert (train_labels == 2).sum() == 5
+    assert (val_labels == 2).sum() == 1
+    # The other classes share the rest evenly:
+    assert abs((train_labels == 0).sum() - (train_labels == 1).sum()) <= 1
+    # Labels still belong to their pixels and train and validation are disjoint:
+    assert np.all(labels[train_indices // 3] == train_labels)
+    assert not set(train_indices) & set(val_indices)
+
+    again = sample_training_pixels(indices, labels, max_pixels=1000, train_ratio=0.8, seed=7)
+    assert np.array_equal(again[0], train_indices)
+    other = sample_training_pixels(indices, labels, max_pixels=1000, train_ratio=0.8, seed=8)
+    assert not np.array_equal(other[0], train_indices)
+
+
+def test_sample_training_pixels_keeps_single_pixel_classes():
+    labels = np.array([0, 0, 0, 0, 1])
+    train_indices, val_indices, train_labels, val_labels = sample_training_pixels(
+        np.arange(5), labels, max_pixels=100, train_ratio=0.8, seed=0
+    )
+    assert 1 in train_labels
+    assert 1 not in val_labels
+
+
+def test_predict_mask_reuses_model_for_postprocessing_changes(client, logged_in_user, monkeypatch):
+    import lightgbm as lgb
+
+    model_cache.clear()
+    n_fits = []
+    original_fit = lgb.LGBMClassifier.fit
+
+    def counting_fit(self, *args, **kwargs):
+        n_fits.append(1)
+        return original_fit(self, *args, **kwargs)
+
+    monkeypatch.setattr(lgb.LGBMClassifier, "fit", counting_fit)
+
+    width, height = project['segmentation']['mask_shape']
+    rng = np.random.RandomState(0)
+    pixels = rng.choice(width * height, 200, replace=False)
+    payload = json.dumps({
+        'user_pixels': pixels.tolist(),
+        'user_labels': np.repeat([0, 1], 100).tolist(),
+    })
+    image_id = project.image_ids[0]
+
+    project.save_user_config(logged_in_user.id, {})
+    response = client.post(f'/segmentation/predict_mask/{image_id}', data=payload)
+    assert response.status_code == 200
+    assert len(response.data) == width * height
+
+    user_config = {'segmentation': {'ai_model': {'suppression_threshold': 60}}}
+    project.save_user_config(logged_in_user.id, user_config)
+    try:
+        response = client.post(f'/segmentation/predict_mask/{image_id}', data=payload)
+        assert response.status_code == 200
+        assert len(n_fits) == 1
+    finally:
+        project.save_user_config(logged_in_user.id, {})
+        model_cache.clear()
+
+
+def test_region_from_json_and_select():
+    mask_shape = (10, 8)  # width, height
+    assert Region.from_json(None, mask_shape).is_full(mask_shape)
+
+    region = Region.from_json({'bbox': [2, 1, 20, 4]}, mask_shape)
+    assert region.bbox == [2, 1, 10, 4]
+    assert region.shape == (3, 8)
+
+    # Pixels at (x=3, y=2), (x=0, y=0) and (x=9, y=3):
+    indices = np.array([2 * 10 + 3, 0, 3 * 10 + 9])
+    local_indices, labels = region.select(indices, np.array([1, 2, 3]), mask_width=10)
+    assert local_indices.tolist() == [1 * 8 + 1, 2 * 8 + 7]
+    assert labels.tolist() == [1, 3]
+
+    triangle = Region.from_json({'polygon': [[0, 0], [6, 0], [0, 6]]}, mask_shape)
+    assert triangle.bbox == [0, 0, 7, 7]
+    assert triangle.inside[0, 0] and not triangle.inside[6, 6]
+    local_indices, labels = triangle.select(np.array([0, 6 * 10 + 6]), np.array([1, 2]), 10)
+    assert local_indices.tolist() == [0]
+    assert labels.tolist() == [1]
+
+    for invalid in [{'bbox': [5, 5, 5, 9]}, {'polygon': [[0, 0], [1, 1]]}, {'other': 1}]:
+        with pytest.raises(ValueError):
+            Region.from_json(invalid, mask_shape)
+
+
+def test_predict_mask_for_region(client, logged_in_user):
+    width, height = project['segmentation']['mask_shape']
+    project.save_user_config(logged_in_user.id, {})
+    x, y = np.meshgrid(np.arange(40, 80), np.arange(20, 50))
+    pixels = (y * width + x).ravel()
+    labels = (x >= 60).ravel().astype(int)
+    payload = {
+        'user_pixels': pixels.tolist(),
+        'user_labels': labels.tolist(),
+        'roi': {'bbox': [30, 10, 90, 60]},
+    }
+    image_id = project.image_ids[0]
+
+    response = client.post(f'/segmentation/predict_mask/{image_id}', data=json.dumps(payload))
+    assert response.status_code == 200
+    assert response.headers[REGION_HEADER] == '30,10,90,60'
+    assert len(response.data) == 60 * 50
+
+    # A region without two classes cannot be trained:
+    payload['roi'] = {'bbox': [30, 10, 55, 60]}
+    response = client.post(f'/segmentation/predict_mask/{image_id}', data=json.dumps(payload))
+    assert response.status_code == 400
+    model_cache.clear()
+
+
+def test_predict_mask_probabilities_output(client, logged_in_user, monkeypatch):
+    import lightgbm as lgb
+
+    model_cache.clear()
+    n_fits = []
+    original_fit = lgb.LGBMClassifier.fit
+
+    def counting_fit(self, *args, **kwargs):
+        n_fits.append(1)
+        return original_fit(self, *args, **kwargs)
+
+    monkeypatch.setattr(lgb.LGBMClassifier, "fit", counting_fit)
+
+    width, height = project['segmentation']['mask_shape']
+    n_classes = len(project['classes'])
+    rng = np.random.RandomState(0)
+    payload = json.dumps({
+        'user_pixels': rng.choice(width * height, 200, replace=False).tolist(),
+        'user_labels': np.repeat([0, 1], 100).tolist(),
+    })
+    image_id = project.image_ids[0]
+    project.save_user_config(logged_in_user.id, {})
+
+    response = client.post(f'/segmentation/predict_mask/{image_id}', data=payload)
+    predictions = np.frombuffer(response.data, dtype=np.uint8)
+
+    response = client.post(
+        f'/segmentation/predict_mask/{image_id}?output=probabilities', data=payload
+    )
+    assert response.status_code == 200
+    assert len(n_fits) == 1
+    planes = np.frombuffer(response.data, dtype=np.uint8).reshape(n_classes, -1)
+    assert planes.shape[1] == width * height
+    # Only the two labelled classes have probabilities:
+    assert not planes[2:].any()
+    assert (np.argmax(planes, axis=0) == predictions).mean() > 0.99
+
+    response = client.post(f'/segmentation/predict_mask/{image_id}?output=magic', data=payload)
+    assert response.status_code == 400
+    model_cache.clear()
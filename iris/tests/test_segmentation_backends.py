@@ -0,0 +1,74 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from iris.project import project
+from iris.segmentation.ai import PixelFeatures, predict_chunks
+from iris.segmentation.backends import BACKENDS, get_backend
+from iris.segmentation import benchmark
+from iris.segmentation.benchmark import run_benchmark, summarise
+from iris.tests.conftest import save_user_masks, striped_mask
+
+
+AI_CONFIG = {
+    'n_estimators': 10, 'max_depth': 4, 'n_leaves': 8, 'bands': None,
+    'use_edge_filter': False, 'use_superpixels': False, 'use_meshgrid': False,
+}
+
+
+@pytest.mark.parametrize('name', list(BACKENDS))
+def test_backend_separates_two_classes(name):
+    image = np.zeros((20, 20, 2), dtype=np.float32)
+    image[:, 10:] = 1
+    features = PixelFeatures(image, AI_CONFIG)
+    labels = (np.arange(400) % 20 >= 10).astype(np.uint8)
+    indices = np.arange(0, 400, 3)
+
+    model = get_backend(AI_CONFIG, name=name).fit(features.rows(indices), labels[indices])
+    predictions, probabilities = predict_chunks(model, features, chunk_size=64)
+
+    assert list(model.classes_) == [0, 1]
+    assert probabilities.shape == (400, 2)
+    assert (predictions == labels).mean() > 0.95
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend({**AI_CONFIG, 'backend': 'magic'})
+
+
+def test_benchmark_on_saved_masks(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+
+    results = run_benchmark(backends=['lightgbm', 'nearest_centroid'])
+    assert [result['backend'] for result in results] == ['lightgbm', 'nearest_centroid']
+    assert all(result['image_id'] == image_id for result in results)
+
+    summary = summarise(results)
+    assert summary['lightgbm']['n_masks'] == 1
+    assert 0 <= summary['nearest_centroid']['agreement'] <= 1
+    assert summary['lightgbm']['fit_time'] > 0
+
+    with pytest.raises(ValueError):
+        run_benchmark(backends=['magic'])
+
+
+def test_benchmark_times_without_tracing(tmp_path, project_snapshot, monkeypatch):
+    project['path'] = str(tmp_path)
+    save_user_masks(project.image_ids[0], '1', striped_mask())
+
+    tracing = []
+
+    def perf_counter():
+        tracing.append(tracemalloc.is_tracing())
+        return time.time()
+
+    monkeypatch.setattr(benchmark.time, 'perf_counter', perf_counter)
+    results = run_benchmark(backends=['nearest_centroid'])
+    assert results[0]['peak_memory'] > 0
+    # Three time stamps of the timed run and two of the traced run:
+    assert tracing == [False, False, False, True, True]
@@ -0,0 +1,160 @@
+import json
+
+import numpy as np
+import pytest
+
+from iris.project import project
+from iris.segmentation.merge_queue import merge_queue
+from iris.segmentation.storage import get_mask_store
+from iris.segmentation.codec import (
+    MASK_FULL, MASK_PATCH, MASK_VERSION_HEADER, apply_patches, decode_masks,
+    decode_training_pixels, encode_masks, encode_training_pixels,
+    get_changed_rect, rle_decode, rle_encode
+)
+
+
+def test_rle_roundtrip():
+    array = np.array([0, 0, 3, 3, 3, 1, 0, 0], dtype=np.uint8)
+    lengths, values = rle_encode(array)
+    assert lengths.tolist() == [2, 3, 1, 2]
+    assert values.tolist() == [0, 3, 1, 0]
+    assert np.array_equal(rle_decode(lengths, values, size=8), array)
+    with pytest.raises(ValueError):
+        rle_decode(lengths, values, size=9)
+    # Huge run lengths are rejected before anything is allocated:
+    huge = np.array([2**32 - 1] * 4, dtype='<u4')
+    with pytest.raises(ValueError):
+        rle_decode(huge, values, size=8)
+
+
+@pytest.mark.parametrize("run_length", [False, True])
+def test_training_pixels_roundtrip(run_length):
+    indices = np.array([3, 10, 11, 12, 40])
+    labels = np.array([1, 0, 0, 2, 1])
+    options = {'roi': {'bbox': [0, 0, 5, 5]}}
+
+    data = encode_training_pixels(indices, labels, options, run_length=run_length, mask_size=50)
+    decoded_indices, decoded_labels, decoded_options = decode_training_pixels(data, mask_size=50)
+    assert decoded_indices.tolist() == indices.tolist()
+    assert decoded_labels.tolist() == labels.tolist()
+    assert decoded_options == options
+
+
+def test_decode_training_pixels_rejects_malformed_data():
+    data = encode_training_pixels(np.array([1, 2]), np.array([0, 1]))
+    with pytest.raises(ValueError):
+        decode_training_pixels(data[:-1], mask_size=10)
+    with pytest.raises(ValueError):
+        decode_training_pixels(b'JUNK' + data[4:], mask_size=10)
+    with pytest.raises(ValueError):
+        decode_training_pixels(data, mask_size=2)
+
+
+def test_predict_mask_accepts_binary_payload(client, logged_in_user):
+    width, height = project['segmentation']['mask_shape']
+    project.save_user_config(logged_in_user.id, {})
+    rng = np.random.RandomState(2)
+    pixels = rng.choice(width * height, 200, replace=False)
+    labels = np.repeat([0, 1], 100)
+    image_id = project.image_ids[0]
+
+    binary = client.post(
+        f'/segmentation/predict_mask/{image_id}',
+        data=encode_training_pixels(pixels, labels, run_length=True, mask_size=width * height),
+        content_type='application/octet-stream',
+    )
+    assert binary.status_code == 200
+
+    # The run-length encoding sorts the pixels, JSON gets them in that order too:
+    order = np.argsort(pixels)
+    legacy = client.post(
+        f'/segmentation/predict_mask/{image_id}',
+        data=json.dumps({
+            'user_pixels': pixels[order].tolist(), 'user_labels': labels[order].tolist()
+        }),
+    )
+    assert legacy.status_code == 200
+    assert binary.data == legacy.data
+
+
+@pytest.mark.parametrize("run_length", [False, True])
+def test_mask_patch_roundtrip(run_length):
+    rng = np.random.RandomState(0)
+    old_mask = rng.randint(0, 3, (6, 8)).astype(np.uint8)
+    old_user = rng.rand(6, 8) > 0.5
+    new_mask, new_user = old_mask.copy(), old_user.copy()
+    new_mask[2:4, 3:7] = 2
+    new_user[2:4, 3:7] = True
+
+    data = encode_masks(new_mask, new_user, run_length=run_length)
+    kind, _, patches = decode_masks(data, (6, 8))
+    assert kind == MASK_FULL
+    np.testing.assert_array_equal(patches[0][2], new_mask)
+
+    rect = get_changed_rect(old_mask, new_mask)
+    assert rect == (3, 2, 4, 2)
+    data = encode_masks(new_mask, new_user, rects=[rect], base_version=5, run_length=run_length)
+    kind, base_version, patches = decode_masks(data, (6, 8))
+    assert (kind, base_version) == (MASK_PATCH, 5)
+    final_mask, user_mask = apply_patches(old_mask, old_user, patches)
+    np.testing.assert_array_equal(final_mask, new_mask)
+    np.testing.assert_array_equal(user_mask, new_user)
+    assert get_changed_rect(new_mask, final_mask) is None
+
+    for broken in [data[:-1], data + b'x', b'IRMK' + data[4:8], data[:4] + b'\x09' + data[5:]]:
+        with pytest.raises(ValueError):
+            decode_masks(broken, (6, 8))
+    with pytest.raises(ValueError):
+        decode_masks(data, (6, 9))
+
+
+def test_save_mask_patches_against_acknowledged_version(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['merge_delay'] = 60
+    width, height = project['segmentation']['mask_shape']
+    image_id = project.image_ids[0]
+    url = f'/segmentation/save_mask/{image_id}'
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    user_mask = np.zeros((height, width), dtype=bool)
+    legacy = np.concatenate([[254], mask.ravel(), user_mask.ravel(), [254]]).astype(np.uint8)
+    response = client.post(url, data=legacy.tobytes())
+    assert response.headers[MASK_VERSION_HEADER] == '1'
+
+    mask[10:20, 30:35] = 1
+    user_mask[10:20, 30:35] = True
+    patch = encode_masks(mask, user_mask, rects=[(30, 10, 5, 10)], base_version=1)
+    assert len(patch) < 200
+    response = client.post(url, data=patch)
+    assert response.status_code == 200
+    assert response.headers[MASK_VERSION_HEADER] == '2'
+
+    # A patch against an outdated version is rejected:
+    response = client.post(url, data=patch)
+    assert response.status_code == 409
+    assert response.headers[MASK_VERSION_HEADER] == '2'
+
+    response = client.get(f'/segmentation/load_mask/{image_id}?encoding=rle')
+    assert response.headers[MASK_VERSION_HEADER] == '2'
+    _, _, [(_, _, final_mask, loaded_user_mask)] = decode_masks(response.data, (height, width))
+    np.testing.assert_array_equal(final_mask, mask)
+    np.testing.assert_array_equal(loaded_user_mask, user_mask)
+    assert client.post(url, data=b'IRMK').status_code == 400
+    merge_queue.flush()
+
+
+def test_save_mask_rejects_patches_with_unknown_class_ids(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    width, height = project['segmentation']['mask_shape']
+    url = f'/segmentation/save_mask/{project.image_ids[0]}'
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    user_mask = np.zeros((height, width), dtype=bool)
+    mask[10:20, 30:35] = len(project['classes'])
+    for run_length in [False, True]:
+        data = encode_masks(mask, user_mask, run_length=run_length)
+        assert client.post(url, data=data).status_code == 400
+        patch = encode_masks(mask, user_mask, rects=[(30, 10, 5, 10)], run_length=run_length)
+        response = client.post(url, data=patch)
+        assert response.status_code == 400 and b'class ids' in response.data
+    assert not get_mask_store().exists(project.image_ids[0], 1)
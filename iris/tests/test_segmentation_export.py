@@ -0,0 +1,73 @@
+import csv
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import Affine
+
+from iris.project import project
+from iris.segmentation.export import export_project, get_georeference
+from iris.tests.conftest import random_mask, save_user_masks
+
+
+def _read_table(filename):
+    with open(filename, newline='') as stream:
+        return list(csv.DictReader(stream))
+
+
+def _georeferenced_images(tmp_path):
+    height, width = project['images']['shape'][::-1]
+    for image_id in project.image_ids:
+        with rio.open(
+            tmp_path / f'{image_id}.tif', 'w', driver='GTiff', height=height,
+            width=width, count=1, dtype='uint8', crs='EPSG:32633',
+            transform=Affine(10, 0, 500000, 0, -10, 4000000),
+        ) as file:
+            file.write(np.zeros((height, width), dtype=np.uint8), 1)
+    project['images']['path'] = {'Sentinel1': str(tmp_path / '{id}.tif')}
+
+
+@pytest.mark.parametrize("format", ["png", "npz", "geotiff"])
+def test_export_consensus_masks_and_statistics(tmp_path, project_snapshot, format):
+    project['path'] = str(tmp_path)
+    _georeferenced_images(tmp_path)
+    image_id = project.image_ids[0]
+    masks = {'1': random_mask(1), '2': random_mask(2), '3': random_mask(1)}
+    for user_id, mask in masks.items():
+        save_user_masks(image_id, user_id, mask)
+
+    output = tmp_path / 'export'
+    assert export_project(str(output), format=format) == 1
+
+    if format == 'png':
+        from PIL import Image
+        with Image.open(output / f'{image_id}.png') as image:
+            exported = np.array(image)
+    elif format == 'npz':
+        with np.load(output / f'{image_id}.npz') as data:
+            exported = data['mask']
+            assert str(data['crs']) == 'EPSG:32633'
+            assert data['transform'][2] == 500000 + 10 * project['segmentation']['mask_area'][0]
+    else:
+        with rio.open(output / f'{image_id}.tif') as file:
+            exported = file.read(1)
+            assert file.crs.to_string() == 'EPSG:32633'
+            assert file.transform == get_georeference(image_id)[1]
+            # GeoTIFF colour maps have no alpha:
+            assert file.colormap(1)[1][:3] == tuple(project['classes'][1]['colour'][:3])
+    # Users 1 and 3 agree, so they win every pixel:
+    np.testing.assert_array_equal(exported, masks['1'])
+
+    [image_row] = _read_table(output / 'images.csv')
+    assert image_row['image_id'] == image_id and image_row['n_users'] == '3'
+    user_rows = _read_table(output / 'users.csv')
+    assert [row['user_id'] for row in user_rows] == ['1', '2', '3']
+    assert user_rows[0]['score'] == '100'
+    first_class = f"pixels_{project['classes'][0]['name']}"
+    assert int(image_row[first_class]) == int((masks['1'] == 0).sum())
+
+
+def test_export_rejects_unknown_format(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    with pytest.raises(ValueError):
+        export_project(str(tmp_path / 'export'), format='jpg')
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.jobs import JobManager, PredictionJob
+
+
+def _wait_for(job, timeout=30):
+    deadline = time.time() + timeout
+    while not job.done and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_job_reports_result_and_progress():
+    manager = JobManager(max_workers=1)
+
+    def work(value, job):
+        job.report('working', step=1)
+        return value * 2
+
+    job = _wait_for(manager.submit(1, "img", work, args=(21,)))
+    assert job.status == PredictionJob.FINISHED
+    assert job.result == 42
+    assert job.progress['step'] == 1
+    assert manager.get(job.id) is job
+
+
+def test_new_job_cancels_superseded_jobs_of_same_user():
+    manager = JobManager(max_workers=2)
+    started = threading.Event()
+
+    def slow(job):
+        started.set()
+        while True:
+            job.report('waiting')
+            time.sleep(0.01)
+
+    first = manager.submit(1, "img", slow)
+    assert started.wait(5)
+    other_user = manager.submit(2, "img", lambda job: "other")
+    second = manager.submit(1, "img", lambda job: "second")
+
+    assert _wait_for(first).status == PredictionJob.CANCELLED
+    assert _wait_for(second).result == "second"
+    assert _wait_for(other_user).result == "other"
+
+
+def test_failed_job_keeps_error():
+    manager = JobManager(max_workers=1)
+
+    def broken(job):
+        raise ValueError("broken model")
+
+    job = _wait_for(manager.submit(1, "img", broken))
+    assert job.status == PredictionJob.FAILED
+    assert "broken model" in job.error
+
+
+def test_predict_job_endpoints(client, logged_in_user):
+    width, height = project['segmentation']['mask_shape']
+    rng = np.random.RandomState(1)
+    payload = json.dumps({
+        'user_pixels': rng.choice(width * height, 200, replace=False).tolist(),
+        'user_labels': np.repeat([0, 1], 100).tolist(),
+    })
+    image_id = project.image_ids[0]
+
+    response = client.post(f'/segmentation/api/predict-jobs/{image_id}', data=payload)
+    assert response.status_code == 202
+    job_id = response.get_json()['job']['id']
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        status = client.get(f'/segmentation/api/predict-jobs/{job_id}').get_json()['job']
+        if status['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    assert status['status'] == 'finished'
+    assert status['progress']['n_features'] > 0
+
+    response = client.get(f'/segmentation/api/predict-jobs/{job_id}/result')
+    assert response.status_code == 200
+    assert len(response.data) == width * height
+
+    assert client.get('/segmentation/api/predict-jobs/unknown').status_code == 404
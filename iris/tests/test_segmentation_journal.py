@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.codec import MASK_VERSION_HEADER, encode_masks
+from iris.segmentation.journal import (
+    ENTRY_FULL, ENTRY_HEADER, ENTRY_PIXELS, MaskJournal, encode_entry, read_entries
+)
+from iris.segmentation.merge_queue import merge_queue
+
+
+def _versions(shape=(8, 6), n_versions=5):
+    rng = np.random.RandomState(0)
+    final_mask = np.zeros(shape, dtype=np.uint8)
+    user_mask = np.zeros(shape, dtype=bool)
+    versions = []
+    for _ in range(n_versions):
+        final_mask = final_mask.copy()
+        user_mask = user_mask.copy()
+        y, x = rng.randint(0, shape[0]), rng.randint(0, shape[1])
+        final_mask[y, x] = rng.randint(1, 4)
+        user_mask[y, x] = True
+        versions.append((final_mask, user_mask))
+    return versions
+
+
+def test_entries_only_store_changed_pixels():
+    final_mask = np.zeros((100, 100), dtype=np.uint8)
+    user_mask = np.zeros((100, 100), dtype=bool)
+    new_mask = final_mask.copy()
+    new_mask[10, 10:15] = 2
+
+    entry, n_changed = encode_entry('1', 2, 0., (final_mask, user_mask), (new_mask, user_mask))
+    assert n_changed == 5
+    assert len(entry) == ENTRY_HEADER.size + 1 + 4 + 5 * 6
+    [decoded] = read_entries(entry)
+    assert decoded['kind'] == ENTRY_PIXELS
+    assert decoded['user_id'] == '1' and decoded['version'] == 2
+
+    # Without the previous masks, the full masks are stored:
+    entry, _ = encode_entry('1', 2, 0., None, (new_mask, user_mask))
+    assert next(read_entries(entry))['kind'] == ENTRY_FULL
+
+    # Incomplete entries (e.g. after a crash) are ignored:
+    assert list(read_entries(entry[:-1])) == []
+
+
+def test_restore_every_version(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['journal'] = {'enabled': True, 'snapshot_interval': 2}
+    journal = MaskJournal()
+    versions = _versions()
+
+    old_masks = None
+    for version, masks in enumerate(versions, start=1):
+        journal.append('IMG', 1, version, version - 1, old_masks, masks)
+        # Saves of another user in between:
+        journal.append('IMG', 2, version, version - 1, old_masks, versions[0])
+        old_masks = masks
+    journal.wait()
+
+    assert journal.get_snapshots('IMG', 1) == [2, 4]
+    for version, (final_mask, user_mask) in enumerate(versions, start=1):
+        restored_final, restored_user = journal.restore('IMG', '1', version, (8, 6))
+        np.testing.assert_array_equal(restored_final, final_mask)
+        np.testing.assert_array_equal(restored_user, user_mask)
+
+    history = journal.get_history('IMG', 1)
+    assert [entry['version'] for entry in history] == [1, 2, 3, 4, 5]
+    statistics = journal.get_statistics('IMG')
+    assert statistics['1']['n_saves'] == 5
+    assert statistics['1']['time_to_completion'] >= 0
+
+
+def test_save_and_restore_through_api(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['merge_delay'] = 60
+    width, height = project['segmentation']['mask_shape']
+    image_id = project.image_ids[0]
+    url = f'/segmentation/save_mask/{image_id}'
+
+    first_mask = np.zeros((height, width), dtype=np.uint8)
+    user_mask = np.zeros((height, width), dtype=bool)
+    first_mask[:5, :5] = 1
+    assert client.post(url, data=encode_masks(first_mask, user_mask)).status_code == 200
+    second_mask = first_mask.copy()
+    second_mask[10:12, 10:12] = 2
+    assert client.post(url, data=encode_masks(second_mask, user_mask)).status_code == 200
+
+    response = client.get(f'/segmentation/api/masks/{image_id}/history')
+    assert [entry['version'] for entry in response.json['versions']] == [1, 2]
+    assert response.json['versions'][1]['kind'] == 'pixels'
+    assert response.json['statistics']['1']['changed_pixels'] == 25 + 4
+    assert os.path.getsize(tmp_path / 'segmentation' / image_id / 'journal.bin') < 500
+
+    restore_url = f'/segmentation/api/masks/{image_id}/restore'
+    response = client.post(restore_url, json={'version': 1})
+    assert response.status_code == 200
+    assert response.json['version'] == 3
+    assert response.headers[MASK_VERSION_HEADER] == '3'
+
+    response = client.get(f'/segmentation/load_mask/{image_id}')
+    loaded_mask = np.frombuffer(response.data, dtype=np.uint8)[1:1 + height * width]
+    np.testing.assert_array_equal(loaded_mask.reshape(height, width), first_mask)
+
+    assert client.post(restore_url, json={'version': 10}).status_code == 404
+    assert client.post(restore_url, json={}).status_code == 400
+    assert client.get('/segmentation/api/masks/unknown/history').status_code == 404
+    merge_queue.flush()
+
+
+def test_first_save_over_unjournalled_mask_is_restorable(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['journal'] = {'enabled': True, 'snapshot_interval': 20}
+    journal = MaskJournal()
+    legacy_masks, saved_masks = _versions(n_versions=2)
+
+    # The legacy mask (version 0) was saved before the journal existed:
+    journal.append('IMG', 1, 1, 0, legacy_masks, saved_masks)
+    assert journal.get_history('IMG')[0]['kind'] == 'full'
+
+    restored_final, restored_user = journal.restore('IMG', 1, 1, (8, 6))
+    np.testing.assert_array_equal(restored_final, saved_masks[0])
+    np.testing.assert_array_equal(restored_user, saved_masks[1])
@@ -4,7 +4,7 @@ from os.path import dirname
 import numpy as np
 
 from iris.project import project
-from iris.segmentation import get_mask_filenames, read_masks
+from iris.segmentation import get_mask_filenames, get_mask_users, read_masks
 
 
 def test_get_mask_filenames_and_read_masks(tmp_path, project_snapshot):
@@ -25,3 +25,17 @@ def test_get_mask_filenames_and_read_masks(tmp_path, project_snapshot):
     final_mask, user_mask = read_masks("IMG", "u1")
     assert final_mask.ndim == 2
     assert user_mask.ndim == 2
+
+
+def test_save_mask_rejects_unknown_class_ids(client, logged_in_user, tmp_path, project_snapshot):
+    project["path"] = str(tmp_path)
+    width, height = project["segmentation"]["mask_shape"]
+    final_mask = np.zeros(width * height, dtype=np.uint8)
+    final_mask[0] = len(project["classes"])
+    user_mask = np.ones(width * height, dtype=np.uint8)
+    data = np.concatenate([[254], final_mask, user_mask, [254]]).astype(np.uint8).tobytes()
+
+    response = client.post(f"/segmentation/save_mask/{project.image_ids[0]}", data=data)
+    assert response.status_code == 400
+    # Nothing was written:
+    assert get_mask_users(project.image_ids[0]) == []
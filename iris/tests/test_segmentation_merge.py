@@ -0,0 +1,229 @@
+import io
+
+import numpy as np
+from PIL import Image
+import pytest
+from sklearn.metrics import accuracy_score, f1_score, jaccard_score
+
+from iris.models import Action, Agreement, ClassCount, Conflict, User, db
+from iris.project import project
+from iris.segmentation import (
+    count_votes, get_confusion_matrix, get_disagreement,
+    merge_masks, read_disagreement, read_masks, read_votes, score_confusion_matrix
+)
+from iris.segmentation.storage import get_mask_store
+from iris.tests.conftest import random_mask, save_user_masks
+
+
+def _read_merged(image_id):
+    merged = np.load(project['segmentation']['path'].format(id=image_id))
+    return np.argmax(merged, axis=-1)
+
+
+def test_merge_masks_updates_votes_incrementally(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    image_id = project.image_ids[0]
+
+    masks = {'1': random_mask(1), '2': random_mask(2), '3': random_mask(3)}
+    for user_id, mask in masks.items():
+        save_user_masks(image_id, user_id, mask)
+        merge_masks(image_id, user_id, None)
+
+    # User 2 changes their mask:
+    old_mask = read_masks(image_id, '2')[0]
+    masks['2'] = random_mask(4)
+    save_user_masks(image_id, '2', masks['2'])
+    merge_masks(image_id, '2', old_mask)
+
+    votes, users = read_votes(image_id)
+    expected, expected_users = count_votes(image_id)
+    assert users == expected_users == ['1', '2', '3']
+    np.testing.assert_array_equal(votes, expected)
+
+    stacked = np.stack(list(masks.values()), axis=-1)
+    counts = np.stack([(stacked == c).sum(axis=-1) for c in range(3)], axis=-1)
+    np.testing.assert_array_equal(_read_merged(image_id), np.argmax(counts, axis=-1))
+
+
+def test_merge_masks_recounts_missing_or_stale_votes(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    image_id = project.image_ids[0]
+
+    save_user_masks(image_id, '1', random_mask(1))
+    save_user_masks(image_id, '2', random_mask(2))
+    # Without persisted votes, all masks are counted:
+    merge_masks(image_id, '2', None)
+    assert read_votes(image_id)[1] == ['1', '2']
+
+    # Unknown old mask of a counted user:
+    save_user_masks(image_id, '1', random_mask(5))
+    merge_masks(image_id, '1', None)
+    np.testing.assert_array_equal(read_votes(image_id)[0], count_votes(image_id)[0])
+    assert (tmp_path / 'segmentation' / image_id / 'votes.npz').exists()
+
+
+@pytest.mark.parametrize('n_classes', [2, 4])
+def test_confusion_matrix_scores_match_sklearn(n_classes):
+    rng = np.random.RandomState(n_classes)
+    reference = rng.randint(0, n_classes, 500)
+    mask = np.where(rng.rand(500) < 0.7, reference, rng.randint(0, n_classes, 500))
+    matrix = get_confusion_matrix(reference, mask, n_classes=5)
+
+    assert matrix.sum() == 500
+    assert score_confusion_matrix(matrix, 'accuracy') == round(100 * accuracy_score(reference, mask))
+    assert score_confusion_matrix(matrix, 'f1') == round(100 * f1_score(reference, mask, average='macro'))
+    average = 'binary' if n_classes == 2 else 'macro'
+    assert score_confusion_matrix(matrix, 'jaccard') == \
+        round(100 * jaccard_score(reference, mask, average=average))
+
+
+def test_merge_masks_scores_all_users(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['score'] = 'accuracy'
+    image_id = project.image_ids[0]
+
+    for user_id in (1, 2):
+        db.session.add(User(id=user_id, name=f'user{user_id}'))
+    db.session.commit()
+
+    mask = random_mask(1)
+    other = mask.copy()
+    other[:len(other) // 2] = (other[:len(other) // 2] + 1) % 3
+    save_user_masks(image_id, '1', mask)
+    save_user_masks(image_id, '2', other)
+    merge_masks(image_id)
+
+    actions = Action.query.filter_by(image_id=image_id).order_by(Action.user_id).all()
+    assert [action.user_id for action in actions] == [1, 2]
+    # Two users are scored against each other:
+    expected = round(100 * np.mean(mask == other))
+    assert [action.score for action in actions] == [expected, expected]
+
+
+def test_merge_records_class_counts_for_statistics(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    db.session.add(User(id=2, name='user2'))
+    db.session.commit()
+
+    store = get_mask_store()
+    masks = {1: random_mask(1), 2: random_mask(2)}
+    user_masks = {1: masks[1] == 1, 2: np.zeros_like(masks[2], dtype=bool)}
+    for image_id in project.image_ids:
+        for user_id in (1, 2):
+            store.write(image_id, user_id, masks[user_id], user_masks[user_id])
+        merge_masks(image_id)
+    # A second merge replaces the counts:
+    merge_masks(project.image_ids[0])
+
+    rows = ClassCount.query.filter_by(image_id=project.image_ids[0], user_id=1).all()
+    assert {row.class_id: row.pixels for row in rows} == {
+        c: int((masks[1] == c).sum()) for c in range(3)
+    }
+    assert {row.class_id: row.user_pixels for row in rows} == {
+        0: 0, 1: int((masks[1] == 1).sum()), 2: 0
+    }
+
+    assert client.get('/admin/api/statistics').status_code == 403
+    logged_in_user.admin = True
+    db.session.add(logged_in_user)
+    db.session.commit()
+
+    data = client.get('/admin/api/statistics').json
+    n_images = len(project.image_ids)
+    first_class = data['classes'][0]
+    assert first_class['name'] == project['classes'][0]['name']
+    assert first_class['pixels'] == n_images * int((masks[1] == 0).sum() + (masks[2] == 0).sum())
+    assert first_class['n_images'] == n_images
+    user1, user2 = data['users']
+    assert user1['name'] == 'test_user' and user1['n_images'] == n_images
+    assert user1['user_pixels'] == n_images * int((masks[1] == 1).sum())
+    assert user2['ai_pixels'] == user2['pixels'] == n_images * masks[2].size
+
+
+def test_merge_records_pairwise_agreement(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    for user_id in (2, 3):
+        db.session.add(User(id=user_id, name=f'user{user_id}'))
+    logged_in_user.admin = True
+    db.session.add(logged_in_user)
+    db.session.commit()
+
+    store = get_mask_store()
+    masks = {1: random_mask(1), 2: random_mask(2), 3: random_mask(1)}
+    first_image, second_image = project.image_ids[:2]
+    for user_id, mask in masks.items():
+        store.write(first_image, user_id, mask, np.ones_like(mask, dtype=bool))
+    for user_id in (1, 2):
+        store.write(second_image, user_id, masks[3 - user_id], np.ones_like(mask, dtype=bool))
+    merge_masks(first_image)
+    merge_masks(second_image)
+    assert Agreement.query.filter_by(image_id=first_image).count() == 3
+
+    data = client.get('/admin/api/agreement').json
+    assert [user['name'] for user in data['users']] == ['test_user', 'user2', 'user3']
+    assert data['matrix'][0][2] == data['matrix'][2][0] == 100
+    assert data['matrix'][0][1] == round(100 * np.mean(masks[1] == masks[2]), 2)
+    assert data['n_images'][0][1] == 2 and data['n_images'][1][2] == 1
+
+
+def test_review_queue_ranks_images_by_conflict(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    logged_in_user.admin = True
+    db.session.add(logged_in_user)
+    db.session.commit()
+
+    store = get_mask_store()
+    mask = random_mask(1)
+    other = mask.copy()
+    other[:10] = (other[:10] + 1) % 3
+    first_image, second_image = project.image_ids[:2]
+    for user_id, user_mask in enumerate([mask, mask, other], start=1):
+        store.write(first_image, user_id, user_mask, np.ones_like(mask, dtype=bool))
+    for user_id in (1, 2):
+        store.write(second_image, user_id, other, np.ones_like(mask, dtype=bool))
+    merge_masks(first_image)
+    merge_masks(second_image)
+
+    # The winners of the first ten rows only got two of three votes:
+    disagreement = read_disagreement(first_image)
+    assert disagreement[:10].all() and not disagreement[10:].any()
+    assert not read_disagreement(second_image).any()
+    assert not get_disagreement(np.array([[[2, 1, 0]]]), threshold=0.6).any()
+    assert get_disagreement(np.array([[[2, 1, 0]]]), threshold=0.7).all()
+
+    conflicts = {conflict.image_id: conflict for conflict in Conflict.query.all()}
+    assert conflicts[first_image].score == pytest.approx(np.mean(disagreement))
+    assert conflicts[second_image].score == 0
+
+    images = client.get('/admin/api/review-queue').json['images']
+    assert [image['image_id'] for image in images] == [first_image]
+    images = client.get('/admin/api/review-queue?min_score=-1&limit=1&offset=1').json['images']
+    assert [image['image_id'] for image in images] == [second_image]
+
+    response = client.get(f'/admin/api/review-queue/{first_image}/disagreement')
+    assert response.headers['Content-Type'] == 'image/png'
+    with Image.open(io.BytesIO(response.data)) as image:
+        np.testing.assert_array_equal(np.array(image), disagreement)
+    assert client.get('/admin/api/review-queue?limit=x').status_code == 400
+
+
+def test_review_queue_is_read_in_index_order(app):
+    query = Conflict.query.filter(Conflict.score > 0)\
+        .order_by(Conflict.score.desc(), Conflict.image_id).limit(10)
+    sql = str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+    plan = ' '.join(
+        row[-1] for row in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql))
+    )
+    assert 'ix_conflict_score_desc_image' in plan
+    assert 'TEMP B-TREE' not in plan
@@ -0,0 +1,81 @@
+import numpy as np
+
+from iris.models import Action
+from iris.project import project
+from iris.segmentation import read_votes
+from iris.segmentation.codec import MASK_VERSION_HEADER
+from iris.segmentation.merge_queue import merge_queue
+
+
+def _mask_payload(value):
+    width, height = project['segmentation']['mask_shape']
+    final_mask = np.full(width * height, value, dtype=np.uint8)
+    user_mask = np.ones(width * height, dtype=np.uint8)
+    return np.concatenate([[254], final_mask, user_mask, [254]]).astype(np.uint8).tobytes()
+
+
+def test_saves_are_coalesced_into_one_background_merge(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'integer'
+    project['segmentation']['merge_delay'] = 60
+    image_id = project.image_ids[0]
+    # Merges queued by other tests:
+    merge_queue.flush()
+
+    for value in (0, 1):
+        response = client.post(f'/segmentation/save_mask/{image_id}', data=_mask_payload(value))
+        assert response.status_code == 200
+
+    # The votes are up to date right away, the merge is still queued:
+    votes, users = read_votes(image_id)
+    assert users == ['1'] and votes[..., 1].all()
+    assert not (tmp_path / 'merged' / f'{image_id}.npy').exists()
+    status = client.get(f'/segmentation/api/merge-status/{image_id}').get_json()['merge']
+    assert status['status'] == 'pending'
+    assert status['pending_saves'] == 2
+
+    merge_queue.flush()
+    status = client.get(f'/segmentation/api/merge-status/{image_id}').get_json()['merge']
+    assert status['status'] == 'done'
+    assert status['merged_saves'] == 2
+    assert (np.load(tmp_path / 'merged' / f'{image_id}.npy') == 1).all()
+    assert Action.query.filter_by(image_id=image_id).one().score == 100
+
+    assert client.get('/segmentation/api/merge-status/unknown').status_code == 404
+
+
+def test_saves_do_not_wait_for_running_merges(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['merge_delay'] = 60
+    image_id = project.image_ids[0]
+    merge_queue.flush()
+
+    # A merge of the image is running (e.g. in the merge thread):
+    with merge_queue.merge_lock(image_id):
+        response = client.post(f'/segmentation/save_mask/{image_id}', data=_mask_payload(1))
+        assert response.status_code == 200
+    merge_queue.flush()
+
+    # Locks are dropped when nobody holds them:
+    assert merge_queue._locks == {} and merge_queue._merge_locks == {}
+
+
+def test_votes_are_recounted_after_a_class_was_added(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['merge_delay'] = 60
+    image_id = project.image_ids[0]
+    merge_queue.flush()
+    url = f'/segmentation/save_mask/{image_id}'
+    assert client.post(url, data=_mask_payload(1)).status_code == 200
+
+    new_class = len(project['classes'])
+    project['classes'].append({**project['classes'][0], 'name': 'new class'})
+    response = client.post(url, data=_mask_payload(new_class))
+    assert response.status_code == 200
+    assert response.headers[MASK_VERSION_HEADER] == '2'
+
+    votes, users = read_votes(image_id)
+    assert users == ['1'] and votes.shape[-1] == new_class + 1
+    assert votes[..., new_class].all() and not votes[..., 1].any()
+    merge_queue.flush()
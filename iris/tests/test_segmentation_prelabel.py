@@ -0,0 +1,106 @@
+from os import makedirs
+from os.path import exists
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.ai import CachedModel, model_cache
+from iris.segmentation.prelabel import Prelabeller, get_annotation_order, prelabeller
+from iris.segmentation.project_model import project_model
+from iris.tests.conftest import save_user_masks, striped_mask
+
+
+def _enable(tmp_path, queue_size=2):
+    project['path'] = str(tmp_path)
+    project['segmentation']['project_model'] = {
+        'enabled': True, 'pixels_per_image': 300, 'max_train_pixels': 1000,
+    }
+    project['segmentation']['prelabelling'] = {
+        'enabled': True, 'queue_size': queue_size,
+    }
+
+
+def test_annotation_order_follows_user_seeds(project_snapshot):
+    project.image_ids = [f'image{i}' for i in range(6)]
+    project.set_image_seed(5)
+    expected = [project.image_ids[index] for index in project.image_order]
+
+    assert get_annotation_order([(5, None)], set()) == expected
+    # Continues after the last image of the user and skips annotated ones:
+    order = get_annotation_order([(5, expected[0])], {expected[2]})
+    assert order == expected[1:2] + expected[3:] + expected[:1]
+
+
+def test_fill_is_bounded_and_resumable(tmp_path, project_snapshot):
+    _enable(tmp_path, queue_size=1)
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+    project_model.update_samples(image_id)
+    project_model.train()
+
+    queue = project.image_ids[::-1]
+    worker = Prelabeller()
+    worker.fill(queue)
+
+    width, height = project['segmentation']['mask_shape']
+    draft = worker.read_draft(queue[0])
+    assert draft.shape == (height, width)
+    assert worker.read_state() == {queue[0]: f'project:{project_model.version}'}
+    assert not exists(worker.get_draft_file(queue[1]))
+
+    # A new worker (e.g. after a restart) does not redo current drafts:
+    worker = Prelabeller()
+    worker.make_draft = None
+    worker.fill(queue)
+
+
+def test_no_drafts_without_project_model(tmp_path, project_snapshot):
+    _enable(tmp_path)
+    # Models trained interactively by users are not used for drafts:
+    model_cache.put(1, project.image_ids[0], 'key', CachedModel(object(), [0, 1], None, None))
+    try:
+        worker = Prelabeller()
+        assert worker.get_model() == (None, None)
+        worker.fill(project.image_ids)
+        assert worker.read_state() == {}
+    finally:
+        model_cache.clear()
+
+
+def test_load_mask_falls_back_to_draft(client, logged_in_user, tmp_path, project_snapshot):
+    _enable(tmp_path)
+    image_id = project.image_ids[0]
+    assert client.get(f'/segmentation/load_mask/{image_id}').status_code == 404
+
+    width, height = project['segmentation']['mask_shape']
+    draft = np.ones((height, width), dtype=np.uint8)
+    makedirs(prelabeller.directory, exist_ok=True)
+    np.save(prelabeller.get_draft_file(image_id), draft)
+
+    response = client.get(f'/segmentation/load_mask/{image_id}')
+    assert response.status_code == 200
+    data = np.frombuffer(response.data, dtype=np.uint8)
+    assert data[0] == 254 and data[-1] == 254
+    assert (data[1:width*height+1] == 1).all()
+    assert not data[width*height+1:-1].any()
+
+
+def test_draft_mask_serves_current_drafts(client, logged_in_user, tmp_path, project_snapshot):
+    _enable(tmp_path)
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+    project_model.update_samples(image_id)
+    project_model.train()
+
+    width, height = project['segmentation']['mask_shape']
+    draft = np.full((height, width), 1, dtype=np.uint8)
+    makedirs(prelabeller.directory, exist_ok=True)
+    np.save(prelabeller.get_draft_file(image_id), draft)
+    prelabeller.write_state({image_id: f'project:{project_model.version}'})
+
+    response = client.get(f'/segmentation/draft_mask/{image_id}')
+    assert response.data == draft.tobytes()
+
+    # Outdated drafts are not served:
+    prelabeller.write_state({image_id: 'project:0'})
+    assert prelabeller.read_draft(image_id, current=True) is None
@@ -0,0 +1,97 @@
+from os import utime
+from os.path import exists
+
+import numpy as np
+
+from iris.project import project
+from iris.segmentation.project_model import ProjectModel, project_model
+from iris.segmentation.scheduler import scheduler
+from iris.tests.conftest import save_user_masks, striped_mask
+
+
+def test_project_model_trains_from_saved_masks(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['project_model'] = {
+        'enabled': True, 'pixels_per_image': 300, 'max_train_pixels': 1000,
+    }
+    model = ProjectModel()
+    assert model.predict(project.image_ids[0]) is None
+
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+    save_user_masks(image_id, '2', striped_mask())
+
+    model.update_samples(image_id)
+    with np.load(model.get_sample_file(image_id)) as sample:
+        # Two users with 300 pixels each:
+        assert len(sample['labels']) == 600
+        assert sample['features'].shape[0] == 600
+
+    model.train()
+    assert exists(model.model_file)
+    # The refit only used a few threads of the budget:
+    [job] = [job for job in scheduler.stats()['recent_jobs'] if job['name'] == 'project model'][-1:]
+    assert job['n_threads'] <= ProjectModel.MAX_THREADS
+
+    predictions = model.predict(project.image_ids[-1])
+    width, height = project['segmentation']['mask_shape']
+    assert predictions.shape == (width * height,)
+    assert set(np.unique(predictions)) <= {0, 1}
+
+
+def test_project_model_runs_in_background(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['project_model'] = {
+        'enabled': True, 'pixels_per_image': 200, 'max_train_pixels': 1000,
+    }
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+
+    model = ProjectModel()
+    model.schedule(image_id)
+    model.wait(60)
+    assert model.load() is not None
+
+
+def test_draft_mask_endpoint_without_model(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project_model._model = None
+    response = client.get(f'/segmentation/draft_mask/{project.image_ids[0]}')
+    assert response.status_code == 404
+    assert client.get('/segmentation/draft_mask/unknown').status_code == 404
+
+
+def test_refits_are_debounced(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['project_model'] = {
+        'enabled': True, 'pixels_per_image': 200, 'max_train_pixels': 1000,
+        'refit_delay': 0.5,
+    }
+    model = ProjectModel()
+    trainings = []
+    model.update_samples = lambda image_id: None
+    model.train = lambda: trainings.append(True)
+
+    for image_id in project.image_ids[:3]:
+        model.schedule(image_id)
+    model.wait(60)
+    assert trainings == [True]
+
+
+def test_draft_predictions_are_cached(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['project_model'] = {
+        'enabled': True, 'pixels_per_image': 300, 'max_train_pixels': 1000,
+    }
+    image_id = project.image_ids[0]
+    save_user_masks(image_id, '1', striped_mask())
+    model = ProjectModel()
+    model.update_samples(image_id)
+    model.train()
+
+    predictions = model.predict(image_id)
+    assert model.predict(image_id) is predictions
+
+    # A new model version is predicted again:
+    utime(model.model_file, (1, 1))
+    assert model.predict(image_id) is not predictions
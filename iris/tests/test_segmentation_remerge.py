@@ -0,0 +1,59 @@
+from iris.models import Action, User, db
+from iris.project import project
+from iris.segmentation.remerge import remerger
+from iris.tests.conftest import random_mask, save_user_masks
+
+
+def _annotate_all_images(tmp_path):
+    project['path'] = str(tmp_path)
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.npy')
+    project['segmentation']['mask_encoding'] = 'binary'
+    for user_id in (1, 2):
+        db.session.add(User(id=user_id, name=f'user{user_id}'))
+    db.session.commit()
+    for seed, image_id in enumerate(project.image_ids):
+        for user_id in ('1', '2'):
+            save_user_masks(image_id, user_id, random_mask(seed * 10 + int(user_id)))
+
+
+def test_remerge_recomputes_scores_in_batches(tmp_path, project_snapshot):
+    _annotate_all_images(tmp_path)
+    project['segmentation']['score'] = 'accuracy'
+    project['segmentation']['unverified_threshold'] = 2
+
+    progress = []
+    status = remerger.run(
+        workers=2, batch_size=1, processes=False,
+        progress=lambda done, total: progress.append((done, total))
+    )
+    n_images = len(project.image_ids)
+    assert status['status'] == 'done' and status['done'] == n_images
+    assert progress[-1] == (n_images, n_images) and len(progress) == n_images
+
+    actions = Action.query.filter_by(type='segmentation').all()
+    assert len(actions) == 2 * n_images
+    # Two random masks with three classes agree on about a third of the pixels:
+    assert all(25 < action.score < 42 and action.unverified for action in actions)
+    for image_id in project.image_ids:
+        assert (tmp_path / 'merged' / f'{image_id}.npy').exists()
+
+    project['segmentation']['score'] = 'f1'
+    project['segmentation']['unverified_threshold'] = 1
+    remerger.run(processes=False)
+    db.session.expire_all()
+    assert not any(action.unverified for action in Action.query.all())
+
+
+def test_remerge_endpoint_requires_admin(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    assert client.post('/admin/api/remerge').status_code == 403
+
+    logged_in_user.admin = True
+    db.session.add(logged_in_user)
+    db.session.commit()
+    assert client.post('/admin/api/remerge', json={'workers': 0}).status_code == 400
+    response = client.post('/admin/api/remerge', json={'workers': 2})
+    assert response.status_code == 202
+    remerger.wait(10)
+    status = client.get('/admin/api/remerge').json['remerge']
+    assert status['status'] == 'done' and status['total'] == 0
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from iris.project import project
+from iris.segmentation.scheduler import ThreadScheduler, call_cooperatively
+
+
+def test_scheduler_shares_budget_and_records_metrics(project_snapshot):
+    project.config['compute'] = {'thread_budget': 4, 'max_threads_per_job': 3}
+    scheduler = ThreadScheduler()
+
+    with scheduler.slot(name='first') as n_first:
+        assert n_first == 3
+        assert scheduler.stats()['threads_in_use'] == 3
+        with scheduler.slot(name='second') as n_second:
+            assert n_second == 1
+
+    stats = scheduler.stats()
+    assert stats['threads_in_use'] == 0
+    assert stats['total_jobs'] == 2
+    assert [job['name'] for job in stats['recent_jobs']] == ['second', 'first']
+    assert stats['recent_jobs'][0]['n_threads'] == 1
+
+
+def test_scheduler_waits_until_threads_are_free(project_snapshot):
+    project.config['compute'] = {'thread_budget': 2, 'max_threads_per_job': 2}
+    scheduler = ThreadScheduler()
+    allocations = []
+
+    def worker():
+        with scheduler.slot(name='waiting') as n_threads:
+            allocations.append(n_threads)
+
+    with scheduler.slot(name='blocking') as n_threads:
+        assert n_threads == 2
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.05)
+        assert scheduler.stats()['waiting_jobs'] == 1
+        assert not allocations
+
+    thread.join(5)
+    assert allocations == [2]
+    waiting = [job for job in scheduler.stats()['recent_jobs'] if job['name'] == 'waiting'][0]
+    assert waiting['wait_time'] >= 0.05
+
+
+def test_jobs_get_half_of_the_budget_by_default(project_snapshot):
+    project.config['compute'] = {'thread_budget': 8, 'max_threads_per_job': None}
+    scheduler = ThreadScheduler()
+    with scheduler.slot() as n_first, scheduler.slot() as n_second:
+        assert n_first == n_second == 4
+
+
+def test_waiting_greenlets_do_not_block_the_hub(project_snapshot):
+    gevent = pytest.importorskip('gevent')
+    project.config['compute'] = {'thread_budget': 1, 'max_threads_per_job': 1}
+    scheduler = ThreadScheduler()
+    released = threading.Event()
+
+    def hold():
+        with scheduler.slot(name='background'):
+            released.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    time.sleep(0.05)
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            gevent.sleep(0.01)
+            ticks.append(True)
+        released.set()
+
+    gevent.spawn(tick)
+    with scheduler.slot(name='request'):
+        # The other greenlet ran while this one was waiting:
+        assert len(ticks) == 5
+    thread.join(5)
+
+
+def test_long_calls_do_not_block_the_hub():
+    gevent = pytest.importorskip('gevent')
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            gevent.sleep(0.01)
+            ticks.append(True)
+
+    def slow(value):
+        time.sleep(0.2)
+        return value
+
+    gevent.spawn(tick)
+    assert call_cooperatively(slow, 42) == 42
+    assert len(ticks) == 5
+
+
+def test_metrics_endpoint_requires_admin(client, logged_in_user):
+    assert client.get('/admin/api/metrics').status_code == 403
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+
+from iris.project import project
+from iris.segmentation import read_disagreement, read_votes
+from iris.segmentation.journal import mask_journal
+from iris.segmentation.merge_queue import merge_queue
+from iris.segmentation.storage import (
+    FileMaskStore, SQLiteMaskStore, copy_masks, get_mask_store, pack_user_mask,
+    unpack_user_mask
+)
+from iris.tests.conftest import save_user_masks
+
+
+def _masks(seed, shape=(7, 5)):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 3, shape).astype(np.uint8), rng.rand(*shape) > 0.5
+
+
+def test_pack_user_mask_roundtrip():
+    user_mask = np.random.RandomState(0).rand(3, 11) > 0.5
+    packed = pack_user_mask(user_mask)
+    assert packed.nbytes == 5
+    np.testing.assert_array_equal(unpack_user_mask(packed, (3, 11)), user_mask)
+
+
+def test_file_store_roundtrip_is_atomic(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    store = FileMaskStore()
+    final_mask, user_mask = _masks(1)
+
+    assert not store.exists('IMG', '1')
+    store.write('IMG', '1', final_mask, user_mask)
+    assert store.exists('IMG', '1')
+    assert os.listdir(tmp_path / 'segmentation' / 'IMG') == ['1_mask.npz']
+
+    read_final, read_user = store.read('IMG', '1')
+    assert read_final.dtype == np.uint8
+    np.testing.assert_array_equal(read_final, final_mask)
+    np.testing.assert_array_equal(read_user, user_mask)
+
+
+def test_file_store_reads_and_migrates_legacy_masks(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    store = FileMaskStore()
+    image_id = project.image_ids[0]
+    width, height = project['segmentation']['mask_shape']
+    legacy_mask = np.zeros((height, width), dtype=np.uint8)
+    legacy_mask[:, :3] = 2
+    save_user_masks(image_id, '1', legacy_mask)
+    store.write(image_id, '2', *_masks(2, (height, width)))
+
+    assert store.users(image_id) == ['1', '2']
+    np.testing.assert_array_equal(store.read(image_id, '1')[0], legacy_mask)
+
+    assert store.migrate() == 1
+    assert sorted(os.listdir(tmp_path / 'segmentation' / image_id)) == ['1_mask.npz', '2_mask.npz']
+    final_mask, user_mask = store.read(image_id, '1')
+    np.testing.assert_array_equal(final_mask, legacy_mask)
+    assert user_mask.all()
+    assert store.migrate() == 0
+
+
+def test_sqlite_store_and_export_to_files(tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    store = SQLiteMaskStore()
+    masks = {('IMG', '2'): _masks(2), ('IMG', '1'): _masks(1), ('OTHER', '1'): _masks(3)}
+    for (image_id, user_id), (final_mask, user_mask) in masks.items():
+        store.write(image_id, user_id, final_mask, user_mask)
+    # Overwriting keeps a single entry:
+    store.write('IMG', '1', *masks['IMG', '1'])
+
+    assert store.users('IMG') == ['1', '2']
+    assert store.exists('OTHER', '1') and not store.exists('OTHER', '2')
+    assert store.items() == [('IMG', '1'), ('IMG', '2'), ('OTHER', '1')]
+    with pytest.raises(FileNotFoundError):
+        store.read('OTHER', '2')
+    assert not (tmp_path / 'segmentation').exists()
+
+    files = FileMaskStore()
+    assert copy_masks(store, files) == 3
+    for (image_id, user_id), (final_mask, user_mask) in masks.items():
+        read_final, read_user = files.read(image_id, user_id)
+        np.testing.assert_array_equal(read_final, final_mask)
+        np.testing.assert_array_equal(read_user, user_mask)
+
+    # Masks which are newer in the target are not overwritten:
+    newer_mask = _masks(4)
+    files.write('OTHER', '1', *newer_mask, version=5)
+    assert copy_masks(store, files) == 2
+    np.testing.assert_array_equal(files.read('OTHER', '1')[0], newer_mask[0])
+
+
+def test_mask_store_is_selected_by_config(client, logged_in_user, tmp_path, project_snapshot):
+    project['path'] = str(tmp_path)
+    project['segmentation']['mask_store'] = 'sqlite'
+    project['segmentation']['merge_delay'] = 60
+    assert isinstance(get_mask_store(), SQLiteMaskStore)
+    with pytest.raises(ValueError):
+        get_mask_store('magic')
+
+    width, height = project['segmentation']['mask_shape']
+    image_id = project.image_ids[0]
+    data = np.concatenate([
+        [254], np.ones(width * height), np.zeros(width * height), [254]
+    ]).astype(np.uint8).tobytes()
+    assert client.post(f'/segmentation/save_mask/{image_id}', data=data).status_code == 200
+    assert get_mask_store().users(image_id) == ['1']
+    assert not (tmp_path / 'segmentation' / image_id / '1_mask.npz').exists()
+
+    response = client.get(f'/segmentation/load_mask/{image_id}')
+    assert response.data == data
+
+    # Votes, disagreement map and journal are kept in masks.db as well:
+    project['segmentation']['path'] = str(tmp_path / 'merged' / '{id}.png')
+    merge_queue.flush()
+    mask_journal.write_snapshot(image_id, '1', 1, (height, width))
+    assert not (tmp_path / 'segmentation').exists()
+    assert read_votes(image_id)[1] == ['1']
+    assert read_disagreement(image_id).shape == (height, width)
+    assert mask_journal.get_snapshots(image_id, '1') == [1]
+    assert [entry['version'] for entry in mask_journal.get_history(image_id)] == [1]
+
+    # The data is exported together with the masks:
+    files = FileMaskStore()
+    assert copy_masks(get_mask_store(), files) == 1
+    assert files.list_data(image_id) == [
+        'disagreement.npz', 'journal.bin', 'journal.json', 'journal/1_1.npz', 'votes.npz'
+    ]
@@ -1,8 +1,11 @@
 import numpy as np
+from PIL import Image
 import pytest
 
 from iris.project import project
-from iris.segmentation import encode_mask, get_score, image_dict_to_array
+from iris.segmentation import (
+    encode_mask, get_score, image_dict_to_array, save_encoded_mask
+)
 
 
 def test_encode_mask_integer_and_binary_and_unknown(tmp_path, monkeypatch):
@@ -17,6 +20,28 @@ def test_encode_mask_integer_and_binary_and_unknown(tmp_path, monkeypatch):
         encode_mask(mask, mode="bogus")
 
 
+def test_encode_mask_colours_and_palette_png(tmp_path, project_snapshot):
+    project['classes'] = [
+        {"colour": (0, 0, 0, 0)}, {"colour": (255, 0, 0, 255)}, {"colour": (0, 0, 255, 128)}
+    ]
+    mask = np.array([[0, 1, 2], [2, 1, 0]], dtype=np.uint8)
+
+    rgba = encode_mask(mask, mode="rgba")
+    assert rgba.dtype == np.uint8 and rgba.shape == (2, 3, 4)
+    assert rgba[0, 2].tolist() == [0, 0, 255, 128]
+    np.testing.assert_array_equal(encode_mask(mask, mode="rgb"), rgba[..., :3])
+    np.testing.assert_array_equal(
+        encode_mask(mask, mode="binary"), np.stack([mask == c for c in range(3)], axis=-1)
+    )
+
+    filename = str(tmp_path / "mask.png")
+    save_encoded_mask(filename, encode_mask(mask, mode="palette"), "palette")
+    with Image.open(filename) as image:
+        assert image.mode == "P"
+        np.testing.assert_array_equal(np.array(image), mask)
+        np.testing.assert_array_equal(np.array(image.convert("RGBA")), rgba)
+
+
 def test_image_dict_to_array_and_passthrough():
     a = np.ones((2, 2), dtype=np.uint8)
     d = {"a": a, "b": a * 2}